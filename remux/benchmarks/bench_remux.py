@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# Benchmarks the UBV discovery, MP4 handling and the full --parse-all flow
+# against a synthetic YYYY/MM/DD tree, using stub remux and ubnt_ubvinfo
+# executables so no real footage or ARM emulation is needed.
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import date, datetime, timedelta, timezone
+
+BASE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_PATH)
+from utilities.config import PathCfg  # noqa: E402
+from utilities.processing import UBVRemux  # noqa: E402
+
+STUB_REMUX = """#!/usr/bin/env python3
+import os, sys, time, struct
+from datetime import datetime, timezone
+latency = float(os.environ.get('STUB_REMUX_LATENCY', '0'))
+segments = int(os.environ.get('STUB_REMUX_SEGMENTS', '3'))
+size = int(os.environ.get('STUB_MP4_SIZE', '0'))
+folder = sys.argv[3]
+
+def box(kind, payload):
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+# The smallest file UBV_VERIFY_MP4 accepts, one minute long: ftyp, then
+# moov with an mvhd, then an mdat padded out to STUB_MP4_SIZE
+mvhd = struct.pack('>B3xIIII', 0, 0, 0, 1000, 60000) + bytes(80)
+header = box(b'ftyp', b'isom' + bytes(4) + b'isom') + \\
+    box(b'moov', box(b'mvhd', mvhd))
+mdat = max(size - len(header), 8)
+for ubv in sys.argv[4:]:
+    mac, _, _, epoch = os.path.basename(ubv)[:-4].split('_')
+    start = int(epoch) / 1000
+    for i in range(segments):
+        stamp = datetime.fromtimestamp(start + i * 60, timezone.utc)
+        name = f"{mac}_0_rotating_" \\
+            f"{stamp.strftime('%Y-%m-%dT%H.%M.%S+00.00')}"
+        path = os.path.join(folder, name + '.mp4')
+        sys.stderr.write(f"Writing MP4 {path}\\n")
+        sys.stderr.flush()
+        time.sleep(latency / segments)
+        with open(path, 'wb') as fh:
+            fh.write(header + struct.pack('>I4s', mdat, b'mdat'))
+            # Sparse, like the UBV files
+            fh.truncate(len(header) + mdat)
+"""
+
+STUB_UBVINFO = """#!/usr/bin/env python3
+import os, sys, time
+time.sleep(float(os.environ.get('STUB_UBVINFO_LATENCY', '0')))
+print('----------- PARTITION START -----------')
+print('Type TID KF OFFSET SIZE DTS CTS WC CR')
+"""
+
+
+def camera_macs(count):
+    return [f"AABBCC{n:06X}" for n in range(count)]
+
+
+def generate_tree(root, days, cameras, files_per_day, file_size):
+    # Days end the day before yesterday so UBV_MIN_AGE=1 includes them all
+    last = date.today() - timedelta(days=2)
+    macs = camera_macs(cameras)
+    count = 0
+    for d in range(days):
+        day = last - timedelta(days=d)
+        folder = os.path.join(
+            root, f"{day.year:04d}", f"{day.month:02d}", f"{day.day:02d}"
+        )
+        os.makedirs(folder, exist_ok=True)
+        midnight = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+        per_camera = max(1, files_per_day // cameras)
+        for mac in macs:
+            for n in range(per_camera):
+                epoch = int((midnight.timestamp() + n * 600) * 1000)
+                path = os.path.join(folder, f"{mac}_0_rotating_{epoch}.ubv")
+                with open(path, 'wb') as fh:
+                    # Sparse, so large scales don't need the disk space
+                    fh.truncate(file_size)
+                count += 1
+    return count
+
+
+def install_stubs(bin_path):
+    os.makedirs(bin_path, exist_ok=True)
+    stubs = [('remux', STUB_REMUX), ('ubnt_ubvinfo', STUB_UBVINFO)]
+    for name, script in stubs:
+        path = os.path.join(bin_path, name)
+        with open(path, 'w') as fh:
+            fh.write(script)
+        os.chmod(path, 0o755)
+    os.environ['PATH'] = os.pathsep.join([bin_path, os.environ['PATH']])
+
+
+def timed(results, name, func, count=None):
+    start = time.perf_counter()
+    value = func()
+    seconds = time.perf_counter() - start
+    results[name] = {"seconds": round(seconds, 6)}
+    if count:
+        results[name]['count'] = count
+        results[name]['per_second'] = round(count / seconds, 2)
+    print(f"{name:<24} {seconds:10.4f}s", file=sys.stderr)
+    return value
+
+
+def write_env(path, workdir, args):
+    settings = {
+        "CLOUDKEY_CONTROLLER": "127.0.0.1",
+        "CLOUDKEY_USERNAME": "bench",
+        "CLOUDKEY_PASSWORD": "bench",
+        "CLOUDKEY_VERIFY_SSL": "true",
+        "CLOUDKEY_CACHE": os.path.join(workdir, 'cameras.json'),
+        "UBV_FILES": os.path.join(workdir, 'ubv'),
+        "UBV_TEMP": os.path.join(workdir, 'temp'),
+        "UBV_OUTPUT": os.path.join(workdir, 'output'),
+        "UBV_MIN_AGE": "1",
+        "UBV_REMUX_BATCH_FILES": str(args.batch_files),
+        # Sparse UBV files would otherwise be held back on a small disk
+        "UBV_DISK_WATERMARK": "0",
+        "LOGGING_ENABLED": "true",
+        "LOGGING_TO_FILE": "false",
+        "LOGGING_LEVEL": "WARNING",
+    }
+    with open(path, 'w') as fh:
+        for k, v in settings.items():
+            fh.write(f"{k}={v}\n")
+    for k, v in settings.items():
+        os.environ[k] = v
+    return settings
+
+
+def git_version():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], cwd=BASE_PATH,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark Unifi Protect Extract on a synthetic tree"
+    )
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--cameras", type=int, default=4)
+    parser.add_argument("--files-per-day", type=int, default=40)
+    parser.add_argument(
+        "--file-size", type=int, default=0,
+        help="Apparent size of each sparse UBV file in bytes."
+    )
+    parser.add_argument("--segments", type=int, default=3)
+    parser.add_argument("--mp4-size", type=int, default=0)
+    parser.add_argument("--remux-latency", type=float, default=0.0)
+    parser.add_argument("--ubvinfo-latency", type=float, default=0.0)
+    parser.add_argument(
+        "--mp4-count", type=int, default=2000,
+        help="MP4 files used for the parse_mp4 and move_mp4 timings."
+    )
+    parser.add_argument(
+        "--parse-all-days", type=int, default=3,
+        help="Days kept for the full --parse-all run, 0 to skip it."
+    )
+    parser.add_argument("--jobs", type=int, default=None)
+    parser.add_argument(
+        "--order", default="lpt",
+        help="--order for the full --parse-all run."
+    )
+    parser.add_argument(
+        "--batch-files", type=int, default=1,
+        help="UBV_REMUX_BATCH_FILES for the full --parse-all run."
+    )
+    parser.add_argument(
+        "--workdir", default=None,
+        help="Where to build the tree. Defaults to a temporary folder."
+    )
+    parser.add_argument(
+        "--output", "-o", default="bench_output.json",
+        help="Where to write the JSON results."
+    )
+    return parser
+
+
+def run(args, workdir):
+    results = {}
+    install_stubs(os.path.join(workdir, 'bin'))
+    env_path = os.path.join(workdir, 'bench.env')
+    write_env(env_path, workdir, args)
+    for name in ('temp', 'output'):
+        os.makedirs(os.path.join(workdir, name), exist_ok=True)
+    os.environ['STUB_REMUX_LATENCY'] = str(args.remux_latency)
+    os.environ['STUB_REMUX_SEGMENTS'] = str(args.segments)
+    os.environ['STUB_MP4_SIZE'] = str(args.mp4_size)
+    os.environ['STUB_UBVINFO_LATENCY'] = str(args.ubvinfo_latency)
+    macs = camera_macs(args.cameras)
+    cameras = {
+        mac: {"name": f"Camera {n}", "type": "UVC G3"}
+        for n, mac in enumerate(macs)
+    }
+    with open(os.path.join(workdir, 'cameras.json'), 'w') as fh:
+        json.dump({"fetched": time.time(), "cameras": cameras}, fh)
+
+    ubv_root = os.path.join(workdir, 'ubv')
+    total = timed(
+        results, "generate_tree",
+        lambda: generate_tree(
+            ubv_root, args.days, args.cameras, args.files_per_day,
+            args.file_size
+        )
+    )
+    remux = UBVRemux(config=PathCfg(), auto_create_tmp=False)
+    timed(results, "get_ubv_files_cold", remux.get_ubv_files, total)
+    timed(results, "get_ubv_files_warm", remux.get_ubv_files, total)
+    fresh = UBVRemux(config=PathCfg(), auto_create_tmp=False)
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            timed(
+                results, "get_ubv_filecounts",
+                lambda: fresh.get_ubv_filecounts(cameras), total
+            )
+        finally:
+            sys.stdout = stdout
+
+    # MP4 handling on its own
+    mp4_folder = os.path.join(workdir, 'mp4')
+    os.makedirs(mp4_folder, exist_ok=True)
+    start = datetime(2021, 1, 27, tzinfo=timezone.utc).timestamp()
+    mp4_files = []
+    for n in range(args.mp4_count):
+        stamp = datetime.fromtimestamp(start + n * 60, timezone.utc)
+        name = f"{macs[n % len(macs)]}_0_rotating_" \
+            f"{stamp.strftime('%Y-%m-%dT%H.%M.%S+00.00')}.mp4"
+        path = os.path.join(mp4_folder, name)
+        open(path, 'wb').close()
+        mp4_files.append(path)
+    remux.temp = mp4_folder
+    mp4dicts = timed(
+        results, "parse_mp4",
+        lambda: [remux.parse_mp4(x, cameras) for x in mp4_files],
+        len(mp4_files)
+    )
+    timed(
+        results, "plan_mp4_files",
+        lambda: remux.plan_mp4_files(mp4_files, cameras), len(mp4_files)
+    )
+    timed(
+        results, "move_mp4",
+        lambda: [remux.move_mp4(x) for x in mp4dicts], len(mp4dicts)
+    )
+    shutil.rmtree(os.path.join(workdir, 'output'))
+    os.makedirs(os.path.join(workdir, 'output'))
+
+    # The full command line flow over the most recent days
+    if args.parse_all_days:
+        keep = sorted(remux.get_ubv_files().keys())[-args.parse_all_days:]
+        for day, files in remux.get_ubv_files().items():
+            if day not in keep:
+                for x in files:
+                    os.remove(x['file'])
+        files = sum(
+            len(v) for v in UBVRemux(
+                config=PathCfg(), auto_create_tmp=False
+            ).get_ubv_files().values()
+        )
+        command = [
+            sys.executable, os.path.join(BASE_PATH, 'remux.py'),
+            '-e', env_path, '--parse-all', '--offline', '--order', args.order
+        ]
+        if args.jobs:
+            command += ['--jobs', str(args.jobs)]
+        timed(
+            results, "parse_all",
+            lambda: subprocess.run(
+                command, cwd=BASE_PATH, check=True,
+                stdout=subprocess.DEVNULL
+            ),
+            files
+        )
+    return results
+
+
+if __name__ == "__main__":
+    args = parse_arguments().parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        results = run(args, args.workdir)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = run(args, workdir)
+    report = {
+        "version": git_version(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "parameters": vars(args),
+        "results": results
+    }
+    with open(args.output, 'w') as fh:
+        json.dump(report, fh, indent=2)
+    print(f"Wrote results to {args.output}", file=sys.stderr)
@@ -1,13 +1,18 @@
 #!/usr/bin/env python3
 import os
 import sys
+import signal
 import logging
+import threading
 import argparse
 from datetime import datetime
 from dateutil import parser as dateparse
 from utilities.config import Config
 from utilities.processing import UBVRemux
 from utilities.cloudkey import CloudKey
+from utilities.engine import AsyncRemuxEngine
+from utilities.planner import ORDERS
+from utilities.watch import UBVWatcher
 
 
 def str2bool(v):
@@ -35,6 +40,67 @@ def parse_date(d):
     return date.date()
 
 
+def parse_time(d):
+    try:
+        return dateparse.parse(d)
+    except dateparse.ParserError as e:
+        logger.critical(f"Bad time passed: {d} - {e}")
+        sys.exit(1)
+
+
+def remux_date(remux, date, cameras, engine):
+    if engine == "asyncio":
+        ubv_files = remux.get_ubv_by_date(date) or []
+        AsyncRemuxEngine(
+            remux,
+            prepare_timeout=config.paths.prepare_timeout,
+            remux_timeout=config.paths.remux_timeout
+        ).run(ubv_files, cameras)
+    else:
+        remux.remux_ubv_by_date(date, cameras)
+
+
+def remux_all(remux, cameras, engine, order):
+    if engine == "asyncio":
+        AsyncRemuxEngine(
+            remux,
+            prepare_timeout=config.paths.prepare_timeout,
+            remux_timeout=config.paths.remux_timeout
+        ).run(remux.plan_all(cameras, order), cameras)
+    else:
+        remux.remux_all(cameras, order)
+
+
+def watch(remux, cloudkey, order):
+    stop = threading.Event()
+
+    def _stop(signum, frame):
+        logger.info("Stopping once the files in progress are done...")
+        stop.set()
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    watcher = UBVWatcher(
+        config.paths.files, quiet=config.paths.watch_quiet,
+        interval=config.paths.watch_interval,
+        use_inotify=not config.paths.watch_poll
+    )
+    logger.info(f"Watching {config.paths.files} for UBV files.")
+    remux.watch(
+        watcher, dict(cloudkey.get_cameras()), stop, order=order,
+        get_cameras=cloudkey.get_cameras,
+        on_group=lambda group: write_metrics(remux)
+    )
+
+
+def write_metrics(remux):
+    if remux.profiler:
+        remux.profiler.write_report()
+    if config.metrics.textfile:
+        remux.metrics.write_textfile(config.metrics.textfile)
+    if config.metrics.summary:
+        remux.metrics.write_summary(config.metrics.summary)
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser(
         description="Unifi Protect Extract - A Working Title!"
@@ -58,6 +124,71 @@ def parse_arguments():
         type=str2bool, nargs='?', const=True, default=False,
         help="List all of the dates available for parsing."
     )
+    parser.add_argument(
+        "--order",
+        choices=ORDERS, default="lpt",
+        help="Order for --parse-all: largest files first (lpt), oldest "
+        "first, or day by day (date). Defaults to lpt."
+    )
+    parser.add_argument(
+        "--format",
+        choices=["table", "json", "csv"], default="table",
+        help="Output format for --list-dates and --find. Defaults to table."
+    )
+    parser.add_argument(
+        "--find",
+        nargs=3, metavar=("CAMERA", "START", "END"),
+        help="List the MP4 segments in UBV_CATALOG from a camera, by name "
+        "or MAC, between two times."
+    )
+    parser.add_argument(
+        "--rebuild-catalog",
+        type=str2bool, nargs='?', const=True, default=False,
+        help="Rebuild UBV_CATALOG from the MP4 files in UBV_OUTPUT."
+    )
+    parser.add_argument(
+        "--watch",
+        type=str2bool, nargs='?', const=True, default=False,
+        help="Keep running and remux UBV files as soon as they've settled."
+    )
+    parser.add_argument(
+        "--offline",
+        type=str2bool, nargs='?', const=True, default=False,
+        help="Use the cached camera list instead of the CloudKey."
+    )
+    parser.add_argument(
+        "--import-sentinels",
+        type=str2bool, nargs='?', const=True, default=False,
+        help="Import .txt/.muxed sentinel files into UBV_STATE_DB."
+    )
+    parser.add_argument(
+        "--jobs", "-j",
+        type=int, default=None,
+        help="Number of UBV files to remux at once. "
+        "Defaults to the number of CPU cores."
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["threads", "asyncio"], default="threads",
+        help="How to run the prepare, remux and move stages. "
+        "Defaults to threads."
+    )
+    parser.add_argument(
+        "--profile",
+        default=None, metavar="DIR",
+        help="Record child process CPU/memory and cProfile data for the "
+        "Python stages into DIR."
+    )
+    parser.add_argument(
+        "--prepare-jobs",
+        type=int, default=None,
+        help="Number of UBV files to prepare at once. Defaults to --jobs."
+    )
+    parser.add_argument(
+        "--move-jobs",
+        type=int, default=None,
+        help="Number of MP4 moves to run at once. Defaults to 2."
+    )
     # parser.add_argument(
     #     "--no-cleanup", "-nc",
     #     type=str2bool, nargs='?', const=True, default=False,
@@ -70,7 +201,6 @@ if __name__ == "__main__":
     # Parse Arguments
     p = parse_arguments()
     args = p.parse_args()
-    print(args)
     # Handle the default environment config
     if args.environment:
         if os.path.exists(args.environment):
@@ -85,8 +215,11 @@ if __name__ == "__main__":
     # Create the logging object
     logger = logging.getLogger()
     logging_handlers = []
-    # Add the stdout
-    logging_handlers.append(logging.StreamHandler(sys.stdout))
+    # Add the stdout, or stderr when stdout is machine readable
+    if (args.list_dates or args.find) and args.format != "table":
+        logging_handlers.append(logging.StreamHandler(sys.stderr))
+    else:
+        logging_handlers.append(logging.StreamHandler(sys.stdout))
     if config.logs.format:
         log_format = config.logs.format
     else:
@@ -114,7 +247,12 @@ if __name__ == "__main__":
         handlers=logging_handlers
     )
     logger.info("Initialized.")
-    cloudkey = CloudKey(config=config.cloudkey)
+    logger.debug(args)
+    if args.profile and args.engine == "asyncio":
+        logger.warning(
+            "--profile only records child processes with --engine threads."
+        )
+    cloudkey = CloudKey(config=config.cloudkey, offline=args.offline)
 
     # TODO - Implement cleanup
     # Determine if we are being destructive, invert the param
@@ -128,34 +266,86 @@ if __name__ == "__main__":
     #         "Destructive is set to False. UBV files will be retained.")
 
     # Handle the arguments
-    if args.list_dates:
+    if args.import_sentinels:
+        if not config.paths.state_db:
+            logger.critical("UBV_STATE_DB is not configured.")
+            sys.exit(1)
+        remux = UBVRemux(config=config.paths, auto_create_tmp=False)
+        remux.state.import_sentinels(config.paths.files)
+        sys.exit(0)
+    elif args.find or args.rebuild_catalog:
+        if not config.paths.catalog:
+            logger.critical("UBV_CATALOG is not configured.")
+            sys.exit(1)
+        remux = UBVRemux(config=config.paths, auto_create_tmp=False)
+        if args.find:
+            camera, start, end = args.find
+            remux.find_segments(
+                camera, parse_time(start), parse_time(end),
+                output_format=args.format
+            )
+        else:
+            remux.catalog.rebuild(
+                config.paths.output, cameras=cloudkey.get_cameras()
+            )
+        remux.catalog.close()
+        cloudkey.close()
+        sys.exit(0)
+    elif args.list_dates:
         logger.info("Listing all Dates with UBV Files...")
         cameras = cloudkey.get_cameras()
         remux = UBVRemux(config=config.paths, auto_create_tmp=False)
-        remux.get_ubv_filecounts(cameras)
+        remux.get_ubv_filecounts(cameras, output_format=args.format)
+        cloudkey.close()
+    elif args.watch:
+        remux = UBVRemux(
+            config=config.paths, jobs=args.jobs,
+            prepare_jobs=args.prepare_jobs, move_jobs=args.move_jobs
+        )
+        if args.profile:
+            remux.enable_profiling(args.profile)
+        watch(remux, cloudkey, args.order)
+        remux.report_moves()
+        remux.report_fingerprints()
+        write_metrics(remux)
+        os.rmdir(remux.temp)
+        cloudkey.close()
+        sys.exit(0)
     elif args.parse_date:
         date = parse_date(args.parse_date)
         logger.info(f"Parsing all UBV Files on {date}")
         cameras = cloudkey.get_cameras()
-        remux = UBVRemux(config=config.paths)
-        remux.remux_ubv_by_date(
-            date, cameras
+        remux = UBVRemux(
+            config=config.paths, jobs=args.jobs,
+            prepare_jobs=args.prepare_jobs, move_jobs=args.move_jobs
         )
+        if args.profile:
+            remux.enable_profiling(args.profile)
+        remux_date(remux, date, cameras, args.engine)
+        remux.report_moves()
+        remux.report_fingerprints()
+        write_metrics(remux)
         logger.info(f"Completed Parsing {date}. Cleaning up...")
         os.rmdir(remux.temp)
+        cloudkey.close()
         sys.exit(0)
     elif args.parse_all:
         logger.info(
             f"Parsing all UBV files available in {config.paths.files}")
         cameras = cloudkey.get_cameras()
-        remux = UBVRemux(config=config.paths)
-        ubv_files = remux.get_ubv_files()
-        for date in sorted(ubv_files.keys()):
-            remux.remux_ubv_by_date(
-                date, cameras
-            )
+        remux = UBVRemux(
+            config=config.paths, jobs=args.jobs,
+            prepare_jobs=args.prepare_jobs, move_jobs=args.move_jobs
+        )
+        if args.profile:
+            remux.enable_profiling(args.profile)
+        remux_all(remux, cameras, args.engine, args.order)
+        remux.report_moves()
+        remux.report_fingerprints()
+        write_metrics(remux)
         logger.info("Completed Parsing all files. Cleaning up...")
         os.rmdir(remux.temp)
+        cloudkey.close()
         sys.exit(0)
     else:
         logger.warning("No arguments passed.")
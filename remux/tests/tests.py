@@ -1,13 +1,54 @@
+import io
 import os
 import sys
 import json
+import time
+import errno
+import random
+import struct
+import pstats
+import cProfile
 import logging
+import sqlite3
+import tempfile
+import threading
 import unittest
+import multiprocessing
+import subprocess
 from unittest.mock import patch
-from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import date, datetime
 from utilities.config import Config
 from utilities.cloudkey import CloudKey
-from utilities.processing import UBVRemux
+from utilities.engine import AsyncRemuxEngine, ToolTimeout
+from utilities.pipeline import Pipeline
+from utilities.processing import UBVRemux, parse_mp4_name
+from utilities.state import StateStore
+from utilities.inventory import UBVInventory
+from utilities.metrics import Metrics
+from utilities.profiling import Profiler
+from utilities.leases import LeaseManager, LeaseLost
+from utilities.journal import Journal
+from utilities.admission import DiskAdmission
+from utilities.planner import plan_ubv_files, parse_weights
+from utilities.watch import StabilityTracker, UBVWatcher
+from utilities import fingerprint
+from utilities import mp4info
+from utilities.catalog import SegmentCatalog
+from utilities.results import FileResult, SegmentResult
+from utilities import transfer
+
+
+def _box(kind, payload=b''):
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+
+def _mp4_bytes(seconds, timescale=1000, mdat=b'\x00' * 64):
+    # ftyp, moov with just an mvhd, and mdat: the boxes verify_segment needs
+    mvhd = struct.pack('>B3xIIII', 0, 0, 0, timescale, seconds * timescale)
+    return _box(b'ftyp', b'isom\x00\x00\x02\x00isom') + \
+        _box(b'moov', _box(b'mvhd', mvhd + b'\x00' * 80)) + \
+        _box(b'mdat', mdat)
 
 
 def _load_boostrap(basepath):
@@ -36,6 +77,74 @@ def _load_testdata(basepath):
     return data
 
 
+class _FakeCloudKeyHandler(BaseHTTPRequestHandler):
+    # Serves just enough of the UniFi OS API for CloudKey
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path))
+        if self.path == "/":
+            self._reply(200, b"", {"X-CSRF-Token": "token"})
+        elif not self._authorized():
+            self._reply(401, b"{}")
+        elif self.path == "/proxy/protect/api/bootstrap":
+            self._reply(200, json.dumps(self.server.bootstrap).encode())
+        elif self.path == "/proxy/protect/api/cameras":
+            self._reply(
+                200, json.dumps(self.server.bootstrap['cameras']).encode()
+            )
+        else:
+            self._reply(404, b"")
+
+    def do_POST(self):
+        self.server.requests.append(("POST", self.path))
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        if self.path == "/api/auth/login":
+            self.server.token += 1
+            self._reply(200, b"{}", {
+                "Set-Cookie": f"TOKEN={self.server.token}; Path=/",
+                "X-Updated-CSRF-Token": f"token-{self.server.token}"
+            })
+        elif self.path == "/api/auth/logout":
+            self._reply(200, b"{}")
+        else:
+            self._reply(404, b"")
+
+    def _authorized(self):
+        return self.headers.get('Cookie') == f"TOKEN={self.server.token}" \
+            and self.headers.get('X-CSRF-Token') == \
+            f"token-{self.server.token}"
+
+    def _reply(self, status, body, headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _start_fake_cloudkey(testcase, bootstrap):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _FakeCloudKeyHandler)
+    server.bootstrap = bootstrap
+    server.requests = []
+    server.connections = 0
+    server.token = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    testcase.addCleanup(server.server_close)
+    testcase.addCleanup(server.shutdown)
+    return server
+
+
 class TestCloudKey(unittest.TestCase):
     def setUp(self):
         self.path = os.path.dirname(os.path.realpath(__file__))
@@ -47,8 +156,8 @@ class TestCloudKey(unittest.TestCase):
     def test_get_cameras(self):
         tmp_bs = _load_boostrap(self.path)
         with patch(
-            'utilities.cloudkey.CloudKey.get_bootstrap',
-            return_value=tmp_bs
+            'utilities.cloudkey.CloudKey.get_camera_list',
+            return_value=tmp_bs['cameras']
         ) as p:  # noqa: F841
             camera_list = self.cloudkey.get_cameras()
         self.assertTrue(
@@ -65,6 +174,116 @@ class TestCloudKey(unittest.TestCase):
         )
 
 
+class TestCloudKeySession(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.dirname(os.path.realpath(__file__))
+        self.config = Config(
+            dotenv=os.path.join(self.path, '.env.testing')
+        )
+        self.server = _start_fake_cloudkey(self, _load_boostrap(self.path))
+        self.config.cloudkey.controller = \
+            f"http://127.0.0.1:{self.server.server_port}"
+        self.cloudkey = CloudKey(config=self.config.cloudkey)
+        self.addCleanup(self.cloudkey.close)
+
+    def test_session_reused(self):
+        for _ in range(3):
+            cameras = self.cloudkey.get_cameras()
+        self.assertEqual(cameras['B4FBE4FBC66F']['name'], "Front Yard")
+        self.cloudkey.get_bootstrap()
+        logins = [x for x in self.server.requests if x[1].endswith('login')]
+        self.assertEqual(len(logins), 1)
+        self.assertEqual(self.server.connections, 1)
+        self.assertIn(
+            ("GET", "/proxy/protect/api/cameras"), self.server.requests
+        )
+
+    def test_reauthenticate_on_401(self):
+        self.cloudkey.get_camera_list()
+        # Expire the session on the controller side
+        self.server.token += 1
+        cameras = self.cloudkey.get_camera_list()
+        self.assertEqual(len(cameras), len(self.server.bootstrap['cameras']))
+        logins = [x for x in self.server.requests if x[1].endswith('login')]
+        self.assertEqual(len(logins), 2)
+
+    def test_close(self):
+        self.cloudkey.get_camera_list()
+        self.cloudkey.close()
+        self.assertEqual(
+            self.server.requests[-1], ("POST", "/api/auth/logout")
+        )
+        self.assertIsNone(self.cloudkey.session)
+
+
+class TestCameraCache(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.dirname(os.path.realpath(__file__))
+        self.config = Config(
+            dotenv=os.path.join(self.path, '.env.testing')
+        )
+        self.server = _start_fake_cloudkey(self, _load_boostrap(self.path))
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.config.cloudkey.controller = \
+            f"http://127.0.0.1:{self.server.server_port}"
+        self.config.cloudkey.cache = os.path.join(
+            self.tmpdir.name, 'cameras.json')
+
+    def _age_cache(self, seconds):
+        with open(self.config.cloudkey.cache) as fh:
+            cached = json.load(fh)
+        cached['fetched'] -= seconds
+        with open(self.config.cloudkey.cache, 'w') as fh:
+            json.dump(cached, fh)
+
+    def test_cache_fresh(self):
+        cameras = CloudKey(config=self.config.cloudkey).get_cameras()
+        self.assertEqual(cameras['B4FBE4FBC66F']['name'], "Front Yard")
+        self.assertTrue(os.path.exists(self.config.cloudkey.cache))
+        fetches = len(self.server.requests)
+        cached = CloudKey(config=self.config.cloudkey).get_cameras()
+        self.assertEqual(cached, cameras)
+        self.assertEqual(len(self.server.requests), fetches)
+
+    def test_cache_stale(self):
+        CloudKey(config=self.config.cloudkey).get_cameras()
+        self._age_cache(self.config.cloudkey.cache_ttl + 1)
+        self.server.bootstrap['cameras'][0]['name'] = "Renamed"
+        cloudkey = CloudKey(config=self.config.cloudkey)
+        cameras = cloudkey.get_cameras()
+        # The stale copy is served straight away
+        self.assertNotIn(
+            "Renamed", [x['name'] for x in cameras.values()]
+        )
+        cloudkey.wait_for_refresh(timeout=10)
+        cameras = CloudKey(config=self.config.cloudkey).get_cameras()
+        self.assertIn(
+            "Renamed", [x['name'] for x in cameras.values()]
+        )
+
+    def test_offline(self):
+        with self.assertRaises(FileNotFoundError):
+            CloudKey(config=self.config.cloudkey, offline=True).get_cameras()
+        CloudKey(config=self.config.cloudkey).get_cameras()
+        self._age_cache(self.config.cloudkey.cache_ttl * 10)
+        fetches = len(self.server.requests)
+        cameras = CloudKey(
+            config=self.config.cloudkey, offline=True).get_cameras()
+        self.assertTrue("B4FBE48C5F9E" in cameras)
+        self.assertEqual(len(self.server.requests), fetches)
+
+    def test_stale_controller_down(self):
+        CloudKey(config=self.config.cloudkey).get_cameras()
+        self._age_cache(self.config.cloudkey.cache_ttl + 1)
+        self.server.shutdown()
+        self.server.server_close()
+        cloudkey = CloudKey(config=self.config.cloudkey)
+        cameras = cloudkey.get_cameras()
+        cloudkey.wait_for_refresh(timeout=30)
+        self.assertTrue("B4FBE48C5F9E" in cameras)
+
+
 class TestRemux(unittest.TestCase):
     def setUp(self):
         self.path = os.path.dirname(os.path.realpath(__file__))
@@ -83,8 +302,8 @@ class TestRemux(unittest.TestCase):
             config=self.config.paths, auto_create_tmp=False)
         tmp_bs = _load_boostrap(self.path)
         with patch(
-            'utilities.cloudkey.CloudKey.get_bootstrap',
-            return_value=tmp_bs
+            'utilities.cloudkey.CloudKey.get_camera_list',
+            return_value=tmp_bs['cameras']
         ) as p:  # noqa: F841
             self.cameras = self.cloudkey.get_cameras()
         self.test_data = _load_testdata(self.path)
@@ -109,9 +328,73 @@ class TestRemux(unittest.TestCase):
             output_file, "Hallway_2021-01-27_18-04-53.mp4"
         )
 
+    def test_mp4_name(self):
+        mac, stamp = parse_mp4_name(
+            "B4FBE48C5F9E_0_rotating_2021-01-27T18.04.53-05.00"
+        )
+        self.assertEqual(mac, "B4FBE48C5F9E")
+        self.assertEqual(stamp.isoformat(), "2021-01-27T18:04:53-05:00")
+        # Odd names still go through dateutil
+        mac, stamp = parse_mp4_name("B4FBE48C5F9E_0_2021-01-27 18.04.53")
+        self.assertEqual(stamp.isoformat(), "2021-01-27T18:04:53")
+
+    def test_mp4_plan(self):
+        plan = self.remux.plan_mp4_files([
+            self.test_data['mp4_file'],
+            "/tmp/000000000001_0_rotating_2021-01-27T18.04.53-05.00.mp4",
+            "/tmp/000000000001_0_rotating_2021-01-27T18.05.53-05.00.mp4"
+        ], self.cameras)
+        self.assertEqual(len(plan['planned']), 1)
+        self.assertEqual(
+            plan['planned'][0]['output']['filename'],
+            "Hallway_2021-01-27_18-04-53.mp4"
+        )
+        self.assertEqual(list(plan['unknown']), ["000000000001"])
+        self.assertEqual(len(plan['unknown']['000000000001']), 2)
+        with self.assertRaises(ValueError):
+            self.remux.parse_mp4(plan['unknown']['000000000001'][0], {})
+
     def test_mp4_move(self):
-        # TODO
-        pass
+        with tempfile.TemporaryDirectory() as tmp:
+            self.remux.config.output = os.path.join(tmp, 'output')
+            mp4_files = []
+            for i in range(3):
+                mp4_file = os.path.join(
+                    tmp, f"B4FBE48C5F9E_0_rotating_"
+                    f"2021-01-27T18.0{i}.53-05.00.mp4"
+                )
+                open(mp4_file, 'w').close()
+                mp4_files.append(mp4_file)
+            os.makedirs(os.path.join(self.remux.config.output, '2021-01-27'))
+            with patch('os.makedirs', wraps=os.makedirs) as makedirs:
+                plan = self.remux.move_mp4_files(mp4_files, self.cameras)
+            # One date/camera folder, created once
+            self.assertEqual(makedirs.call_count, 1)
+            self.assertEqual(len(plan['moved']), 3)
+            for output in plan['moved']:
+                self.assertTrue(os.path.exists(output))
+
+    def test_mp4_catalog(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.remux.config.output = os.path.join(tmp, 'output')
+            self.remux.catalog = SegmentCatalog(os.path.join(tmp, 'c.db'))
+            self.addCleanup(self.remux.catalog.close)
+            mp4_file = os.path.join(
+                tmp, "B4FBE48C5F9E_0_rotating_2021-01-27T18.04.53-05.00.mp4"
+            )
+            with open(mp4_file, 'w') as fh:
+                fh.write('mp4')
+            self.remux.move_mp4_files([mp4_file], self.cameras)
+            out = io.StringIO()
+            rows = self.remux.find_segments(
+                "B4FBE48C5F9E", datetime(2021, 1, 27, 18),
+                datetime(2021, 1, 27, 19), output_format="json", out=out
+            )
+            self.assertEqual(len(rows), 1)
+            self.assertEqual(rows[0]['camera'], "Hallway")
+            self.assertEqual(rows[0]['start'], "2021-01-27 18:04:53")
+            self.assertEqual(rows[0]['size'], 3)
+            self.assertEqual(json.loads(out.getvalue()), rows)
 
     def test_get_ubv_files(self):
         ubv_files = self.remux.get_ubv_files(
@@ -145,6 +428,1468 @@ class TestRemux(unittest.TestCase):
             muxed, 1
         )
 
+    def test_ubv_filecounts(self):
+        rows = self.remux.count_ubv_files(self.cameras)
+        self.assertEqual(
+            [(x['date'], x['files']) for x in rows],
+            [("2021-01-27", 3), ("2021-02-01", 4)]
+        )
+        self.assertEqual(rows[0]['mac'], "FCECDAD84AA9")
+        self.assertEqual((rows[0]['prepared'], rows[0]['muxed']), (2, 1))
+        self.assertEqual(
+            rows[0]['bytes'], sum(
+                os.path.getsize(x['file']) for x in
+                self.remux.get_ubv_files(filter_age=False)[date(2021, 1, 27)]
+            )
+        )
+
+    def test_ubv_filecounts_formats(self):
+        out = io.StringIO()
+        self.remux.get_ubv_filecounts(self.cameras, "json", out=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['totals']['files'], 7)
+        out = io.StringIO()
+        self.remux.get_ubv_filecounts(self.cameras, "csv", out=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(
+            lines[0], "date,mac,camera,files,bytes,prepared,muxed"
+        )
+        self.assertEqual(len(lines), 3)
+        out = io.StringIO()
+        self.remux.get_ubv_filecounts(self.cameras, out=out)
+        self.assertIn("2021-02-01", out.getvalue())
+
+    def test_worker_temp_paths(self):
+        self.remux.temp = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, self.remux.temp)
+        temp_paths = []
+
+        def fake_remux(ubv_file, temp_path, profiler=None):
+            temp_paths.append(temp_path)
+            yield "exit", {
+                "file": ubv_file['file'], "returncode": 0,
+                "outputs": [], "seconds": 0
+            }
+        ubv_files = [
+            {"file": f"{x}.ubv", "prepared": True, "muxed": False}
+            for x in range(4)
+        ]
+        with patch.object(
+            self.remux, '_stream_remux', side_effect=fake_remux
+        ):
+            errors = self.remux.remux_ubv_files(ubv_files, self.cameras)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(set(temp_paths)), 4)
+        for temp_path in temp_paths:
+            self.assertEqual(
+                os.path.dirname(temp_path), self.remux.temp
+            )
+        # Workers clean up after themselves
+        self.assertEqual(os.listdir(self.remux.temp), [])
+
+
+class TestStreamRemux(unittest.TestCase):
+    # A stand-in remux that floods stdout and reports on stderr
+    FAKE_REMUX = "\n".join([
+        "#!/usr/bin/env python3",
+        "import os, sys",
+        "folder = sys.argv[3]",
+        "for i in range(3):",
+        "    name = f'B4FBE48C5F9E_0_rotating_2021-01-27T18.0{i}.53-05.00'",
+        "    path = os.path.join(folder, f'{name}.mp4')",
+        "    sys.stdout.write('x' * 65536 + '\\n')",
+        "    sys.stderr.write(f'Writing MP4 {path}\\n')",
+        "    with open(path, 'wb') as fh:",
+        "        fh.write(bytes.fromhex(os.environ.get('FAKE_MP4', '')))",
+        "sys.exit(int(os.environ.get('FAKE_REMUX_EXIT', '0')))",
+        ""
+    ])
+    FAKE_UBVINFO = "\n".join([
+        "#!/usr/bin/env python3",
+        "import os, sys, time",
+        "time.sleep(float(os.environ.get('FAKE_UBVINFO_SLEEP', '0')))",
+        "print('Type TID KF OFFSET SIZE DTS CTS WC CR')",
+        ""
+    ])
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        bin_path = os.path.join(self.tmpdir.name, 'bin')
+        os.makedirs(bin_path)
+        for name, script in [
+            ('remux', self.FAKE_REMUX), ('ubnt_ubvinfo', self.FAKE_UBVINFO)
+        ]:
+            tool_path = os.path.join(bin_path, name)
+            with open(tool_path, 'w') as fh:
+                fh.write(script)
+            os.chmod(tool_path, 0o755)
+        path = patch.dict(os.environ, {
+            "PATH": os.pathsep.join([bin_path, os.environ['PATH']]),
+            "FAKE_MP4": _mp4_bytes(60).hex()
+        })
+        path.start()
+        self.addCleanup(path.stop)
+        self.ubv_file = {"file": "B4FBE48C5F9E_0_rotating_1.ubv"}
+
+    def test_segments(self):
+        segments = []
+        result = UBVRemux._remux(
+            self.ubv_file, self.tmpdir.name, on_segment=segments.append
+        )
+        self.assertEqual(result['returncode'], 0)
+        self.assertEqual(len(result['outputs']), 3)
+        self.assertEqual(segments, result['outputs'])
+        for segment in segments:
+            self.assertTrue(segment['path'].startswith(self.tmpdir.name))
+            self.assertGreaterEqual(segment['seconds'], 0)
+
+    def test_failed_remux(self):
+        with patch.dict(os.environ, {"FAKE_REMUX_EXIT": "1"}):
+            events = list(
+                UBVRemux._stream_remux(self.ubv_file, self.tmpdir.name)
+            )
+        # The segment being written when remux failed is dropped
+        self.assertEqual(
+            [x[0] for x in events], ["segment", "segment", "exit"]
+        )
+        self.assertEqual(events[-1][1]['returncode'], 1)
+
+    def _remux_setup(self):
+        path = os.path.dirname(os.path.realpath(__file__))
+        config = Config(dotenv=os.path.join(path, '.env.testing'))
+        config.paths.temp = self.tmpdir.name
+        config.paths.output = os.path.join(self.tmpdir.name, 'output')
+        remux = UBVRemux(config=config.paths, jobs=2)
+        self.addCleanup(os.rmdir, remux.temp)
+        with patch(
+            'utilities.cloudkey.CloudKey.get_camera_list',
+            return_value=_load_boostrap(path)['cameras']
+        ):
+            cameras = CloudKey(config=config.cloudkey).get_cameras()
+        ubv_path = os.path.join(self.tmpdir.name, self.ubv_file['file'])
+        open(ubv_path, 'w').close()
+        ubv_file = {"file": ubv_path, "prepared": False, "muxed": False}
+        return remux, cameras, ubv_file
+
+    def _assert_remuxed(self, remux, ubv_file):
+        self.assertTrue(ubv_file['prepared'])
+        self.assertTrue(os.path.exists(f"{ubv_file['file']}.txt"))
+        self.assertTrue(os.path.exists(f"{ubv_file['file']}.muxed"))
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(
+                remux.config.output, '2021-01-27', 'Hallway'
+            ))),
+            [f"Hallway_2021-01-27_18-0{i}-53.mp4" for i in range(3)]
+        )
+        self.assertEqual(os.listdir(remux.temp), [])
+        stages = remux.metrics.summary()['stages']
+        self.assertEqual(
+            {k: v['files'] for k, v in stages.items()},
+            {"prepare": 1, "remux": 1, "move": 3}
+        )
+        self.assertEqual(
+            {x['camera'] for x in remux.metrics.summary()['cameras']},
+            {"Hallway"}
+        )
+
+    def test_pipeline(self):
+        remux, cameras, ubv_file = self._remux_setup()
+        errors = remux.remux_ubv_files([ubv_file], cameras)
+        self.assertEqual(errors, [])
+        self._assert_remuxed(remux, ubv_file)
+        self.assertEqual(remux.report_moves()['rename'], 3)
+        self.assertEqual(
+            remux.metrics.summary()['stages']['move']['media_seconds'], 180
+        )
+
+    def test_iter_results(self):
+        remux, cameras, ubv_file = self._remux_setup()
+        done = {"file": "done.ubv", "prepared": True, "muxed": True}
+        records = list(remux.iter_results(iter([done, ubv_file]), cameras))
+        segments = [x for x in records if isinstance(x, SegmentResult)]
+        files = [x for x in records if isinstance(x, FileResult)]
+        self.assertEqual(len(segments), 3)
+        for segment in segments:
+            self.assertTrue(segment.ok)
+            self.assertEqual(segment.source, ubv_file['file'])
+            self.assertEqual(segment.camera, "Hallway")
+            self.assertEqual(segment.duration, 60)
+        self.assertEqual(
+            [(x.source, x.status) for x in files],
+            [("done.ubv", "skipped"), (ubv_file['file'], "muxed")]
+        )
+        self.assertEqual(
+            sorted(files[1].outputs), sorted(x.output for x in segments)
+        )
+        self.assertEqual(files[1].returncode, 0)
+        # The file result comes after all of its segments
+        self.assertIs(records[-1], files[1])
+        self._assert_remuxed(remux, ubv_file)
+
+    def test_iter_results_stop_early(self):
+        remux, cameras, _ = self._remux_setup()
+        pulled = []
+
+        def _ubv_files():
+            for i in range(20):
+                path = os.path.join(
+                    self.tmpdir.name, f"B4FBE48C5F9E_0_rotating_{i}.ubv"
+                )
+                open(path, 'w').close()
+                pulled.append(path)
+                yield {"file": path, "prepared": False, "muxed": False}
+        results = remux.iter_results(_ubv_files(), cameras)
+        first = next(x for x in results if isinstance(x, FileResult))
+        results.close()
+        self.assertEqual(first.status, "muxed")
+        self.assertLess(len(pulled), 20)
+        # Files already started were finished and cleaned up
+        self.assertEqual(os.listdir(remux.temp), [])
+
+    def test_truncated_segment(self):
+        remux, cameras, ubv_file = self._remux_setup()
+        with patch.dict(os.environ, {"FAKE_MP4": _mp4_bytes(60)[:-10].hex()}):
+            errors = remux.remux_ubv_files([ubv_file], cameras)
+        self.assertEqual(len(errors), 3)
+        self.assertIsInstance(errors[0][2], mp4info.MP4FormatError)
+        self.assertFalse(ubv_file['muxed'])
+        self.assertFalse(os.path.exists(f"{ubv_file['file']}.muxed"))
+        # The incomplete MP4s are dropped along with the temp folders
+        self.assertEqual(os.listdir(remux.temp), [])
+
+    # Writes two MP4s per UBV file and can fail part way through a batch
+    FAKE_BATCH_REMUX = "\n".join([
+        "#!/usr/bin/env python3",
+        "import os, sys",
+        "from datetime import datetime, timedelta, timezone",
+        "folder = sys.argv[3]",
+        "with open(os.environ['FAKE_REMUX_CALLS'], 'a') as fh:",
+        "    fh.write(f'{len(sys.argv) - 4}\\n')",
+        "tz = timezone(timedelta(hours=-5))",
+        "for n, ubv in enumerate(sys.argv[4:]):",
+        "    mac, epoch = ubv.split('/')[-1][:-4].split('_')[::3]",
+        "    for i in range(2):",
+        "        if n == 2 and i == 1 and os.environ.get('FAKE_BATCH_FAIL'):",
+        "            sys.exit(1)",
+        "        stamp = datetime.fromtimestamp(",
+        "            int(epoch) / 1000 + i * 60, tz)",
+        "        name = f'{mac}_0_rotating_' + stamp.strftime(",
+        "            '%Y-%m-%dT%H.%M.%S-05.00')",
+        "        path = os.path.join(folder, f'{name}.mp4')",
+        "        sys.stderr.write(f'Writing MP4 {path}\\n')",
+        "        with open(path, 'wb') as fh:",
+        "            fh.write(bytes.fromhex(os.environ['FAKE_MP4']))",
+        ""
+    ])
+
+    def _batch_setup(self):
+        with open(os.path.join(self.tmpdir.name, 'bin', 'remux'), 'w') as fh:
+            fh.write(self.FAKE_BATCH_REMUX)
+        calls = patch.dict(os.environ, {
+            "FAKE_REMUX_CALLS": os.path.join(self.tmpdir.name, 'calls')
+        })
+        calls.start()
+        self.addCleanup(calls.stop)
+        remux, cameras, _ = self._remux_setup()
+        remux.config.remux_batch_files = 3
+        ubv_files = []
+        for i in range(3):
+            # 2021-01-27 18:00:53 -05:00, ten minutes apart
+            epoch = (1611788453 + i * 600) * 1000
+            ubv_path = os.path.join(
+                self.tmpdir.name, f"B4FBE48C5F9E_0_rotating_{epoch}.ubv"
+            )
+            open(ubv_path, 'w').close()
+            ubv_files.append(
+                {"file": ubv_path, "prepared": True, "muxed": False}
+            )
+        return remux, cameras, ubv_files
+
+    def _assert_batch(self, remux, ubv_files, muxed, calls):
+        self.assertEqual(os.listdir(remux.temp), [])
+        with open(os.path.join(self.tmpdir.name, 'calls')) as fh:
+            self.assertEqual(fh.read().split(), calls)
+        outputs = {
+            x[0][0]['file']: sorted(os.path.basename(y) for y in x[0][1])
+            for x in muxed.call_args_list
+        }
+        self.assertEqual(len(outputs), 3)
+        for i, ubv_file in enumerate(ubv_files):
+            self.assertEqual(outputs[ubv_file['file']], [
+                f"Hallway_2021-01-27_18-{i}{j}-53.mp4" for j in range(2)
+            ])
+
+    def test_batched_pipeline(self):
+        remux, cameras, ubv_files = self._batch_setup()
+        with patch.object(
+            remux, '_set_file_muxed', wraps=remux._set_file_muxed
+        ) as muxed:
+            errors = remux.remux_ubv_files(ubv_files, cameras)
+        self.assertEqual(errors, [])
+        self._assert_batch(remux, ubv_files, muxed, ['3'])
+
+    def test_batched_fallback(self):
+        remux, cameras, ubv_files = self._batch_setup()
+        with patch.object(
+            remux, '_set_file_muxed', wraps=remux._set_file_muxed
+        ) as muxed, patch.dict(os.environ, {"FAKE_BATCH_FAIL": "1"}):
+            errors = remux.remux_ubv_files(ubv_files, cameras)
+        self.assertEqual(errors, [])
+        # The first file finished in the batch. The second may not have, as
+        # its last MP4 can't be told apart from a partial one, so it's
+        # rerun alone along with the third.
+        self._assert_batch(remux, ubv_files, muxed, ['3', '1', '1'])
+
+    def _crashed_run(self, returncode=None):
+        # Leaves what a run killed part way through remuxing would: one
+        # MP4 moved, one finished but still in temp, and one partial
+        old_temp = os.path.join(self.tmpdir.name, 'crashed')
+        worker = os.path.join(old_temp, 'worker')
+        os.makedirs(worker)
+        journal = Journal(os.path.join(
+            self.tmpdir.name, "journal-crashed.jsonl"
+        ))
+        journal.open(old_temp)
+        ubv_path = os.path.join(self.tmpdir.name, self.ubv_file['file'])
+        journal.write("start", ubv_path, temp=worker)
+        output = os.path.join(self.tmpdir.name, 'output', '2021-01-27')
+        segments = []
+        data = _mp4_bytes(60)
+        for i in range(3):
+            segment = os.path.join(
+                worker, f"B4FBE48C5F9E_0_rotating_2021-01-27T18.0{i}.53-05.00"
+                ".mp4"
+            )
+            with open(segment, 'wb') as fh:
+                fh.write(data)
+            segments.append(segment)
+            if i < 2 or returncode is not None:
+                journal.write(
+                    "segment", ubv_path, path=segment, size=len(data)
+                )
+        moved = os.path.join(
+            output, 'Hallway', "Hallway_2021-01-27_18-00-53.mp4"
+        )
+        os.makedirs(os.path.dirname(moved))
+        os.rename(segments[0], moved)
+        journal.write(
+            "moved", ubv_path, path=segments[0], output=moved,
+            size=len(data)
+        )
+        if returncode is not None:
+            journal.write("remuxed", ubv_path, returncode=returncode)
+        journal.close()
+        return old_temp
+
+    def test_resume_after_crash(self):
+        old_temp = self._crashed_run()
+        remux, cameras, ubv_file = self._remux_setup()
+        ubv_file['prepared'] = True
+        with patch.object(
+            remux, '_set_file_muxed', wraps=remux._set_file_muxed
+        ) as muxed:
+            errors = remux.remux_ubv_files([ubv_file], cameras)
+        self.assertEqual(errors, [])
+        self.assertFalse(os.path.exists(old_temp))
+        self.assertEqual(len(muxed.call_args[0][1]), 3)
+        # Remuxed again, but only the MP4 never moved before is moved now
+        self.assertEqual(remux.report_moves()['rename'], 2)
+        self.assertEqual(os.listdir(remux.temp), [])
+        self.assertEqual(
+            len(os.listdir(os.path.join(
+                remux.config.output, '2021-01-27', 'Hallway'
+            ))), 3
+        )
+
+    def test_recover_finished_remux(self):
+        old_temp = self._crashed_run(returncode=0)
+        remux, cameras, ubv_file = self._remux_setup()
+        ubv_file['prepared'] = True
+        with patch.object(remux, '_stream_remux') as stream:
+            errors = remux.remux_ubv_files([ubv_file], cameras)
+        self.assertEqual(errors, [])
+        stream.assert_not_called()
+        self.assertTrue(ubv_file['muxed'])
+        self.assertTrue(os.path.exists(f"{ubv_file['file']}.muxed"))
+        self.assertFalse(os.path.exists(old_temp))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tmpdir.name, "journal-crashed.jsonl")
+        ))
+        self.assertEqual(remux.report_moves()['rename'], 2)
+        # Nothing is left in flight
+        self.assertEqual(remux.journal.replay()[1], {})
+
+    def test_async_engine_resume(self):
+        old_temp = self._crashed_run()
+        remux, cameras, ubv_file = self._remux_setup()
+        ubv_file['prepared'] = True
+        with patch.object(
+            remux.journal, 'write', wraps=remux.journal.write
+        ) as write:
+            results = AsyncRemuxEngine(remux).run([ubv_file], cameras)
+        self.assertEqual(results[0]['returncode'], 0)
+        self.assertTrue(ubv_file['muxed'])
+        self.assertFalse(os.path.exists(old_temp))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tmpdir.name, "journal-crashed.jsonl")
+        ))
+        # Only the MP4 never moved before is moved again
+        self.assertEqual(remux.report_moves()['rename'], 2)
+        self.assertEqual(
+            len(os.listdir(os.path.join(
+                remux.config.output, '2021-01-27', 'Hallway'
+            ))), 3
+        )
+        events = [x[0][0] for x in write.call_args_list]
+        self.assertEqual(
+            [x for x in events if x != "moved"],
+            ["start", "segment", "segment", "segment", "remuxed", "done"]
+        )
+        # One from recovery, then each MP4 of the rerun, moved or kept
+        self.assertEqual(events.count("moved"), 4)
+        self.assertEqual(remux.journal.replay()[1], {})
+
+    def test_concurrent_runs(self):
+        # A second run sharing the staging root leaves the first one's
+        # temp folder and journal alone while it's alive
+        first, cameras, ubv_file = self._remux_setup()
+        first.journal.write("start", "other.ubv", temp=first.temp)
+        partial = os.path.join(first.temp, "partial.mp4")
+        open(partial, 'w').close()
+        second, _, _ = self._remux_setup()
+        self.assertEqual(second.remux_ubv_files([ubv_file], cameras), [])
+        self._assert_remuxed(second, ubv_file)
+        self.assertTrue(os.path.exists(partial))
+        self.assertIn("other.ubv", first.journal.replay()[1])
+        # Once the first run is gone the next one cleans up after it
+        first.journal.close()
+        third, _, _ = self._remux_setup()
+        third.remux_ubv_files([], cameras)
+        self.assertFalse(os.path.exists(first.temp))
+        self.assertFalse(os.path.exists(first.journal.path))
+        # For the cleanup _remux_setup added
+        os.makedirs(first.temp)
+
+    def _watch(self, **kwargs):
+        remux, cameras, _ = self._remux_setup()
+        remux.config.files = os.path.join(self.tmpdir.name, 'ubv')
+        day = os.path.join(remux.config.files, '2021', '01', '27')
+        os.makedirs(day)
+        watcher = UBVWatcher(remux.config.files, quiet=0.2, interval=0.1)
+        stop = threading.Event()
+        groups = []
+        thread = threading.Thread(target=remux.watch, args=(
+            watcher, cameras, stop
+        ), kwargs={"on_group": groups.append, **kwargs})
+        thread.start()
+        ubv_path = os.path.join(day, self.ubv_file['file'])
+        with open(ubv_path, 'w') as fh:
+            fh.write('still syncing')
+        deadline = time.monotonic() + 10
+        while not os.path.exists(f"{ubv_path}.muxed") and \
+                time.monotonic() < deadline:
+            time.sleep(0.05)
+        stop.set()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([[x['file'] for x in g] for g in groups], [
+            [ubv_path]
+        ])
+        self.assertEqual(remux.report_moves()['rename'], 3)
+        self.assertEqual(os.listdir(remux.temp), [])
+
+    def test_watch(self):
+        self._watch()
+
+    def test_watch_cloudkey_down(self):
+        # The cameras already known are kept rather than stopping
+        def get_cameras():
+            raise ConnectionError("CloudKey unreachable")
+        self._watch(get_cameras=get_cameras)
+
+    def test_leased_pipeline(self):
+        remux, cameras, ubv_file = self._remux_setup()
+        remux.config.files = self.tmpdir.name
+        lease_dir = os.path.join(self.tmpdir.name, 'leases')
+        remux.leases = LeaseManager(lease_dir, ttl=30, owner="this")
+        other = LeaseManager(lease_dir, ttl=30, owner="other")
+        self.addCleanup(other.close)
+        self.addCleanup(remux.leases.close)
+        name = os.path.basename(ubv_file['file'])
+        self.assertTrue(other.claim(name))
+        self.assertEqual(remux.remux_ubv_files([ubv_file], cameras), [])
+        self.assertFalse(ubv_file['prepared'] or ubv_file['muxed'])
+        other.release(name)
+        self.assertEqual(remux.remux_ubv_files([ubv_file], cameras), [])
+        self._assert_remuxed(remux, ubv_file)
+        self.assertEqual(os.listdir(lease_dir), [])
+
+    def _lose_lease(self, remux, ubv_file, moves):
+        # Another host takes the file over once moves MP4s were moved
+        remux.config.files = self.tmpdir.name
+        lease_dir = os.path.join(self.tmpdir.name, 'leases')
+        remux.leases = LeaseManager(lease_dir, ttl=30, owner="this")
+        self.addCleanup(remux.leases.close)
+        name = os.path.basename(ubv_file['file'])
+        claim = remux.claim
+        move_mp4 = remux.move_mp4
+        moved = []
+
+        def claim_then_lose(ubv_file):
+            claimed = claim(ubv_file)
+            if not moves:
+                remux.leases._lost.add(name)
+            return claimed
+
+        def move_then_lose(mp4dict):
+            moved.append(move_mp4(mp4dict))
+            if len(moved) == moves:
+                remux.leases._lost.add(name)
+            return moved[-1]
+        remux.claim = claim_then_lose
+        remux.move_mp4 = move_then_lose
+
+    def _assert_not_muxed(self, remux, ubv_file, moves):
+        self.assertFalse(ubv_file['muxed'])
+        self.assertFalse(os.path.exists(f"{ubv_file['file']}.muxed"))
+        output = os.path.join(remux.config.output, '2021-01-27', 'Hallway')
+        self.assertEqual(
+            len(os.listdir(output)) if os.path.isdir(output) else 0, moves
+        )
+        self.assertEqual(os.listdir(remux.temp), [])
+
+    def test_lost_lease_pipeline(self):
+        remux, cameras, ubv_file = self._remux_setup()
+        self._lose_lease(remux, ubv_file, 0)
+        errors = remux.remux_ubv_files([ubv_file], cameras)
+        self.assertEqual([type(x[2]) for x in errors], [LeaseLost] * 3)
+        self._assert_not_muxed(remux, ubv_file, 0)
+
+    def test_lost_lease_before_marking(self):
+        remux, cameras, ubv_file = self._remux_setup()
+        self._lose_lease(remux, ubv_file, 3)
+        self.assertEqual(remux.remux_ubv_files([ubv_file], cameras), [])
+        self._assert_not_muxed(remux, ubv_file, 3)
+
+    def test_lost_lease_engine(self):
+        for moves in (0, 3):
+            remux, cameras, ubv_file = self._remux_setup()
+            self._lose_lease(remux, ubv_file, moves)
+            AsyncRemuxEngine(remux).run([ubv_file], cameras)
+            self._assert_not_muxed(remux, ubv_file, moves)
+
+    def test_profiled_pipeline(self):
+        remux, cameras, ubv_file = self._remux_setup()
+        report_path = os.path.join(self.tmpdir.name, 'profile')
+        profiler = remux.enable_profiling(report_path)
+        errors = remux.remux_ubv_files([ubv_file], cameras)
+        self.assertEqual(errors, [])
+        self._assert_remuxed(remux, ubv_file)
+        report = profiler.write_report()
+        self.assertEqual(
+            {k: v['processes'] for k, v in report['tools'].items()},
+            {"ubnt_ubvinfo": 1, "remux": 1}
+        )
+        self.assertGreater(report['tools']['remux']['max_rss_kb'], 0)
+        self.assertIn('move_mp4.pstats', os.listdir(report_path))
+
+    def test_async_engine(self):
+        remux, cameras, ubv_file = self._remux_setup()
+        results = AsyncRemuxEngine(remux).run([ubv_file], cameras)
+        self.assertEqual(results[0]['returncode'], 0)
+        self.assertEqual(len(results[0]['outputs']), 3)
+        self._assert_remuxed(remux, ubv_file)
+
+    def test_async_engine_timeout(self):
+        remux, cameras, ubv_file = self._remux_setup()
+        engine = AsyncRemuxEngine(remux, prepare_timeout=0.5)
+        start = time.monotonic()
+        with patch.dict(os.environ, {"FAKE_UBVINFO_SLEEP": "30"}):
+            results = engine.run([ubv_file], cameras)
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertIsInstance(results[0]['error'], ToolTimeout)
+        self.assertFalse(ubv_file['muxed'])
+        # The partial ubnt_ubvinfo output is not left behind
+        self.assertEqual(os.listdir(remux.temp), [])
+
+
+class TestStateStore(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.dirname(os.path.realpath(__file__))
+        self.config = Config(
+            dotenv=os.path.join(self.path, '.env.testing')
+        )
+        self.config.paths.files = os.path.join(
+            self.path, self.config.paths.files)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.config.paths.state_db = os.path.join(
+            self.tmpdir.name, 'state.db')
+        self.remux = UBVRemux(
+            config=self.config.paths, auto_create_tmp=False)
+        self.addCleanup(self.remux.state.close)
+
+    def test_import_sentinels(self):
+        count = self.remux.state.import_sentinels(self.config.paths.files)
+        self.assertEqual(count, 7)
+        ubv = os.path.join(
+            self.config.paths.files, '2021', '01', '27',
+            'FCECDAD84AA9_0_rotating_1611764494329.ubv'
+        )
+        row = self.remux.state.get(ubv)
+        self.assertTrue(row['prepared'])
+        self.assertTrue(row['muxed'])
+
+    def test_state_overrides_sentinels(self):
+        ubv_files = self.remux.get_ubv_files(filter_age=False)
+        ubv_file = next(
+            x for x in ubv_files[date(2021, 1, 27)] if not x['muxed']
+        )
+        self.remux._set_file_muxed(ubv_file, ['/out/a.mp4'], 1.5)
+        # No sentinel is written when the state store is in use
+        self.assertFalse(os.path.exists(f"{ubv_file['file']}.muxed"))
+        ubv_files = self.remux.get_ubv_files(filter_age=False)
+        muxed = len([
+            x for x in ubv_files[date(2021, 1, 27)] if x['muxed']
+        ])
+        self.assertEqual(muxed, 2)
+        row = self.remux.state.get(ubv_file['file'])
+        self.assertEqual(row['outputs'], ['/out/a.mp4'])
+        self.assertEqual(row['move_seconds'], 1.5)
+
+    def test_changed_file_rescanned(self):
+        store = StateStore(os.path.join(self.tmpdir.name, 'other.db'))
+        self.addCleanup(store.close)
+        store.record_file('/a.ubv', 10, 100, True, True)
+        self.assertIsNotNone(store.lookup('/a.ubv', 10, 100))
+        self.assertIsNone(store.lookup('/a.ubv', 11, 100))
+        self.assertIsNone(store.lookup('/a.ubv', 10, 101))
+
+
+class TestInventory(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.root = os.path.join(self.tmpdir.name, 'ubv')
+        for day in ['2021/01/27', '2021/02/01']:
+            os.makedirs(os.path.join(self.root, day))
+            self._touch(day, 'AABBCCDDEEFF_0_rotating_1.ubv')
+
+    def _touch(self, day, name):
+        path = os.path.join(self.root, day, name)
+        open(path, 'w').close()
+        return path
+
+    def test_refresh(self):
+        inventory = UBVInventory(self.root)
+        files = inventory.refresh()
+        self.assertEqual(
+            sorted(files.keys()), [date(2021, 1, 27), date(2021, 2, 1)]
+        )
+        self._touch('2021/01/27', 'AABBCCDDEEFF_0_rotating_1.ubv.muxed')
+        with patch.object(
+            inventory, '_scan_day', wraps=inventory._scan_day
+        ) as scan:
+            files = inventory.refresh()
+        # Only the day that changed is listed again
+        self.assertEqual(scan.call_count, 1)
+        self.assertTrue(files[date(2021, 1, 27)][0]['muxed'])
+
+    def test_refresh_date(self):
+        inventory = UBVInventory(self.root)
+        files = inventory.refresh_date(date(2021, 2, 1))
+        self.assertEqual(len(files), 1)
+        self.assertIsNone(inventory.refresh_date(date(2021, 3, 1)))
+
+    def test_persisted_between_runs(self):
+        store = StateStore(os.path.join(self.tmpdir.name, 'state.db'))
+        self.addCleanup(store.close)
+        UBVInventory(self.root, state=store).refresh()
+        inventory = UBVInventory(self.root, state=store)
+        with patch.object(inventory, '_load', wraps=inventory._load) as load:
+            files = inventory.refresh()
+        # Files are statted, but none are loaded again
+        self.assertEqual(load.call_count, 0)
+        self.assertEqual(len(files[date(2021, 1, 27)]), 1)
+
+
+class TestFingerprint(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.root = os.path.join(self.tmpdir.name, 'ubv')
+        os.makedirs(os.path.join(self.root, '2021/01/27'))
+        self.ubv = os.path.join(
+            self.root, '2021/01/27', 'AABBCCDDEEFF_0_rotating_1.ubv')
+        with open(self.ubv, 'wb') as fh:
+            fh.write(bytes(range(256)) * 1024)
+
+    def _rewrite(self, offset=None):
+        # Bumps the mtime, changing one byte if offset is given
+        if offset is not None:
+            with open(self.ubv, 'r+b') as fh:
+                fh.seek(offset)
+                fh.write(b'\xff')
+        st = os.stat(self.ubv)
+        os.utime(self.ubv, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    def test_sample_ranges(self):
+        self.assertEqual(fingerprint.sample_ranges(100, 10, 16), [(0, 100)])
+        ranges = fingerprint.sample_ranges(1000, 10, 4)
+        self.assertEqual(len(ranges), 6)
+        self.assertEqual(ranges[0], (0, 10))
+        self.assertEqual(ranges[-1], (990, 10))
+
+    def test_sampled_blocks_only(self):
+        before = fingerprint.fingerprint(self.ubv, block=1024, samples=4)
+        # A byte between the samples isn't read
+        self._rewrite(offset=100000)
+        self.assertEqual(
+            fingerprint.fingerprint(self.ubv, block=1024, samples=4), before
+        )
+        self._rewrite(offset=0)
+        self.assertNotEqual(
+            fingerprint.fingerprint(self.ubv, block=1024, samples=4), before
+        )
+
+    def test_sentinel(self):
+        fingerprint.write_sentinel(
+            f"{self.ubv}.muxed", fingerprint.fingerprint_record(self.ubv))
+        self._rewrite()
+        inventory = UBVInventory(self.root)
+        ubv_file = inventory.refresh()[date(2021, 1, 27)][0]
+        self.assertTrue(ubv_file['muxed'])
+        self.assertEqual(
+            inventory.fingerprint_stats, {"unchanged": 1, "changed": 0})
+        # The sentinel now matches the rewritten file
+        record = fingerprint.read_sentinel(f"{self.ubv}.muxed")
+        self.assertEqual(record['mtime_ns'], os.stat(self.ubv).st_mtime_ns)
+        self._rewrite(offset=0)
+        inventory = UBVInventory(self.root)
+        ubv_file = inventory.refresh()[date(2021, 1, 27)][0]
+        self.assertFalse(ubv_file['muxed'])
+        self.assertEqual(
+            inventory.fingerprint_stats, {"unchanged": 0, "changed": 1})
+        self.assertFalse(os.path.exists(f"{self.ubv}.muxed"))
+
+    def test_empty_sentinel_trusted(self):
+        open(f"{self.ubv}.muxed", 'w').close()
+        self._rewrite(offset=0)
+        ubv_file = UBVInventory(self.root).entry(self.ubv)
+        self.assertTrue(ubv_file['muxed'])
+
+    def test_state_store(self):
+        store = StateStore(os.path.join(self.tmpdir.name, 'state.db'))
+        self.addCleanup(store.close)
+        inventory = UBVInventory(self.root, state=store)
+        self.assertFalse(inventory.entry(self.ubv)['muxed'])
+        store.set_muxed(
+            self.ubv, record=fingerprint.fingerprint_record(self.ubv))
+        self._rewrite()
+        self.assertTrue(inventory.entry(self.ubv)['muxed'])
+        row = store.get(self.ubv)
+        self.assertEqual(row['mtime_ns'], os.stat(self.ubv).st_mtime_ns)
+        self.assertIsNotNone(row['fingerprint'])
+        self._rewrite(offset=1)
+        self.assertFalse(inventory.entry(self.ubv)['muxed'])
+        self.assertFalse(store.get(self.ubv)['muxed'])
+        self.assertEqual(
+            inventory.fingerprint_stats, {"unchanged": 1, "changed": 1})
+
+    def test_state_store_refresh(self):
+        # A file rewritten in place leaves its folder's mtime alone, so a
+        # new run's refresh has to notice it from the file itself
+        store = StateStore(os.path.join(self.tmpdir.name, 'state.db'))
+        self.addCleanup(store.close)
+        UBVInventory(self.root, state=store).refresh()
+        store.set_muxed(
+            self.ubv, record=fingerprint.fingerprint_record(self.ubv))
+        folder = os.path.dirname(self.ubv)
+        folder_mtime_ns = os.stat(folder).st_mtime_ns
+        self._rewrite()
+        inventory = UBVInventory(self.root, state=store)
+        ubv_file = inventory.refresh()[date(2021, 1, 27)][0]
+        self.assertTrue(ubv_file['muxed'])
+        self.assertEqual(
+            inventory.fingerprint_stats, {"unchanged": 1, "changed": 0})
+        self._rewrite(offset=1)
+        self.assertEqual(os.stat(folder).st_mtime_ns, folder_mtime_ns)
+        inventory = UBVInventory(self.root, state=store)
+        ubv_file = inventory.refresh()[date(2021, 1, 27)][0]
+        self.assertFalse(ubv_file['muxed'])
+        self.assertEqual(
+            inventory.fingerprint_stats, {"unchanged": 0, "changed": 1})
+        self.assertFalse(store.get(self.ubv)['muxed'])
+
+    def test_state_store_migrated(self):
+        path = os.path.join(self.tmpdir.name, 'old.db')
+        conn = sqlite3.connect(path)
+        conn.execute(
+            "CREATE TABLE ubv_files (path TEXT PRIMARY KEY, "
+            "size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+            "prepared INTEGER NOT NULL DEFAULT 0, "
+            "muxed INTEGER NOT NULL DEFAULT 0, "
+            "moved INTEGER NOT NULL DEFAULT 0, outputs TEXT, "
+            "prepare_seconds REAL, remux_seconds REAL, "
+            "move_seconds REAL, updated REAL)"
+        )
+        conn.close()
+        store = StateStore(path)
+        self.addCleanup(store.close)
+        store.record_file('/a.ubv', 10, 100, True, True, fingerprint='10:x')
+        self.assertEqual(store.get('/a.ubv')['fingerprint'], '10:x')
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.catalog = SegmentCatalog(
+            os.path.join(self.tmpdir.name, 'catalog.db'))
+        self.addCleanup(self.catalog.close)
+
+    def _find(self, start, end, camera="Driveway"):
+        return [
+            x['start'][11:] for x in self.catalog.find(
+                camera, datetime(2021, 3, 14, *start),
+                datetime(2021, 3, 14, *end)
+            )
+        ]
+
+    def test_find(self):
+        self.catalog.add_many([
+            ('/o/a.mp4', 'Driveway', '2021-03-14 02:00:00', 'AABBCCDDEEFF',
+             10, 900),
+            ('/o/b.mp4', 'Driveway', '2021-03-14 02:15:00', 'AABBCCDDEEFF',
+             10, 900),
+            ('/o/c.mp4', 'Driveway', '2021-03-14 02:30:00', 'AABBCCDDEEFF',
+             10, None),
+            ('/o/d.mp4', 'Hallway', '2021-03-14 02:20:00', None, 10, None),
+        ])
+        # 02:00 runs until 02:15, so only the later segments overlap
+        self.assertEqual(self._find((2, 20), (2, 40)),
+                         ['02:15:00', '02:30:00'])
+        self.assertEqual(self._find((2, 10), (2, 20)),
+                         ['02:00:00', '02:15:00'])
+        self.assertEqual(self._find((2, 10), (2, 20), 'aabbccddeeff'),
+                         ['02:00:00', '02:15:00'])
+        # Without a duration the last segment may still be running
+        self.assertEqual(self._find((3, 0), (4, 0)), ['02:30:00'])
+        self.assertEqual(self._find((1, 0), (2, 0)), [])
+
+    def test_rebuild(self):
+        root = os.path.join(self.tmpdir.name, 'output')
+        for folder, name in [
+            ('2021-03-14/Driveway', 'Driveway_2021-03-14_02-00-00.mp4'),
+            ('2021-03-14/Front Door', 'Front Door_2021-03-14_02-05-00.mp4'),
+            ('.staging/tmp1', 'Driveway_2021-03-14_02-10-00.mp4'),
+            ('2021-03-14/Driveway', 'notes.txt'),
+        ]:
+            os.makedirs(os.path.join(root, folder), exist_ok=True)
+            open(os.path.join(root, folder, name), 'w').close()
+        self.catalog.add(
+            os.path.join(root, 'gone.mp4'), 'Driveway', '2021-03-14 01:00:00'
+        )
+        count = self.catalog.rebuild(root, cameras={
+            'AABBCCDDEEFF': {'name': 'Driveway'}
+        })
+        self.assertEqual(count, 2)
+        self.assertEqual(self._find((0, 0), (3, 0)), ['02:00:00'])
+        self.assertEqual(self._find((0, 0), (3, 0), 'AABBCCDDEEFF'),
+                         ['02:00:00'])
+        self.assertEqual(self._find((0, 0), (3, 0), 'Front Door'),
+                         ['02:05:00'])
+
+
+class TestMP4Info(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, 'test.mp4')
+
+    def _write(self, data):
+        with open(self.path, 'wb') as fh:
+            fh.write(data)
+
+    def test_complete(self):
+        self._write(_mp4_bytes(90, timescale=90000))
+        info = mp4info.read_mp4(self.path)
+        self.assertEqual(info['brand'], 'isom')
+        self.assertEqual(info['boxes'], ['ftyp', 'moov', 'mdat'])
+        self.assertEqual(info['duration'], 90)
+
+    def test_incomplete(self):
+        data = _mp4_bytes(60)
+        for bad in (
+            b'', data[:-1], data + b'\x00' * 4,
+            # Killed before the moov was written
+            _box(b'ftyp', b'isom') + _box(b'mdat', b'\x00' * 8),
+            _box(b'mdat', b'\x00' * 8) + data,
+        ):
+            self._write(bad)
+            with self.assertRaises(mp4info.MP4FormatError):
+                mp4info.read_mp4(self.path)
+
+    def test_large_and_open_ended_boxes(self):
+        # A 64 bit mdat size, and a last mdat running to the end of file
+        data = _mp4_bytes(60, mdat=b'')[:-8]
+        self._write(
+            data + struct.pack('>I4sQ', 1, b'mdat', 16 + 4) + b'\x00' * 4 +
+            struct.pack('>I4s', 0, b'mdat') + b'\x00' * 100
+        )
+        info = mp4info.read_mp4(self.path)
+        self.assertEqual(info['boxes'], ['ftyp', 'moov', 'mdat', 'mdat'])
+
+    def test_fragmented(self):
+        mvhd = struct.pack('>B3xIIII', 0, 0, 0, 1000, 0) + b'\x00' * 80
+        mehd = struct.pack('>B3xQ', 1, 30000)
+        self._write(
+            _box(b'ftyp', b'iso5') +
+            _box(b'moov', _box(b'mvhd', mvhd) +
+                 _box(b'mvex', _box(b'mehd', mehd))) +
+            _box(b'moof') + _box(b'mdat', b'\x00' * 8)
+        )
+        self.assertEqual(mp4info.read_mp4(self.path)['duration'], 30)
+
+
+class TestTransfer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.source = os.path.join(self.tmpdir.name, 'source.mp4')
+        self.data = os.urandom(300000)
+        with open(self.source, 'wb') as fh:
+            fh.write(self.data)
+        self.destination = os.path.join(self.tmpdir.name, 'dest.mp4')
+
+    def _assert_moved(self):
+        self.assertFalse(os.path.exists(self.source))
+        with open(self.destination, 'rb') as fh:
+            self.assertEqual(fh.read(), self.data)
+        self.assertEqual(os.listdir(self.tmpdir.name), ['dest.mp4'])
+
+    def test_rename(self):
+        kind = transfer.move_file(self.source, self.destination)
+        self.assertEqual(kind, "rename")
+        self._assert_moved()
+
+    def test_cross_device_copy(self):
+        with patch(
+            'os.rename', side_effect=OSError(errno.EXDEV, "cross-device")
+        ):
+            kind = transfer.move_file(
+                self.source, self.destination, verify=True
+            )
+        self.assertEqual(kind, "copy")
+        self._assert_moved()
+
+    def test_copy_fallbacks(self):
+        unsupported = OSError(errno.EXDEV, "cross-device")
+        with patch('os.copy_file_range', side_effect=unsupported), \
+                patch('os.sendfile', side_effect=unsupported):
+            transfer.copy_file(self.source, self.destination)
+        with open(self.destination, 'rb') as fh:
+            self.assertEqual(fh.read(), self.data)
+
+    def test_short_fast_copy(self):
+        # A fast path that stops early falls back to a plain copy
+        with patch('os.copy_file_range', return_value=0), \
+                patch('os.sendfile', side_effect=[4096, 0]):
+            copied = transfer.copy_file(self.source, self.destination)
+        self.assertEqual(copied, len(self.data))
+        with open(self.destination, 'rb') as fh:
+            self.assertEqual(fh.read(), self.data)
+
+    def test_short_copy(self):
+        with patch(
+            'os.rename', side_effect=OSError(errno.EXDEV, "cross-device")
+        ), patch('utilities.transfer.copy_file', return_value=4096):
+            with self.assertRaises(IOError):
+                transfer.move_file(self.source, self.destination)
+        # The source is kept and no partial copy is left
+        self.assertEqual(os.listdir(self.tmpdir.name), ['source.mp4'])
+
+    def test_verify_failure(self):
+        with patch(
+            'os.rename', side_effect=OSError(errno.EXDEV, "cross-device")
+        ), patch(
+            'utilities.transfer.file_digest', side_effect=['a', 'b']
+        ):
+            with self.assertRaises(IOError):
+                transfer.move_file(
+                    self.source, self.destination, verify=True
+                )
+        # The source is kept and no partial copy is left
+        self.assertEqual(os.listdir(self.tmpdir.name), ['source.mp4'])
+
+    def test_staging_root(self):
+        path = os.path.dirname(os.path.realpath(__file__))
+        config = Config(dotenv=os.path.join(path, '.env.testing'))
+        config.paths.temp = self.tmpdir.name
+        config.paths.output = os.path.join(self.tmpdir.name, 'output')
+        config.paths.stage_on_output = True
+        with patch(
+            'utilities.processing.same_filesystem', return_value=False
+        ):
+            remux = UBVRemux(config=config.paths)
+        self.assertEqual(
+            os.path.dirname(remux.temp),
+            os.path.join(config.paths.output, '.staging')
+        )
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.record(
+            "remux", 2.0, mac="B4FBE48C5F9E", camera="Hallway",
+            bytes_in=1000, bytes_out=900
+        )
+        self.metrics.record(
+            "remux", 400, mac="B4FBE48C5F9E", camera="Hallway",
+            bytes_in=1000, failed=True
+        )
+        self.metrics.record("move", 0.2, mac="B4FBE4FBC66F", bytes_in=10)
+
+    def test_summary(self):
+        summary = self.metrics.summary()
+        remux = summary['stages']['remux']
+        self.assertEqual(remux['files'], 2)
+        self.assertEqual(remux['failures'], 1)
+        self.assertEqual(remux['bytes_in'], 2000)
+        self.assertEqual(remux['bytes_out'], 900)
+        self.assertGreater(remux['files_per_second'], 0)
+        self.assertEqual(len(summary['cameras']), 2)
+
+    def test_prometheus(self):
+        text = self.metrics.to_prometheus()
+        labels = 'stage="remux",mac="B4FBE48C5F9E",camera="Hallway"'
+        self.assertIn(
+            f"unifi_protect_extract_stage_files_total{{{labels}}} 2", text
+        )
+        self.assertIn(
+            f"unifi_protect_extract_stage_failures_total{{{labels}}} 1",
+            text
+        )
+        self.assertIn(
+            f'unifi_protect_extract_stage_seconds_bucket{{{labels},le="5"}} 1',
+            text
+        )
+        self.assertIn(
+            f'unifi_protect_extract_stage_seconds_bucket{{{labels},'
+            f'le="+Inf"}} 2', text
+        )
+        self.assertIn('camera="unknown"', text)
+
+    def test_write(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            textfile = os.path.join(tmp, 'remux.prom')
+            summary = os.path.join(tmp, 'summary.json')
+            self.metrics.write_textfile(textfile)
+            self.metrics.write_summary(summary)
+            self.assertEqual(
+                sorted(os.listdir(tmp)), ['remux.prom', 'summary.json']
+            )
+            with open(summary) as fh:
+                self.assertEqual(json.load(fh)['stages']['move']['files'], 1)
+
+
+class TestProfiler(unittest.TestCase):
+    def test_wait(self):
+        profiler = Profiler(output_dir=None)
+        p = subprocess.Popen([sys.executable, '-c', 'import sys; sys.exit(3)'])
+        self.assertEqual(profiler.wait(p, "python", "exit", 0), 3)
+        self.assertEqual(p.returncode, 3)
+        self.assertEqual(profiler.children[0]['returncode'], 3)
+        self.assertGreater(profiler.children[0]['max_rss_kb'], 0)
+
+    def test_nested_stages(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            profiler = Profiler(output_dir=tmp)
+
+            def inner():
+                return sum(range(1000))
+
+            def outer():
+                return profiler.call("inner", inner) + 1
+            self.assertEqual(profiler.call("outer", outer), 499501)
+            profiler.write_report()
+            self.assertEqual(
+                sorted(os.listdir(tmp)),
+                ['children.json', 'inner.pstats', 'outer.pstats']
+            )
+            # The inner stage's work is not counted against the outer one
+            outer_stats = pstats.Stats(os.path.join(tmp, 'outer.pstats'))
+            self.assertNotIn(
+                'inner', [x[2] for x in outer_stats.stats]
+            )
+
+    def test_concurrent_stages(self):
+        # As on Python 3.12+, where only one profiler can be active
+        active = []
+
+        class ExclusiveProfile(cProfile.Profile):
+            def enable(self):
+                if active:
+                    raise ValueError("Another profiling tool is active")
+                active.append(self)
+                super().enable()
+
+            def disable(self):
+                super().disable()
+                if self in active:
+                    active.remove(self)
+        barrier = threading.Barrier(2)
+        results = []
+
+        def parse():
+            barrier.wait(5)
+            return sum(range(1000))
+
+        def worker():
+            results.append(profiler.call("parse_mp4", parse))
+        with tempfile.TemporaryDirectory() as tmp, patch(
+            'utilities.profiling.cProfile.Profile', ExclusiveProfile
+        ):
+            profiler = Profiler(output_dir=tmp)
+            threads = [threading.Thread(target=worker) for _ in range(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join(10)
+            profiler.write_report()
+            self.assertEqual(results, [499500, 499500])
+            self.assertEqual(profiler.unprofiled, {"parse_mp4": 1})
+            self.assertIn('parse_mp4.pstats', os.listdir(tmp))
+
+
+def _lease_worker(lease_dir, done_dir, names, seed, out):
+    # Works through names like a host would, recording what it handled
+    leases = LeaseManager(lease_dir, ttl=30)
+    random.Random(seed).shuffle(names)
+    handled = []
+    for name in names:
+        if not leases.claim(name):
+            continue
+        done = os.path.join(done_dir, name)
+        if not os.path.exists(done):
+            time.sleep(0.002)
+            open(done, 'w').close()
+            handled.append(name)
+        leases.release(name)
+    leases.close()
+    with open(out, 'w') as fh:
+        json.dump(handled, fh)
+
+
+def _lease_and_exit(lease_dir, name):
+    # A host that dies while holding a lease
+    LeaseManager(lease_dir, ttl=0.5).claim(name)
+    os._exit(0)
+
+
+class TestLeases(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.lease_dir = os.path.join(self.tmpdir.name, 'leases')
+
+    def test_processes_split_work(self):
+        done_dir = os.path.join(self.tmpdir.name, 'done')
+        os.makedirs(done_dir)
+        names = [f"{x:02d}.ubv" for x in range(60)]
+        workers = []
+        for n in range(4):
+            out = os.path.join(self.tmpdir.name, f"worker{n}.json")
+            p = multiprocessing.Process(
+                target=_lease_worker,
+                args=(self.lease_dir, done_dir, list(names), n, out)
+            )
+            p.start()
+            workers.append((p, out))
+        handled = []
+        for p, out in workers:
+            p.join(30)
+            self.assertEqual(p.exitcode, 0)
+            with open(out) as fh:
+                handled.extend(json.load(fh))
+        # Every file handled exactly once
+        self.assertEqual(sorted(handled), sorted(names))
+        self.assertEqual(os.listdir(self.lease_dir), [])
+
+    def test_expired_lease(self):
+        p = multiprocessing.Process(
+            target=_lease_and_exit, args=(self.lease_dir, "a.ubv")
+        )
+        p.start()
+        p.join(30)
+        leases = LeaseManager(self.lease_dir, ttl=30)
+        self.addCleanup(leases.close)
+        self.assertFalse(leases.claim("a.ubv"))
+        time.sleep(0.6)
+        self.assertTrue(leases.claim("a.ubv"))
+        self.assertTrue(leases.held("a.ubv"))
+
+    def test_heartbeat(self):
+        holder = LeaseManager(self.lease_dir, ttl=0.3, owner="holder")
+        other = LeaseManager(self.lease_dir, ttl=0.3, owner="other")
+        self.addCleanup(other.close)
+        self.assertTrue(holder.claim("a.ubv"))
+        time.sleep(0.7)
+        self.assertFalse(other.claim("a.ubv"))
+        holder.close()
+        self.assertTrue(other.claim("a.ubv"))
+
+    def test_lost_lease(self):
+        leases = LeaseManager(self.lease_dir, ttl=30)
+        self.addCleanup(leases.close)
+        self.assertTrue(leases.claim("a.ubv"))
+        lease_path = leases._lease_path("a.ubv")
+        with open(lease_path) as fh:
+            record = json.load(fh)
+        with open(lease_path, 'w') as fh:
+            json.dump(dict(record, token="someone else"), fh)
+        leases.renew()
+        self.assertFalse(leases.held("a.ubv"))
+        # The new holder's lease is left alone
+        leases.release("a.ubv")
+        self.assertTrue(os.path.exists(lease_path))
+
+    def test_empty_lease_expires(self):
+        # Left by a host that died between creating and writing it
+        leases = LeaseManager(self.lease_dir, ttl=1)
+        self.addCleanup(leases.close)
+        lease_path = leases._lease_path("a.ubv")
+        open(lease_path, 'w').close()
+        self.assertFalse(leases.claim("a.ubv"))
+        past = time.time() - 2
+        os.utime(lease_path, (past, past))
+        self.assertTrue(leases.claim("a.ubv"))
+        self.assertTrue(leases.held("a.ubv"))
+
+    def test_renew_race(self):
+        # Another host takes the lease over while it's being renewed
+        holder = LeaseManager(self.lease_dir, ttl=30, owner="holder")
+        other = LeaseManager(self.lease_dir, ttl=30, owner="other")
+        self.addCleanup(holder.close)
+        self.addCleanup(other.close)
+        self.assertTrue(holder.claim("a.ubv"))
+        read = holder._read
+
+        def read_then_take_over(path):
+            record = read(path)
+            self.assertTrue(other.claim("a.ubv"))
+            return record
+        with patch.object(holder, '_read', read_then_take_over):
+            holder.renew()
+        self.assertFalse(holder.held("a.ubv"))
+        self.assertTrue(other.held("a.ubv"))
+        with open(other._lease_path("a.ubv")) as fh:
+            self.assertEqual(json.load(fh)['owner'], "other")
+        self.assertEqual(len(os.listdir(self.lease_dir)), 1)
+
+
+class TestDiskAdmission(unittest.TestCase):
+    def setUp(self):
+        # A 1000 byte filesystem with 100 bytes used
+        self.statvfs = patch('os.statvfs', return_value=os.statvfs_result(
+            (1, 1, 1000, 900, 900, 0, 0, 0, 0, 255)
+        ))
+        self.statvfs.start()
+        self.addCleanup(self.statvfs.stop)
+        self.admission = DiskAdmission(
+            [tempfile.gettempdir()], watermark=0.9, expansion=1.0, poll=0.05
+        )
+
+    def test_waits_for_space(self):
+        self.admission.admit("a", 500)
+        admitted = threading.Event()
+
+        def second():
+            self.admission.admit("b", 500)
+            admitted.set()
+        thread = threading.Thread(target=second)
+        thread.start()
+        self.assertFalse(admitted.wait(0.3))
+        self.admission.release("a")
+        self.assertTrue(admitted.wait(5))
+        thread.join()
+
+    def test_consumed(self):
+        self.admission.admit("a", 500)
+        self.assertIsNotNone(self.admission.try_admit("b", 500))
+        # Written MP4s already show up as used space
+        self.admission.consumed("a", 300)
+        self.assertIsNone(self.admission.try_admit("b", 500))
+
+    def test_too_large(self):
+        with self.assertLogs('utilities.admission', 'WARNING'):
+            self.assertIsNotNone(self.admission.try_admit("a", 900))
+            self.admission.log_short(
+                "a", self.admission.try_admit("a", 900)
+            )
+
+    def test_off_by_default(self):
+        path = os.path.dirname(os.path.realpath(__file__))
+        with open(os.path.join(path, '.env.testing')) as f:
+            lines = [x for x in f if not x.startswith('UBV_DISK_WATERMARK')]
+        with tempfile.NamedTemporaryFile('w', suffix='.env') as dotenv, \
+                patch.dict(os.environ):
+            dotenv.writelines(lines)
+            dotenv.flush()
+            os.environ.pop('UBV_DISK_WATERMARK', None)
+            config = Config(dotenv=dotenv.name)
+            self.assertEqual(config.paths.disk_watermark, 0)
+
+
+class TestPlanner(unittest.TestCase):
+    def setUp(self):
+        def ubv(mac, epoch, size):
+            return {
+                "file": f"/ubv/{mac}_0_rotating_{epoch}.ubv", "size": size
+            }
+        self.ubv_files = {
+            date(2021, 1, 27): [
+                ubv("AAAAAAAAAAAA", 2000, 10), ubv("BBBBBBBBBBBB", 1000, 50)
+            ],
+            date(2021, 1, 26): [
+                ubv("AAAAAAAAAAAA", 500, 30), ubv("BBBBBBBBBBBB", 100, 20)
+            ]
+        }
+        self.cameras = {"AAAAAAAAAAAA": {"name": "Front Door"}}
+
+    def _sizes(self, **kwargs):
+        return [
+            x['size'] for x in plan_ubv_files(self.ubv_files, **kwargs)
+        ]
+
+    def test_orders(self):
+        self.assertEqual(self._sizes(order="date"), [30, 20, 10, 50])
+        self.assertEqual(self._sizes(order="lpt"), [50, 30, 20, 10])
+        self.assertEqual(self._sizes(order="oldest"), [20, 30, 50, 10])
+        with self.assertRaises(ValueError):
+            self._sizes(order="random")
+
+    def test_weights(self):
+        weights = parse_weights("Front Door=2, BBBBBBBBBBBB=0.5")
+        self.assertEqual(weights, {"Front Door": 2.0, "BBBBBBBBBBBB": 0.5})
+        self.assertEqual(
+            self._sizes(order="lpt", weights=weights, cameras=self.cameras),
+            [30, 50, 10, 20]
+        )
+        self.assertEqual(
+            self._sizes(
+                order="oldest", weights=weights, cameras=self.cameras
+            ),
+            [30, 20, 10, 50]
+        )
+        with self.assertRaises(ValueError):
+            parse_weights("Front Door")
+
+
+class TestWatch(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.day = os.path.join(self.tmpdir.name, '2021', '01', '27')
+        os.makedirs(self.day)
+
+    def test_stability(self):
+        tracker = StabilityTracker(quiet=60)
+        old = os.path.join(self.day, 'old.ubv')
+        new = os.path.join(self.day, 'new.ubv')
+        for path in (old, new):
+            open(path, 'w').close()
+            tracker.observe(path)
+        # Synced a while ago and untouched since
+        os.utime(old, (time.time() - 120, time.time() - 120))
+        tracker.observe(old)
+        self.assertEqual(tracker.ready(), [])
+        tracker = StabilityTracker(quiet=60)
+        tracker.observe(old)
+        tracker.observe(new)
+        self.assertEqual(tracker.ready(), [old])
+        self.assertEqual(len(tracker), 1)
+
+    def _watch(self, use_inotify):
+        watcher = UBVWatcher(
+            self.tmpdir.name, quiet=0.2, interval=0.1,
+            use_inotify=use_inotify
+        )
+        muxed = os.path.join(self.day, 'muxed.ubv')
+        open(muxed, 'w').close()
+        open(f"{muxed}.muxed", 'w').close()
+        stop = threading.Event()
+        groups = []
+
+        def _collect():
+            for group in watcher.ready_groups(stop):
+                groups.append(group)
+        thread = threading.Thread(target=_collect)
+        thread.start()
+        time.sleep(0.3)
+        # A new day folder and a file still being written to
+        day = os.path.join(self.tmpdir.name, '2021', '01', '28')
+        os.makedirs(day)
+        path = os.path.join(day, 'new.ubv')
+        with open(path, 'w') as fh:
+            for _ in range(5):
+                fh.write('x')
+                fh.flush()
+                time.sleep(0.1)
+            self.assertEqual(groups, [])
+        deadline = time.monotonic() + 10
+        while not groups and time.monotonic() < deadline:
+            time.sleep(0.05)
+        stop.set()
+        thread.join(10)
+        self.assertEqual(groups, [[path]])
+        return watcher
+
+    def test_inotify(self):
+        watcher = self._watch(use_inotify=True)
+        self.assertIsNotNone(watcher.inotify)
+
+    def test_polling(self):
+        watcher = self._watch(use_inotify=False)
+        self.assertIsNone(watcher.inotify)
+
+
+class TestPipeline(unittest.TestCase):
+    def test_stages(self):
+        pipeline = Pipeline(name="test")
+        pipeline.add_stage("double", lambda x: x * 2, workers=3)
+        pipeline.add_stage(
+            "drop", lambda x: None if x % 4 else x, workers=2)
+        results = []
+        pipeline.add_stage("collect", results.append)
+        errors = pipeline.run(range(10))
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(results), [0, 4, 8, 12, 16])
+
+    def test_errors(self):
+        pipeline = Pipeline(name="test")
+        pipeline.add_stage("invert", lambda x: 1 / x, workers=2)
+        errors = pipeline.run(range(3))
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0][0], "invert")
+        self.assertEqual(errors[0][1], 0)
+
+    def test_failing_items(self):
+        # The workers finish and stop when the item source raises
+        def items():
+            yield 1
+            raise ConnectionError("source failed")
+        results = []
+        pipeline = Pipeline(name="test")
+        pipeline.add_stage("collect", results.append, workers=2)
+        before = threading.active_count()
+        with self.assertRaises(ConnectionError):
+            pipeline.run(items())
+        self.assertEqual(results, [1])
+        self.assertEqual(threading.active_count(), before)
+
 
 if __name__ == "__main__":
     logger = logging.getLogger()
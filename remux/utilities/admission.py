@@ -0,0 +1,100 @@
+import os
+import time
+import logging
+import threading
+
+
+class DiskAdmission():
+    # Admits remux jobs only while the space they're expected to need fits
+    # under the watermark on every filesystem they write to. Each job holds
+    # a reservation until it finishes, shrinking as its MP4s land on disk
+    # since statvfs already counts those.
+    def __init__(self, paths, watermark=0.95, expansion=1.1, poll=5,
+                 report=300):
+        self.paths = paths
+        self.watermark = watermark
+        self.expansion = expansion
+        self.poll = poll
+        self.report = report
+        self.logger = logging.getLogger(__name__)
+        self._reserved = {}
+        self._cond = threading.Condition()
+
+    def estimate(self, ubv_bytes):
+        return int(ubv_bytes * self.expansion)
+
+    def admit(self, key, ubv_bytes):
+        # Blocks until the job fits, reporting while it waits
+        start = time.monotonic()
+        reported = None
+        with self._cond:
+            while True:
+                short = self.try_admit(key, ubv_bytes)
+                if short is None:
+                    break
+                now = time.monotonic()
+                if reported is None or now - reported >= self.report:
+                    reported = now
+                    self.log_short(key, short)
+                self._cond.wait(self.poll)
+        waited = time.monotonic() - start
+        if reported is not None:
+            self.logger.info(f"Resumed {key} after {waited:.0f}s.")
+        return waited
+
+    def try_admit(self, key, ubv_bytes):
+        # Reserves space and returns None, or returns what's short
+        needed = self.estimate(ubv_bytes)
+        with self._cond:
+            short = self._short(needed)
+            if short is None:
+                self._reserved[key] = needed
+            return short
+
+    def log_short(self, key, short):
+        path, needed, free, limit = short
+        self.logger.warning(
+            f"Paused {key}: it needs {needed} bytes but only "
+            f"{max(limit, 0)} of {free} free bytes on {path} "
+            f"are under the {self.watermark:.0%} watermark."
+        )
+
+    def consumed(self, key, nbytes):
+        with self._cond:
+            if key in self._reserved:
+                self._reserved[key] = max(self._reserved[key] - nbytes, 0)
+
+    def release(self, key):
+        with self._cond:
+            if self._reserved.pop(key, None) is not None:
+                self._cond.notify_all()
+
+    def _short(self, needed):
+        # The first filesystem the job doesn't fit on, or None. Paths on
+        # the same device are only counted once.
+        reserved = sum(self._reserved.values())
+        seen = set()
+        for path in self.paths:
+            path = self._existing(path)
+            st = os.statvfs(path)
+            device = os.stat(path).st_dev
+            if device in seen:
+                continue
+            seen.add(device)
+            total = st.f_blocks * st.f_frsize
+            free = st.f_bavail * st.f_frsize
+            used = total - free
+            limit = int(total * self.watermark) - used - reserved
+            if needed > limit:
+                return path, needed, free, limit
+        return None
+
+    @staticmethod
+    def _existing(path):
+        # The output folder may not have been created yet
+        while not os.path.exists(path):
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+        return path
@@ -0,0 +1,167 @@
+import os
+import re
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timedelta
+from utilities.mp4info import read_mp4, MP4FormatError
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS segments (
+    path TEXT PRIMARY KEY,
+    mac TEXT,
+    camera TEXT NOT NULL,
+    start TEXT NOT NULL,
+    duration REAL,
+    size INTEGER,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS segments_camera_start ON segments (camera, start);
+CREATE INDEX IF NOT EXISTS segments_mac_start ON segments (mac, start);
+"""
+
+# Starts are kept as the wall clock time in the output name, which sorts
+# the same as text
+START_FORMAT = "%Y-%m-%d %H:%M:%S"
+# <camera>_YYYY-MM-DD_HH-MM-SS.mp4 as written by move_mp4
+OUTPUT_NAME = re.compile(
+    r'^(.+)_(\d{4}-\d{2}-\d{2})_(\d{2})-(\d{2})-(\d{2})\.mp4$'
+)
+MAC = re.compile(r'^[0-9A-Fa-f]{12}$')
+
+
+def parse_output_name(filename):
+    # Returns the camera name and start of an output MP4, or None
+    m = OUTPUT_NAME.match(filename)
+    if not m:
+        return None
+    return m.group(1), f"{m.group(2)} {m.group(3)}:{m.group(4)}:{m.group(5)}"
+
+
+class SegmentCatalog():
+    # Every MP4 segment moved into the output tree, by camera and start
+    # time, so a time range can be found without walking the tree. Kept in
+    # its own SQLite file as it describes UBV_OUTPUT rather than UBV_FILES.
+    def __init__(self, path):
+        self.path = path
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self.conn.row_factory = sqlite3.Row
+        with self._lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(SCHEMA)
+        self.logger.debug(f"Opened segment catalog at {path}")
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def add(self, path, camera, start, mac=None, size=None, duration=None):
+        self.add_many([(path, camera, start, mac, size, duration)])
+
+    def add_many(self, segments):
+        # segments are (path, camera, start, mac, size, duration). A known
+        # duration or MAC isn't replaced by a missing one.
+        now = time.time()
+        with self._lock:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT INTO segments "
+                "(path, camera, start, mac, size, duration, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET "
+                "camera = excluded.camera, start = excluded.start, "
+                "mac = COALESCE(excluded.mac, mac), size = excluded.size, "
+                "duration = COALESCE(excluded.duration, duration), "
+                "updated = excluded.updated",
+                [(*x, now) for x in segments]
+            )
+            self.conn.execute("COMMIT")
+
+    def find(self, camera, start, end):
+        # Segments of camera, by name or MAC, overlapping [start, end).
+        # The segment running into start is included when its duration
+        # says it reaches start, or isn't known.
+        column = 'mac' if MAC.match(camera) else 'camera'
+        if column == 'mac':
+            camera = camera.upper()
+        start = start.strftime(START_FORMAT)
+        end = end.strftime(START_FORMAT)
+        with self._lock:
+            before = self.conn.execute(
+                f"SELECT * FROM segments WHERE {column} = ? AND start < ? "
+                "ORDER BY start DESC LIMIT 1",
+                (camera, start)
+            ).fetchone()
+            rows = self.conn.execute(
+                f"SELECT * FROM segments WHERE {column} = ? "
+                "AND start >= ? AND start < ? ORDER BY start",
+                (camera, start, end)
+            ).fetchall()
+        segments = [dict(x) for x in rows]
+        if before and self._reaches(dict(before), start):
+            segments.insert(0, dict(before))
+        return segments
+
+    @staticmethod
+    def _reaches(segment, start):
+        if segment['duration'] is None:
+            return True
+        end = datetime.strptime(segment['start'], START_FORMAT) + \
+            timedelta(seconds=segment['duration'])
+        return end.strftime(START_FORMAT) > start
+
+    def rebuild(self, root, cameras=None):
+        # Backfills the catalog from an existing output tree and drops
+        # segments no longer in it. Dot folders such as .staging hold
+        # MP4s that haven't been moved yet.
+        self.logger.info(f"Rebuilding segment catalog from {root}")
+        macs = {v['name']: k for k, v in (cameras or {}).items()}
+        segments = []
+        for folder, subfolders, files in os.walk(root):
+            subfolders[:] = sorted(
+                x for x in subfolders if not x.startswith('.')
+            )
+            for name in files:
+                parsed = parse_output_name(name)
+                if parsed is None:
+                    continue
+                path = os.path.join(folder, name)
+                try:
+                    size = os.path.getsize(path)
+                    duration = read_mp4(path)['duration']
+                except FileNotFoundError:
+                    continue
+                except (MP4FormatError, OSError) as e:
+                    self.logger.warning(f"Cannot read duration: {e}")
+                    duration = None
+                camera, start = parsed
+                segments.append(
+                    (path, camera, start, macs.get(camera), size, duration)
+                )
+        self.add_many(segments)
+        seen = {x[0] for x in segments}
+        prefix = root.rstrip(os.path.sep) + os.path.sep
+        with self._lock:
+            stale = [
+                x['path'] for x in self.conn.execute(
+                    "SELECT path FROM segments WHERE path >= ? AND path < ?",
+                    (prefix, prefix[:-1] + chr(ord(os.path.sep) + 1))
+                ) if x['path'] not in seen
+            ]
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "DELETE FROM segments WHERE path = ?",
+                [(x,) for x in stale]
+            )
+            self.conn.execute("COMMIT")
+        self.logger.info(
+            f"Catalogued {len(segments)} MP4 segments, "
+            f"dropped {len(stale)} missing ones."
+        )
+        return len(segments)
@@ -1,16 +1,37 @@
+import os
 import sys
+import json
+import time
 import urllib3
 import requests
 import logging
+import threading
+from requests.adapters import HTTPAdapter
 
 
 class CloudKey():
-    def __init__(self, config):
+    def __init__(self, config, offline=False):
         self.config = config
+        self.offline = offline
         self.logger = logging.getLogger(__name__)
         self.logger.info("CloudKey Class Initialized")
-        self.url = "https://{}".format(self.config.controller)
+        if "://" in self.config.controller:
+            self.url = self.config.controller.rstrip('/')
+        else:
+            self.url = "https://{}".format(self.config.controller)
         self.verify_ssl = self._check_ssl()
+        self._refresh_thread = None
+        # One session is kept for the life of the object so the
+        # connection, cookie and CSRF token are reused between calls.
+        self.session = None
+        self._authenticated = False
+        self._session_lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def _check_ssl(self):
         if self.config.ssl:
@@ -28,48 +49,178 @@ class CloudKey():
             urllib3.disable_warnings()
         return self.config.ssl
 
+    def login(self):
+        with self._session_lock:
+            session = self._get_session()
+            self.logger.debug(
+                f"Authenticating with CloudKey at {self.url}"
+            )
+            preauth = session.get(self.url)
+            self._update_csrf(preauth)
+            authentication = {
+                "username": self.config.username,
+                "password": self.config.password,
+                "rememberMe": False
+            }
+            auth = session.post(
+                f"{self.url}/api/auth/login", data=authentication
+            )
+            if auth.status_code != 200:
+                self.logger.critical(
+                    f"Status Code {auth.status_code} raised on "
+                    "authentication attempt. Bad password?"
+                    "Exiting..."
+                )
+                sys.exit(1)
+            self._update_csrf(auth)
+            self._authenticated = True
+
+    def logout(self):
+        with self._session_lock:
+            if self.session and self._authenticated:
+                deauth = self.session.post(  # noqa: F841
+                    f"{self.url}/api/auth/logout"
+                )
+            self._authenticated = False
+
+    def close(self, timeout=60):
+        self.wait_for_refresh(timeout)
+        with self._session_lock:
+            if self.session:
+                try:
+                    self.logout()
+                except requests.RequestException as e:
+                    self.logger.debug(f"Logout failed: {e}")
+                self.session.close()
+                self.session = None
+
     def get_bootstrap(self):
         self.logger.debug(
-            f"Querying CloudKey at {self.url}"
+            f"Querying CloudKey bootstrap at {self.url}"
         )
-        session = requests.Session()
-        preauth = session.get(self.url, verify=self.verify_ssl)
-        session.headers.update(
-            {"X-CSRF-Token": preauth.headers['X-CSRF-Token']}
+        bootstrap = self._request("GET", "/proxy/protect/api/bootstrap")
+        self.logger.debug(
+            "Returning bootstrap data from cloudkey."
         )
-        authentication = {
-            "username": self.config.username,
-            "password": self.config.password,
-            "rememberMe": False
-        }
-        auth = session.post(  # noqa: F841
-            f"{self.url}/api/auth/login", data=authentication
+        return bootstrap.json()
+
+    def get_camera_list(self):
+        # Only the cameras, without the rest of the bootstrap
+        self.logger.debug(
+            f"Querying CloudKey cameras at {self.url}"
         )
-        if auth.status_code != 200:
-            self.logger.critical(
-                f"Status Code {auth.status_code} raised on "
-                "authentication attempt. Bad password?"
-                "Exiting..."
-            )
-            sys.exit(1)
-        else:
-            bootstrap = session.get(
-                f"{self.url}/proxy/protect/api/bootstrap"
+        cameras = self._request("GET", "/proxy/protect/api/cameras")
+        return cameras.json()
+
+    def _get_session(self):
+        if self.session is None:
+            self.session = requests.Session()
+            self.session.verify = self.verify_ssl
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
+        return self.session
+
+    def _request(self, method, path, **kwargs):
+        with self._session_lock:
+            if not self._authenticated:
+                self.login()
+            response = self.session.request(
+                method, f"{self.url}{path}", **kwargs
             )
-            deauth = session.post(  # noqa: F841
-                f"{self.url}/api/auth/logout"
+            if response.status_code == 401:
+                self.logger.info(
+                    "CloudKey session expired, authenticating again."
+                )
+                self._authenticated = False
+                self.login()
+                response = self.session.request(
+                    method, f"{self.url}{path}", **kwargs
+                )
+            self._update_csrf(response)
+            response.raise_for_status()
+        return response
+
+    def _update_csrf(self, response):
+        token = response.headers.get('X-Updated-CSRF-Token') or \
+            response.headers.get('X-CSRF-Token')
+        if token:
+            self.session.headers.update({"X-CSRF-Token": token})
+
+    def get_cameras(self):
+        self.logger.info("Getting Cameras")
+        cached = self._read_cache()
+        if cached:
+            age = time.time() - cached['fetched']
+            if self.offline or age < self.config.cache_ttl:
+                self.logger.info(
+                    f"Returning {len(cached['cameras'])} cached cameras "
+                    f"from {int(age)}s ago."
+                )
+                return cached['cameras']
+            # Serve the stale copy now and refresh it for the next run
+            self.logger.info(
+                f"Camera cache is {int(age)}s old, refreshing in background."
             )
-            self.logger.debug(
-                "Returning bootstrap data from cloudkey."
+            self._refresh_in_background()
+            return cached['cameras']
+        if self.offline:
+            raise FileNotFoundError(
+                f"Offline mode needs a camera cache at {self.config.cache}"
             )
-            cameras = bootstrap.json()
+        return self.refresh_cameras()
+
+    def refresh_cameras(self):
+        cameras = self._fetch_cameras()
+        self._write_cache(cameras)
         return cameras
 
-    def get_cameras(self):
-        self.logger.info("Getting Cameras")
-        bootstrap = self.get_bootstrap()
+    def wait_for_refresh(self, timeout=None):
+        if self._refresh_thread:
+            self._refresh_thread.join(timeout)
+
+    def _refresh_in_background(self):
+        if self._refresh_thread and self._refresh_thread.is_alive():
+            return
+
+        def _refresh():
+            try:
+                self.refresh_cameras()
+            except (Exception, SystemExit) as e:
+                self.logger.warning(f"Background camera refresh failed: {e}")
+        self._refresh_thread = threading.Thread(
+            target=_refresh, name="camera-refresh", daemon=True
+        )
+        self._refresh_thread.start()
+
+    def _read_cache(self):
+        if not self.config.cache or not os.path.exists(self.config.cache):
+            return None
+        try:
+            with open(self.config.cache, 'r') as fh:
+                cached = json.load(fh)
+            cached['fetched'] = float(cached['fetched'])
+            if not isinstance(cached['cameras'], dict):
+                raise TypeError("cameras is not a mapping")
+        except (ValueError, KeyError, TypeError) as e:
+            self.logger.warning(
+                f"Ignoring unreadable camera cache {self.config.cache}: {e}"
+            )
+            return None
+        return cached
+
+    def _write_cache(self, cameras):
+        if not self.config.cache:
+            return
+        tmp_path = f"{self.config.cache}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as fh:
+            json.dump({"fetched": time.time(), "cameras": cameras}, fh)
+        os.replace(tmp_path, self.config.cache)
+        self.logger.debug(f"Wrote camera cache to {self.config.cache}")
+
+    def _fetch_cameras(self):
         camera_list = {}
-        for camera in bootstrap['cameras']:
+        for camera in self.get_camera_list():
             self.logger.debug(
                 f"Adding Camera {camera['name']} - {camera['mac']}."
             )
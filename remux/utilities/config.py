@@ -2,12 +2,17 @@ import os
 import sys
 import logging
 from dotenv import load_dotenv
+from utilities.planner import parse_weights
 
 
 def _check_boolean(x):
     return x.lower() in ['true', '1', 'yes', 'y']
 
 
+def _optional_float(x):
+    return float(x) if x else None
+
+
 class Config():
     def __init__(self, dotenv='.env'):
         self.dotenv = dotenv
@@ -15,6 +20,7 @@ class Config():
         self.paths = PathCfg()
         self.cloudkey = CloudKeyCfg()
         self.logs = LogCfg()
+        self.metrics = MetricsCfg()
 
     def _load_dotenv(self):
         if not os.path.exists(self.dotenv):
@@ -30,6 +36,59 @@ class PathCfg():
         self.temp = os.environ.get('UBV_TEMP')
         self.output = os.environ.get('UBV_OUTPUT')
         self.min_age = int(os.environ.get("UBV_MIN_AGE"))
+        # Optional SQLite database holding the state of each UBV file
+        self.state_db = os.environ.get('UBV_STATE_DB')
+        # Optional SQLite catalog of the MP4 segments moved to the output
+        self.catalog = os.environ.get('UBV_CATALOG')
+        # Seconds before a hung ubnt_ubvinfo or remux is killed
+        self.prepare_timeout = _optional_float(
+            os.environ.get('UBV_PREPARE_TIMEOUT'))
+        self.remux_timeout = _optional_float(
+            os.environ.get('UBV_REMUX_TIMEOUT'))
+        # Stage MP4s on the output filesystem so moves are renames, and
+        # checksum any copies that still have to cross filesystems.
+        self.stage_on_output = _check_boolean(
+            os.environ.get('UBV_STAGE_ON_OUTPUT', 'false'))
+        self.verify_copy = _check_boolean(
+            os.environ.get('UBV_VERIFY_COPY', 'false'))
+        # Check each MP4's box headers before it's moved, so a truncated
+        # one keeps its UBV file from being marked muxed
+        self.verify_mp4 = _check_boolean(
+            os.environ.get('UBV_VERIFY_MP4', 'true'))
+        # Pass up to this many UBV files from one camera, and optionally no
+        # more than this many bytes, to each remux run. 1 disables batching.
+        self.remux_batch_files = int(
+            os.environ.get('UBV_REMUX_BATCH_FILES', '1'))
+        self.remux_batch_bytes = int(
+            os.environ.get('UBV_REMUX_BATCH_BYTES', '0'))
+        # Shared folder of expiring claims so several hosts can split the
+        # UBV tree between them, and how long a claim lasts in seconds
+        self.lease_dir = os.environ.get('UBV_LEASE_DIR')
+        self.lease_ttl = int(os.environ.get('UBV_LEASE_TTL', '300'))
+        # Journal files in flight so a crashed run can be picked up again
+        self.journal = _check_boolean(
+            os.environ.get('UBV_JOURNAL', 'true'))
+        # Only start a remux while the temp and output filesystems would
+        # stay under this fraction used, counting each UBV file as this
+        # many times its size in MP4s. Off (0) unless set.
+        self.disk_watermark = float(
+            os.environ.get('UBV_DISK_WATERMARK', '0'))
+        self.temp_expansion = float(
+            os.environ.get('UBV_TEMP_EXPANSION', '1.1'))
+        # Per-camera priority as MAC or name=weight, comma separated
+        self.camera_weights = parse_weights(
+            os.environ.get('UBV_CAMERA_WEIGHTS'))
+        # --watch: seconds a file must go unchanged before it's remuxed,
+        # how often to poll, and whether to poll instead of using inotify
+        self.watch_quiet = float(os.environ.get('UBV_WATCH_QUIET', '300'))
+        self.watch_interval = float(
+            os.environ.get('UBV_WATCH_INTERVAL', '30'))
+        self.watch_poll = _check_boolean(
+            os.environ.get('UBV_WATCH_POLL', 'false'))
+        # Keep a sampled fingerprint of each muxed file, so one rewritten
+        # with the same content isn't remuxed again
+        self.fingerprint = _check_boolean(
+            os.environ.get('UBV_FINGERPRINT', 'true'))
 
 
 class CloudKeyCfg(object):
@@ -39,6 +98,9 @@ class CloudKeyCfg(object):
         self.controller = os.environ.get('CLOUDKEY_CONTROLLER')
         self.ssl = _check_boolean(
             os.environ.get('CLOUDKEY_VERIFY_SSL'))
+        # Optional on-disk copy of the camera list and its lifetime
+        self.cache = os.environ.get('CLOUDKEY_CACHE')
+        self.cache_ttl = int(os.environ.get('CLOUDKEY_CACHE_TTL', '86400'))
 
 
 class LogCfg(object):
@@ -55,3 +117,10 @@ class LogCfg(object):
         self.level = logging.getLevelName(
             os.environ.get('LOGGING_LEVEL')
         )
+
+
+class MetricsCfg(object):
+    def __init__(self):
+        # Prometheus textfile collector output and JSON run summary
+        self.textfile = os.environ.get('METRICS_TEXTFILE')
+        self.summary = os.environ.get('METRICS_SUMMARY')
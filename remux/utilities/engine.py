@@ -0,0 +1,368 @@
+import os
+import time
+import shutil
+import asyncio
+import logging
+import tempfile
+from utilities.processing import parse_remux_line
+
+
+class ToolTimeout(Exception):
+    pass
+
+
+class AsyncRemuxEngine():
+    # Runs ubnt_ubvinfo and remux with asyncio subprocesses. Each tool has
+    # its own semaphore, and hung processes are killed once their timeout
+    # passes or when the calling task is cancelled. Parsing, moving,
+    # state tracking and the journal are delegated to the UBVRemux
+    # instance.
+    def __init__(self, remux, prepare_timeout=None, remux_timeout=None):
+        self.remux = remux
+        self.logger = logging.getLogger(__name__)
+        self.prepare_timeout = prepare_timeout
+        self.remux_timeout = remux_timeout
+        self._semaphores = None
+
+    def run(self, ubv_files, cameras):
+        return asyncio.run(self.remux_ubv_files(ubv_files, cameras))
+
+    async def remux_ubv_files(self, ubv_files, cameras):
+        # Semaphores have to be created inside the running loop
+        self._semaphores = {
+            "ubnt_ubvinfo": asyncio.Semaphore(self.remux.prepare_jobs),
+            "remux": asyncio.Semaphore(self.remux.jobs),
+            "move": asyncio.Semaphore(self.remux.move_jobs),
+            "claim": asyncio.Semaphore(
+                self.remux.prepare_jobs + self.remux.jobs
+            )
+        }
+        total = len(ubv_files)
+        self.remux.cameras = cameras
+        if self.remux._recovery:
+            await self._in_thread(self.remux.recover, ubv_files, cameras)
+        self.logger.info(
+            f"Beginning async remux of {total} files with "
+            f"{self.remux.prepare_jobs} prepare, {self.remux.jobs} remux "
+            f"and {self.remux.move_jobs} move slots"
+        )
+        tasks = [
+            asyncio.ensure_future(self.process_ubv(x, cameras))
+            for x in ubv_files
+        ]
+        results = []
+        try:
+            for i, task in enumerate(asyncio.as_completed(tasks), start=1):
+                try:
+                    results.append(await task)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.logger.exception("Failed processing UBV file")
+                    results.append({"returncode": None, "error": e})
+                self.logger.info(f"Processed File {i} of {total}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if self.remux.journal:
+            self.remux.journal.compact(self.remux.temp)
+        return results
+
+    async def process_ubv(self, ubv_file, cameras):
+        if ubv_file['muxed']:
+            self.logger.debug(
+                f"Skipping {ubv_file['file']} - already remuxed"
+            )
+            return None
+        # Files are only claimed once a slot frees up, so other hosts can
+        # take the rest
+        async with self._semaphores['claim']:
+            if not await self._in_thread(self.remux.claim, ubv_file):
+                return None
+            try:
+                if not ubv_file['prepared']:
+                    await self.prepare_file(ubv_file)
+                return await self.remux_file(ubv_file, cameras)
+            finally:
+                await self._in_thread(self.remux.release, ubv_file)
+
+    async def prepare_file(self, ubv_file):
+        ubv_filepath, ubv_filename = os.path.split(ubv_file['file'])
+        stdout_file = f"{ubv_filename}.txt"
+        stdout_path = os.path.join(self.remux.temp, stdout_file)
+        args = ['ubnt_ubvinfo', '-P', '-f', ubv_file['file']]
+        start = time.monotonic()
+        labels = self.remux.camera_labels(ubv_file['file'])
+        try:
+            with open(stdout_path, 'wb') as out:
+                returncode = await self._run(
+                    args, self.prepare_timeout, stdout=out,
+                    cwd=self.remux.temp
+                )
+        except BaseException:
+            self._remove(stdout_path)
+            self.remux.metrics.record(
+                "prepare", time.monotonic() - start, **labels,
+                bytes_in=self.remux._ubv_size(ubv_file), failed=True
+            )
+            raise
+        self.remux.metrics.record(
+            "prepare", time.monotonic() - start, **labels,
+            bytes_in=self.remux._ubv_size(ubv_file),
+            bytes_out=self.remux._file_size(stdout_path),
+            failed=returncode != 0
+        )
+        if returncode != 0:
+            self.logger.warning(
+                f"Failed to prepare {ubv_file['file']}, "
+                f"ubnt_ubvinfo exited with {returncode}"
+            )
+            self._remove(stdout_path)
+            return False
+        await self._in_thread(
+            shutil.move, stdout_path, os.path.join(ubv_filepath, stdout_file)
+        )
+        ubv_file['prepared'] = True
+        if self.remux.state:
+            await self._in_thread(
+                self.remux.state.set_prepared,
+                ubv_file['file'], time.monotonic() - start
+            )
+        return True
+
+    async def remux_file(self, ubv_file, cameras):
+        worker_temp = tempfile.mkdtemp(dir=self.remux.temp)
+        await self._admit(worker_temp, self.remux._ubv_size(ubv_file))
+        self.remux._journal("start", ubv_file['file'], temp=worker_temp)
+        args = [
+            "remux", "-with-audio", "-output-folder",
+            worker_temp, ubv_file['file']
+        ]
+        start = time.time()
+        outputs = []
+        moves = []
+        current = None
+
+        def on_line(line):
+            nonlocal current
+            mp4_file = parse_remux_line(line, worker_temp)
+            if mp4_file is None:
+                return
+            now = time.time()
+            if current:
+                current.update(
+                    finished=now, seconds=now - current['started'],
+                    size=self.remux._file_size(current['path'])
+                )
+                self.remux._consumed(worker_temp, current)
+                self.remux._journal(
+                    "segment", ubv_file['file'], path=current['path'],
+                    size=current['size']
+                )
+                moves.append(asyncio.ensure_future(
+                    self._move(ubv_file, current, cameras)
+                ))
+            current = {"path": mp4_file, "started": now}
+            outputs.append(current)
+        try:
+            returncode = await self._run(
+                args, self.remux_timeout, on_line=on_line
+            )
+            end = time.time()
+            if current:
+                current.update(
+                    finished=end, seconds=end - current['started'],
+                    size=self.remux._file_size(current['path'])
+                )
+                if returncode == 0:
+                    self.remux._journal(
+                        "segment", ubv_file['file'], path=current['path'],
+                        size=current['size']
+                    )
+                    moves.append(asyncio.ensure_future(
+                        self._move(ubv_file, current, cameras)
+                    ))
+                else:
+                    outputs.remove(current)
+            self.remux._journal(
+                "remuxed", ubv_file['file'], returncode=returncode
+            )
+            moved = await asyncio.gather(*moves, return_exceptions=True)
+        except BaseException as e:
+            self.remux.metrics.record(
+                "remux", time.time() - start,
+                **self.remux.camera_labels(ubv_file['file']),
+                bytes_in=self.remux._ubv_size(ubv_file), failed=True
+            )
+            for move in moves:
+                move.cancel()
+            await asyncio.gather(*moves, return_exceptions=True)
+            await self._in_thread(self._clear_temp, worker_temp)
+            if self.remux.admission:
+                self.remux.admission.release(worker_temp)
+            if not isinstance(e, asyncio.CancelledError):
+                # A cancelled run is left for the next one to recover
+                self.remux._journal("done", ubv_file['file'])
+            raise
+        result = {
+            "file": ubv_file['file'],
+            "returncode": returncode,
+            "outputs": outputs,
+            "started": start,
+            "finished": end,
+            "seconds": end - start
+        }
+        self.remux.metrics.record(
+            "remux", result['seconds'],
+            **self.remux.camera_labels(ubv_file['file']),
+            bytes_in=self.remux._ubv_size(ubv_file),
+            bytes_out=sum(x.get('size') or 0 for x in outputs),
+            failed=returncode != 0
+        )
+        failed = [x for x in moved if isinstance(x, BaseException)]
+        if returncode != 0:
+            self.logger.warning(
+                f"Remux of {ubv_file['file']} exited with {returncode}."
+            )
+        elif failed:
+            self.logger.warning(
+                f"{len(failed)} MP4 files from {ubv_file['file']} "
+                "were not moved."
+            )
+        elif moved and not self.remux.holds_lease(ubv_file):
+            self.logger.warning(
+                f"Lost the lease on {ubv_file['file']}, not marking it muxed."
+            )
+        elif moved:
+            self.logger.info(f"Marking {ubv_file['file']} as muxed.")
+            await self._in_thread(
+                self.remux._set_file_muxed, ubv_file, list(moved),
+                time.time() - start
+            )
+        self.remux._journal("done", ubv_file['file'])
+        self.remux._resumed.pop(ubv_file['file'], None)
+        await self._in_thread(self.remux._remove_job_temp, worker_temp)
+        return result
+
+    async def _admit(self, worker_temp, ubv_bytes):
+        # Polls rather than blocking a thread, so moves keep running
+        admission = self.remux.admission
+        if not admission:
+            return
+        start = time.monotonic()
+        reported = None
+        while True:
+            short = await self._in_thread(
+                admission.try_admit, worker_temp, ubv_bytes
+            )
+            if short is None:
+                break
+            now = time.monotonic()
+            if reported is None or now - reported >= admission.report:
+                reported = now
+                admission.log_short(worker_temp, short)
+            await asyncio.sleep(admission.poll)
+        if reported is not None:
+            self.logger.info(
+                f"Resumed {worker_temp} after "
+                f"{time.monotonic() - start:.0f}s."
+            )
+
+    async def _move(self, ubv_file, segment, cameras):
+        async with self._semaphores['move']:
+            start = time.monotonic()
+            size = segment.get('size') or 0
+            output = None
+            duration = None
+            try:
+                await self._in_thread(
+                    self.remux.check_lease, ubv_file, segment
+                )
+                duration = await self._in_thread(
+                    self.remux.verify_segment, segment
+                )
+                mp4dict = self.remux.parse_mp4(segment['path'], cameras)
+                mp4dict['duration'] = duration
+                output = await self._in_thread(
+                    self.remux._skip_resumed, ubv_file, mp4dict, segment
+                ) or await self._in_thread(self.remux.move_mp4, mp4dict)
+                self.remux._journal(
+                    "moved", ubv_file['file'], path=segment['path'],
+                    output=output, size=segment.get('size')
+                )
+            finally:
+                self.remux.metrics.record(
+                    "move", time.monotonic() - start,
+                    **self.remux.camera_labels(segment['path']),
+                    bytes_in=size, bytes_out=size if output else 0,
+                    failed=output is None, media_seconds=duration
+                )
+            return output
+
+    async def _run(self, args, timeout, stdout=None, cwd=None, on_line=None):
+        tool = args[0]
+        async with self._semaphores[tool]:
+            self.logger.debug(f"Running {' '.join(args)}")
+            proc = await asyncio.create_subprocess_exec(
+                *args, cwd=cwd,
+                stdout=stdout or asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            readers = [self._read_lines(proc.stderr, on_line)]
+            if stdout is None:
+                readers.append(self._read_lines(proc.stdout, on_line))
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*readers, proc.wait()), timeout
+                )
+            except asyncio.TimeoutError:
+                self.logger.error(
+                    f"{tool} exceeded {timeout}s on {args[-1]}, killing it."
+                )
+                await self._kill(proc)
+                raise ToolTimeout(f"{tool} timed out on {args[-1]}")
+            except BaseException:
+                await self._kill(proc)
+                raise
+        return proc.returncode
+
+    @staticmethod
+    async def _read_lines(stream, on_line):
+        # Read in chunks rather than readline() so a huge line can't
+        # overrun the stream buffer limit.
+        pending = b''
+        while True:
+            chunk = await stream.read(65536)
+            if not chunk:
+                break
+            pending += chunk
+            *lines, pending = pending.split(b'\n')
+            if on_line:
+                for line in lines:
+                    on_line(line)
+        if pending and on_line:
+            on_line(pending)
+
+    @staticmethod
+    async def _kill(proc):
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+
+    @staticmethod
+    async def _in_thread(func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    @staticmethod
+    def _remove(path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    @staticmethod
+    def _clear_temp(worker_temp):
+        shutil.rmtree(worker_temp, ignore_errors=True)
@@ -0,0 +1,69 @@
+import os
+import json
+import mmap
+import hashlib
+
+# A fingerprint hashes the first and last blocks of a UBV file and blocks
+# spread evenly between them, along with its size. That's a few megabytes
+# read however large the file is, and enough to tell a file that was only
+# rewritten in place (restored, or copied again by rsync) from one whose
+# recordings changed.
+BLOCK = 1 << 20
+SAMPLES = 16
+
+
+def sample_ranges(size, block=BLOCK, samples=SAMPLES):
+    # (offset, length) of each block hashed, the whole file if it's small
+    if size <= block * (samples + 2):
+        return [(0, size)]
+    stride = (size - block) / (samples + 1)
+    return [(int(stride * i), block) for i in range(samples + 2)]
+
+
+def fingerprint(path, block=BLOCK, samples=SAMPLES):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as fh:
+        size = os.fstat(fh.fileno()).st_size
+        if size:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for offset, length in sample_ranges(size, block, samples):
+                    digest.update(mm[offset:offset + length])
+    return f"{size}:{digest.hexdigest()}"
+
+
+def fingerprint_record(path):
+    # What's kept when a file is muxed, so a later change to its size or
+    # mtime can be checked against its content
+    st = os.stat(path)
+    return {
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "fingerprint": fingerprint(path)
+    }
+
+
+def unchanged(path, recorded):
+    # True if path still has the recorded fingerprint. A different size
+    # settles it without reading anything.
+    if not recorded or not recorded.get('fingerprint'):
+        return False
+    size = recorded['fingerprint'].split(':', 1)[0]
+    if str(os.path.getsize(path)) != size:
+        return False
+    return fingerprint(path) == recorded['fingerprint']
+
+
+def read_sentinel(path):
+    # The record written into a .muxed file, None for the empty sentinels
+    # written before fingerprints were kept
+    try:
+        with open(path) as fh:
+            return json.loads(fh.read() or 'null')
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_sentinel(path, record=None):
+    with open(path, 'w') as fh:
+        if record:
+            json.dump(record, fh)
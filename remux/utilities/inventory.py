@@ -0,0 +1,232 @@
+import os
+import logging
+import threading
+from datetime import date
+from utilities.fingerprint import read_sentinel, write_sentinel, unchanged
+
+
+class UBVInventory():
+    # An index of date -> UBV files for the YYYY/MM/DD tree under root.
+    # Day folders are only listed again when their mtime changes, which
+    # happens whenever a file is added, removed or renamed in them. Files
+    # rewritten in place do not touch the folder mtime.
+    def __init__(self, root, state=None):
+        self.root = root
+        self.state = state
+        self.logger = logging.getLogger(__name__)
+        self._days = {}
+        # Muxed files rewritten since, by whether their content changed
+        self.fingerprint_stats = {"unchanged": 0, "changed": 0}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        self.logger.debug(f"Refreshing UBV inventory from {self.root}")
+        seen = set()
+        scanned = 0
+        for path, filedate in self._day_folders():
+            seen.add(filedate)
+            scanned += self._refresh_day(path, filedate)
+        with self._lock:
+            for filedate in set(self._days) - seen:
+                del self._days[filedate]
+        self.logger.debug(
+            f"Listed {scanned} of {len(seen)} day folders."
+        )
+        return self.by_date()
+
+    def refresh_date(self, filedate):
+        with self._lock:
+            cached = self._days.get(filedate)
+        if cached:
+            path = cached['path']
+        else:
+            path = os.path.join(
+                self.root, f"{filedate.year:04d}", f"{filedate.month:02d}",
+                f"{filedate.day:02d}"
+            )
+        if os.path.isdir(path):
+            self._refresh_day(path, filedate)
+        else:
+            with self._lock:
+                self._days.pop(filedate, None)
+        return self.get(filedate)
+
+    def get(self, filedate):
+        with self._lock:
+            day = self._days.get(filedate)
+        if day and day['files']:
+            return day['files']
+        return None
+
+    def by_date(self):
+        with self._lock:
+            return {
+                k: v['files'] for k, v in self._days.items() if v['files']
+            }
+
+    def _day_folders(self):
+        for year in self._subfolders(self.root):
+            for month in self._subfolders(year.path):
+                for day in self._subfolders(month.path):
+                    try:
+                        filedate = date(
+                            int(year.name), int(month.name), int(day.name)
+                        )
+                    except ValueError:
+                        continue
+                    yield day.path, filedate
+
+    @staticmethod
+    def _subfolders(path):
+        with os.scandir(path) as it:
+            entries = [
+                x for x in it if x.name.isdigit() and x.is_dir()
+            ]
+        return sorted(entries, key=lambda x: x.name)
+
+    def _refresh_day(self, path, filedate):
+        mtime_ns = os.stat(path).st_mtime_ns
+        with self._lock:
+            cached = self._days.get(filedate)
+        if cached and cached['mtime_ns'] == mtime_ns:
+            return 0
+        if not cached and self.state and \
+                self.state.get_directory(path) == mtime_ns:
+            # No file was added or removed since the last run, so reuse
+            # what we stored for any file whose size and mtime still match
+            rows = {x['path']: x for x in self.state.files_in(path)}
+            self._store_day(
+                path, filedate, mtime_ns, self._scan_day(path, rows)
+            )
+            return 0
+        self._store_day(path, filedate, mtime_ns, self._scan_day(path))
+        if self.state:
+            self.state.set_directory(path, mtime_ns)
+        return 1
+
+    def _store_day(self, path, filedate, mtime_ns, files):
+        with self._lock:
+            self._days[filedate] = {
+                "path": path,
+                "mtime_ns": mtime_ns,
+                "files": files
+            }
+
+    def _scan_day(self, path, rows=None):
+        with os.scandir(path) as it:
+            entries = {x.name: x for x in it if x.is_file()}
+        files = []
+        for name in sorted(entries):
+            if not name.endswith('.ubv'):
+                continue
+            st = entries[name].stat()
+            row = (rows or {}).get(entries[name].path)
+            if row and not self._changed_since(row, st):
+                files.append({
+                    "file": row['path'],
+                    "prepared": row['prepared'],
+                    "muxed": row['muxed'],
+                    "size": row['size']
+                })
+                continue
+            files.append(self._load(
+                entries[name].path, st,
+                prepared=f"{name}.txt" in entries,
+                muxed=f"{name}.muxed" in entries
+            ))
+        return files
+
+    def entry(self, path):
+        # The same record _scan_day builds, for a single file
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return self._load(
+            path, st, prepared=os.path.exists(f"{path}.txt"),
+            muxed=os.path.exists(f"{path}.muxed")
+        )
+
+    def _load(self, path, st, prepared, muxed):
+        # - prepared = True if the file has indices created.
+        # - muxed = True if the file already has been remuxed
+        ubv_file = {
+            "file": path,
+            "prepared": prepared,
+            "muxed": muxed,
+            "size": st.st_size
+        }
+        if self.state:
+            self._apply_state(ubv_file, st)
+        elif muxed:
+            recorded = read_sentinel(f"{path}.muxed")
+            if self._changed_since(recorded, st):
+                self._verify(ubv_file, recorded, st)
+        return ubv_file
+
+    def _apply_state(self, ubv_file, st):
+        # Known files keep their stored state, new or changed files are
+        # recorded from what the sentinel files say.
+        row = self.state.get(ubv_file['file'])
+        if row and not self._changed_since(row, st):
+            ubv_file['prepared'] = row['prepared'] or ubv_file['prepared']
+            ubv_file['muxed'] = row['muxed']
+            return
+        if row and row['muxed'] and row['fingerprint']:
+            recorded = row
+        elif ubv_file['muxed']:
+            recorded = read_sentinel(f"{ubv_file['file']}.muxed") or {}
+        else:
+            recorded = {}
+        if recorded.get('fingerprint') and self._changed_since(recorded, st):
+            ubv_file['prepared'] = bool(row and row['prepared']) or \
+                ubv_file['prepared']
+            ubv_file['muxed'] = True
+            self._verify(ubv_file, recorded, st)
+        self.state.record_file(
+            ubv_file['file'], st.st_size, st.st_mtime_ns,
+            ubv_file['prepared'], ubv_file['muxed'],
+            fingerprint=recorded.get('fingerprint')
+            if ubv_file['muxed'] else None
+        )
+
+    @staticmethod
+    def _changed_since(recorded, st):
+        # Empty sentinels from before fingerprints were kept are trusted
+        return bool(recorded) and (recorded.get('size'), recorded.get(
+            'mtime_ns')) != (st.st_size, st.st_mtime_ns)
+
+    def _verify(self, ubv_file, recorded, st):
+        # The file's size or mtime moved since it was muxed. It's only
+        # remuxed again if its fingerprint did too.
+        path = ubv_file['file']
+        if not recorded.get('fingerprint'):
+            return
+        try:
+            same = unchanged(path, recorded)
+        except OSError as e:
+            self.logger.warning(f"Cannot fingerprint {path}: {e}")
+            return
+        with self._lock:
+            self.fingerprint_stats['unchanged' if same else 'changed'] += 1
+        if same:
+            self.logger.info(
+                f"Skipping {path} - rewritten since it was remuxed, "
+                f"but its content is unchanged"
+            )
+            if os.path.exists(f"{path}.muxed"):
+                write_sentinel(f"{path}.muxed", {
+                    "size": st.st_size,
+                    "mtime_ns": st.st_mtime_ns,
+                    "fingerprint": recorded['fingerprint']
+                })
+            return
+        self.logger.info(f"{path} changed since it was remuxed, queueing it")
+        ubv_file['muxed'] = False
+        # The index is for the old content too
+        ubv_file['prepared'] = False
+        for sentinel in (f"{path}.muxed", f"{path}.txt"):
+            try:
+                os.remove(sentinel)
+            except FileNotFoundError:
+                pass
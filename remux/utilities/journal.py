@@ -0,0 +1,143 @@
+import os
+import glob
+import json
+import fcntl
+import logging
+import threading
+
+
+class Journal():
+    # Write-ahead log of the UBV files a run is working on and the MP4s
+    # remux has finished for each, so a run that dies part way can be
+    # reconciled by the next one. Each line is one JSON event, written and
+    # fsynced before the work it describes is relied upon. The file is
+    # emptied whenever nothing is left in flight.
+    #
+    # Each run has its own journal, flocked for as long as the run lives,
+    # so runs sharing a staging root only ever recover journals whose
+    # lock can be taken, those of runs that are gone.
+    def __init__(self, path):
+        self.path = path
+        self.logger = logging.getLogger(__name__)
+        self._fh = None
+        self._temp = None
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    def replay(self):
+        # Returns the run temp folders and the state of each UBV file that
+        # was started but never finished
+        runs = []
+        files = {}
+        if not os.path.exists(self.path):
+            return runs, files
+        with open(self.path) as fh:
+            for line in fh:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # A line cut short by the crash
+                    continue
+                kind = event.get('event')
+                if kind == "run":
+                    runs.append(event['temp'])
+                    continue
+                entry = files.setdefault(event['file'], {
+                    "temps": [],
+                    "segments": {},
+                    "moved": {},
+                    "returncode": None,
+                    "done": False
+                })
+                if kind == "start":
+                    entry['temps'].append(event['temp'])
+                elif kind == "segment":
+                    entry['segments'][event['path']] = event.get('size')
+                elif kind == "moved":
+                    entry['moved'][event['path']] = {
+                        "output": event['output'], "size": event.get('size')
+                    }
+                elif kind == "remuxed":
+                    entry['returncode'] = event['returncode']
+                elif kind == "done":
+                    entry['done'] = True
+        return runs, {k: v for k, v in files.items() if not v['done']}
+
+    @classmethod
+    def claim_stale(cls, root):
+        # The journals in root left by runs that are gone, each locked so
+        # no other run recovers it as well
+        journals = []
+        for path in sorted(glob.glob(os.path.join(root, "journal-*.jsonl"))):
+            journal = cls(path)
+            if journal.lock():
+                journals.append(journal)
+        return journals
+
+    def lock(self):
+        # True once this journal is held. False if a live run holds it, or
+        # it was recovered and removed while waiting for it.
+        fh = open(self.path, 'a')
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if os.stat(self.path).st_ino != os.fstat(fh.fileno()).st_ino:
+                raise FileNotFoundError(self.path)
+        except OSError:
+            fh.close()
+            return False
+        with self._lock:
+            self._fh = fh
+        return True
+
+    def open(self, temp):
+        if not self.lock():
+            raise RuntimeError(f"{self.path} is held by another run")
+        with self._lock:
+            self._temp = temp
+        self.write("run", temp=temp)
+
+    def write(self, event, file=None, **fields):
+        record = {"event": event, **fields}
+        if file is not None:
+            record['file'] = file
+        with self._lock:
+            if self._fh is None:
+                return
+            if event == "start":
+                self._in_flight.add(file)
+            elif event == "done":
+                self._in_flight.discard(file)
+            if event == "done" and not self._in_flight:
+                # Nothing left to recover, so start the journal over
+                self._fh.truncate(0)
+                record = {"event": "run", "temp": self._temp}
+            self._fh.write(json.dumps(record) + "\n")
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+
+    def compact(self, temp):
+        # Starts the journal over once no file is in flight
+        with self._lock:
+            if self._fh is None or self._in_flight:
+                return False
+            self._temp = temp
+            self._fh.truncate(0)
+            self._fh.write(json.dumps({"event": "run", "temp": temp}) + "\n")
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            return True
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+    def discard(self):
+        # Removes a recovered journal, unlinking it before the lock goes
+        with self._lock:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+        self.close()
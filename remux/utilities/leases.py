@@ -0,0 +1,192 @@
+import os
+import json
+import time
+import uuid
+import socket
+import hashlib
+import logging
+import threading
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class LeaseManager():
+    # Expiring claims on UBV files so several hosts can work through the
+    # same tree. Each lease is a small JSON file in a shared folder, created
+    # with O_EXCL and kept alive by a heartbeat thread. A lease whose holder
+    # stops renewing it can be taken over once it expires, so hosts' clocks
+    # need to be roughly in sync.
+    def __init__(self, path, ttl=300, owner=None):
+        self.path = path
+        self.ttl = ttl
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.logger = logging.getLogger(__name__)
+        self._held = {}
+        self._lost = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+        os.makedirs(self.path, exist_ok=True)
+
+    def _lease_path(self, name):
+        digest = hashlib.sha1(name.encode()).hexdigest()
+        return os.path.join(self.path, f"{digest}.lease")
+
+    def _record(self, name, token):
+        return {
+            "name": name,
+            "owner": self.owner,
+            "token": token,
+            "expires": time.time() + self.ttl
+        }
+
+    def claim(self, name):
+        # True if this process now holds the lease on name
+        lease_path = self._lease_path(name)
+        token = uuid.uuid4().hex
+        for _ in range(2):
+            if self._create(lease_path, self._record(name, token)):
+                with self._lock:
+                    self._held[name] = token
+                    self._lost.discard(name)
+                self._start_heartbeat()
+                return True
+            current = self._read(lease_path)
+            if current is None:
+                # Released between our attempt and the read
+                continue
+            if current['expires'] > time.time():
+                return False
+            if not self._break(lease_path, current):
+                return False
+            self.logger.info(
+                f"Took over expired lease on {name} from {current['owner']}"
+            )
+        return False
+
+    def release(self, name):
+        with self._lock:
+            token = self._held.pop(name, None)
+            self._lost.discard(name)
+        if token is None:
+            return
+        lease_path = self._lease_path(name)
+        current = self._read(lease_path)
+        if current and current['token'] == token:
+            try:
+                os.remove(lease_path)
+            except FileNotFoundError:
+                pass
+
+    def release_all(self):
+        with self._lock:
+            names = list(self._held)
+        for name in names:
+            self.release(name)
+
+    def held(self, name):
+        with self._lock:
+            return name in self._held and name not in self._lost
+
+    def renew(self):
+        # Extends every lease still held, noting any that were taken over
+        with self._lock:
+            held = dict(self._held)
+        for name, token in held.items():
+            if not self._renew(name, token):
+                with self._lock:
+                    self._lost.add(name)
+                self.logger.warning(f"Lost the lease on {name}")
+
+    def _renew(self, name, token):
+        # The lease is moved aside while it's rewritten, so one another
+        # host took over is put back rather than overwritten. A host that
+        # creates the lease while it's aside keeps it.
+        lease_path = self._lease_path(name)
+        aside = f"{lease_path}.{token}.renew"
+        try:
+            os.rename(lease_path, aside)
+        except FileNotFoundError:
+            return False
+        current = self._read(aside)
+        renewed = current is not None and current['token'] == token
+        if renewed:
+            with open(aside, 'w') as fh:
+                json.dump(self._record(name, token), fh)
+        try:
+            os.link(aside, lease_path)
+        except FileExistsError:
+            renewed = False
+        os.remove(aside)
+        return renewed
+
+    def close(self):
+        self._stop.set()
+        if self._heartbeat:
+            self._heartbeat.join()
+        self.release_all()
+
+    def _start_heartbeat(self):
+        with self._lock:
+            if self._heartbeat is not None:
+                return
+            self._heartbeat = threading.Thread(
+                target=self._beat, name="lease-heartbeat", daemon=True
+            )
+        self._heartbeat.start()
+
+    def _beat(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                self.renew()
+            except OSError:
+                self.logger.exception("Failed renewing leases")
+
+    @staticmethod
+    def _create(lease_path, record):
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(record, fh)
+        return True
+
+    def _read(self, lease_path):
+        try:
+            with open(lease_path) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # Still being written by its creator, or left empty by one that
+            # died before writing it. Either way it lasts a TTL from when it
+            # was created.
+            try:
+                created = os.stat(lease_path).st_mtime
+            except FileNotFoundError:
+                return None
+            return {
+                "owner": None, "token": None, "expires": created + self.ttl
+            }
+
+    def _break(self, lease_path, expired):
+        # Moves the expired lease aside. If another host renewed or took it
+        # over in the meantime, what was moved is put back untouched.
+        aside = f"{lease_path}.{uuid.uuid4().hex}.expired"
+        try:
+            os.rename(lease_path, aside)
+        except FileNotFoundError:
+            return True
+        moved = self._read(aside)
+        if moved and moved['token'] != expired['token']:
+            try:
+                os.link(aside, lease_path)
+            except FileExistsError:
+                pass
+            os.remove(aside)
+            return False
+        os.remove(aside)
+        return True
@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import logging
+import threading
+
+# Histogram buckets in seconds, from quick moves up to hour long remuxes
+BUCKETS = (0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+PREFIX = "unifi_protect_extract"
+
+
+class Metrics():
+    # Per-stage counters and histograms for a run, labelled by stage and
+    # camera. Written out as a Prometheus textfile collector file and as a
+    # JSON summary.
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.started = time.time()
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds, mac=None, camera=None, bytes_in=0,
+               bytes_out=0, failed=False, media_seconds=0):
+        key = (stage, mac or "unknown", camera or "unknown")
+        with self._lock:
+            entry = self._stages.get(key)
+            if entry is None:
+                entry = self._stages[key] = {
+                    "files": 0,
+                    "failures": 0,
+                    "seconds": 0.0,
+                    "bytes_in": 0,
+                    "bytes_out": 0,
+                    "media_seconds": 0.0,
+                    "buckets": [0] * len(BUCKETS)
+                }
+            entry['files'] += 1
+            entry['failures'] += int(failed)
+            entry['seconds'] += seconds
+            entry['bytes_in'] += bytes_in or 0
+            entry['bytes_out'] += bytes_out or 0
+            entry['media_seconds'] += media_seconds or 0
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    entry['buckets'][i] += 1
+
+    def summary(self):
+        elapsed = max(time.time() - self.started, 1e-9)
+        with self._lock:
+            stages = {}
+            cameras = []
+            for (stage, mac, camera), entry in sorted(self._stages.items()):
+                totals = stages.setdefault(stage, {
+                    "files": 0, "failures": 0, "seconds": 0.0,
+                    "bytes_in": 0, "bytes_out": 0, "media_seconds": 0.0
+                })
+                for k in totals:
+                    totals[k] += entry[k]
+                cameras.append({
+                    "stage": stage, "mac": mac, "camera": camera,
+                    **{k: v for k, v in entry.items() if k != 'buckets'}
+                })
+        for totals in stages.values():
+            totals['files_per_second'] = totals['files'] / elapsed
+        return {
+            "started": self.started,
+            "elapsed": elapsed,
+            "stages": stages,
+            "cameras": cameras
+        }
+
+    def write_summary(self, path):
+        self._write_atomic(path, json.dumps(self.summary(), indent=2))
+        self.logger.info(f"Wrote run summary to {path}")
+
+    def write_textfile(self, path):
+        self._write_atomic(path, self.to_prometheus())
+        self.logger.info(f"Wrote Prometheus metrics to {path}")
+
+    def to_prometheus(self):
+        summary = self.summary()
+        lines = []
+
+        def _metric(name, kind, text):
+            lines.append(f"# HELP {PREFIX}_{name} {text}")
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+
+        with self._lock:
+            entries = sorted(self._stages.items())
+        counters = [
+            ("files_total", "files", "Files handled by each stage."),
+            ("failures_total", "failures", "Files that failed a stage."),
+            ("bytes_in_total", "bytes_in", "Bytes read by each stage."),
+            ("bytes_out_total", "bytes_out", "Bytes written by each stage."),
+            ("media_seconds_total", "media_seconds",
+             "Seconds of video in the MP4s handled by each stage."),
+        ]
+        for name, field, text in counters:
+            _metric(f"stage_{name}", "counter", text)
+            for (stage, mac, camera), entry in entries:
+                labels = self._labels(stage=stage, mac=mac, camera=camera)
+                lines.append(
+                    f"{PREFIX}_stage_{name}{{{labels}}} {entry[field]}"
+                )
+        _metric("stage_seconds", "histogram", "Wall time spent per file.")
+        for (stage, mac, camera), entry in entries:
+            labels = self._labels(stage=stage, mac=mac, camera=camera)
+            for bound, count in zip(BUCKETS, entry['buckets']):
+                lines.append(
+                    f"{PREFIX}_stage_seconds_bucket"
+                    f"{{{labels},le=\"{bound}\"}} {count}"
+                )
+            lines.append(
+                f"{PREFIX}_stage_seconds_bucket{{{labels},le=\"+Inf\"}} "
+                f"{entry['files']}"
+            )
+            lines.append(
+                f"{PREFIX}_stage_seconds_sum{{{labels}}} {entry['seconds']}"
+            )
+            lines.append(
+                f"{PREFIX}_stage_seconds_count{{{labels}}} {entry['files']}"
+            )
+        _metric(
+            "stage_files_per_second", "gauge",
+            "Files per second for each stage over the run."
+        )
+        for stage, totals in sorted(summary['stages'].items()):
+            lines.append(
+                f"{PREFIX}_stage_files_per_second"
+                f"{{{self._labels(stage=stage)}}} "
+                f"{totals['files_per_second']}"
+            )
+        _metric("run_seconds", "gauge", "Wall time of the last run.")
+        lines.append(f"{PREFIX}_run_seconds {summary['elapsed']}")
+        _metric(
+            "last_run_timestamp_seconds", "gauge",
+            "When the last run finished."
+        )
+        lines.append(f"{PREFIX}_last_run_timestamp_seconds {time.time()}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _labels(**labels):
+        def _escape(v):
+            return str(v).replace('\\', '\\\\').replace('"', '\\"') \
+                .replace('\n', '\\n')
+        return ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+
+    @staticmethod
+    def _write_atomic(path, text):
+        # node_exporter must never read a half written file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as fh:
+            fh.write(text)
+        os.replace(tmp_path, path)
@@ -0,0 +1,114 @@
+import os
+import struct
+
+# Header-only MP4 checks, so a segment left truncated by a killed remux
+# isn't counted as done. Only box headers and the few bytes of ftyp, mvhd
+# and mehd are read, never the media itself.
+#
+# Every box starts with a 32 bit size and a four character type. A size of
+# 1 means a 64 bit size follows, and 0 that the box runs to the end of the
+# file. A file is complete when its top level boxes exactly fill it and it
+# has ftyp first, then moov and mdat in either order.
+BOX = struct.Struct('>I4s')
+LARGE_SIZE = struct.Struct('>Q')
+# version 0 and 1 of mvhd: creation, modification, timescale, duration
+MVHD = {0: struct.Struct('>B3xIIII'), 1: struct.Struct('>B3xQQIQ')}
+# version 0 and 1 of mehd: fragment duration
+MEHD = {0: struct.Struct('>B3xI'), 1: struct.Struct('>B3xQ')}
+
+
+class MP4FormatError(ValueError):
+    pass
+
+
+def boxes(fh, start, end, path):
+    # Yields (type, offset, header size, box size) for the boxes in
+    # [start, end) of fh
+    offset = start
+    while offset < end:
+        if end - offset < BOX.size:
+            raise MP4FormatError(
+                f"Truncated box header at {offset} in {path}"
+            )
+        fh.seek(offset)
+        size, kind = BOX.unpack(fh.read(BOX.size))
+        kind = kind.decode('latin-1')
+        header = BOX.size
+        if size == 1:
+            if end - offset < BOX.size + LARGE_SIZE.size:
+                raise MP4FormatError(
+                    f"Truncated {kind} box header at {offset} in {path}"
+                )
+            size, = LARGE_SIZE.unpack(fh.read(LARGE_SIZE.size))
+            header += LARGE_SIZE.size
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            raise MP4FormatError(
+                f"{kind} box at {offset} in {path} has a bad size {size}"
+            )
+        if offset + size > end:
+            raise MP4FormatError(
+                f"{kind} box at {offset} runs {offset + size - end} bytes "
+                f"past the end of {path}"
+            )
+        yield kind, offset, header, size
+        offset += size
+
+
+def _read_full_box(fh, offset, header, size, layouts, path, kind):
+    fh.seek(offset + header)
+    version = fh.read(1)
+    layout = layouts.get(version[0]) if version else None
+    if layout is None or size - header < layout.size:
+        raise MP4FormatError(f"Unreadable {kind} box in {path}")
+    fh.seek(offset + header)
+    return layout.unpack(fh.read(layout.size))
+
+
+def read_mp4(path):
+    # Returns the brand, top level boxes and duration in seconds of a
+    # complete MP4, raising MP4FormatError for anything else
+    with open(path, 'rb') as fh:
+        end = os.fstat(fh.fileno()).st_size
+        if end == 0:
+            raise MP4FormatError(f"{path} is empty")
+        top = list(boxes(fh, 0, end, path))
+        kinds = [x[0] for x in top]
+        if kinds[0] != 'ftyp':
+            raise MP4FormatError(f"{path} does not start with ftyp")
+        for required in ('moov', 'mdat'):
+            if required not in kinds:
+                raise MP4FormatError(f"{path} has no {required} box")
+        _, offset, header, _ = top[0]
+        fh.seek(offset + header)
+        brand = fh.read(4).decode('latin-1')
+        _, offset, header, size = top[kinds.index('moov')]
+        moov = {
+            x[0]: x for x in boxes(fh, offset + header, offset + size, path)
+        }
+        if 'mvhd' not in moov:
+            raise MP4FormatError(f"{path} has no mvhd box")
+        _, _, _, timescale, duration = _read_full_box(
+            fh, *moov['mvhd'][1:], MVHD, path, 'mvhd'
+        )
+        if not timescale:
+            raise MP4FormatError(f"{path} has a zero timescale")
+        if not duration and 'mvex' in moov:
+            # Fragmented files may only give their length in mehd
+            _, offset, header, size = moov['mvex']
+            mvex = {
+                x[0]: x for x in boxes(
+                    fh, offset + header, offset + size, path
+                )
+            }
+            if 'mehd' in mvex:
+                _, duration = _read_full_box(
+                    fh, *mvex['mehd'][1:], MEHD, path, 'mehd'
+                )
+    return {
+        "brand": brand,
+        "boxes": kinds,
+        "timescale": timescale,
+        "duration": duration / timescale
+    }
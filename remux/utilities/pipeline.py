@@ -0,0 +1,98 @@
+import queue
+import inspect
+import logging
+import threading
+
+_STOP = object()
+
+
+class Pipeline():
+    # Runs items through a chain of stages connected by bounded queues.
+    # Every stage has its own pool of worker threads, so a slow stage only
+    # holds up the items queued in front of it. A stage function returns
+    # the item to hand to the next stage, or None to drop it. A stage that
+    # returns a generator hands on each item as soon as it is yielded.
+    def __init__(self, name="pipeline"):
+        self.name = name
+        self.logger = logging.getLogger(__name__)
+        self.stages = []
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def add_stage(self, name, func, workers=1, queue_size=None):
+        workers = max(1, int(workers))
+        self.stages.append({
+            "name": name,
+            "func": func,
+            "workers": workers,
+            # Keep the backlog in front of a stage no deeper than its pool
+            "queue": queue.Queue(maxsize=queue_size or workers),
+            "running": workers
+        })
+        return self
+
+    def run(self, items):
+        self.logger.debug(
+            f"Starting {self.name} with stages "
+            f"{[(s['name'], s['workers']) for s in self.stages]}"
+        )
+        threads = []
+        for index, stage in enumerate(self.stages):
+            for n in range(stage['workers']):
+                t = threading.Thread(
+                    target=self._worker, args=(index,),
+                    name=f"{self.name}-{stage['name']}-{n}", daemon=True
+                )
+                t.start()
+                threads.append(t)
+        try:
+            if self.stages:
+                for item in items:
+                    self.stages[0]['queue'].put(item)
+        finally:
+            # Workers finish what they have even if items raised
+            if self.stages:
+                for _ in range(self.stages[0]['workers']):
+                    self.stages[0]['queue'].put(_STOP)
+            for t in threads:
+                t.join()
+        self.logger.debug(
+            f"Finished {self.name} with {len(self.errors)} errors."
+        )
+        return self.errors
+
+    @staticmethod
+    def _put(stage, item):
+        if item is not None and stage:
+            stage['queue'].put(item)
+
+    def _worker(self, index):
+        stage = self.stages[index]
+        downstream = None
+        if index + 1 < len(self.stages):
+            downstream = self.stages[index + 1]
+        while True:
+            item = stage['queue'].get()
+            if item is _STOP:
+                break
+            try:
+                result = stage['func'](item)
+                if inspect.isgenerator(result):
+                    for x in result:
+                        self._put(downstream, x)
+                else:
+                    self._put(downstream, result)
+            except Exception as e:
+                self.logger.exception(
+                    f"Stage {stage['name']} failed on {item}"
+                )
+                with self._lock:
+                    self.errors.append((stage['name'], item, e))
+                continue
+        # The last worker out of a stage shuts down the next one
+        with self._lock:
+            stage['running'] -= 1
+            last = stage['running'] == 0
+        if last and downstream:
+            for _ in range(downstream['workers']):
+                downstream['queue'].put(_STOP)
@@ -0,0 +1,60 @@
+import os
+
+# How a backlog is ordered. "date" keeps the old day by day order, "lpt"
+# starts the largest files first so no worker is left with a huge file at
+# the end, and "oldest" clears the oldest recordings first.
+ORDERS = ('date', 'lpt', 'oldest')
+
+
+def ubv_start(ubv_file):
+    # Epoch seconds from MAC_<channel>_rotating_<epoch ms>.ubv, or None
+    try:
+        return int(os.path.basename(ubv_file)[:-4].rsplit('_', 1)[1]) / 1000
+    except (IndexError, ValueError):
+        return None
+
+
+def parse_weights(value):
+    # "MAC=2,Front Door=0.5" into {"MAC": 2.0, "Front Door": 0.5}
+    weights = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        key, _, weight = item.rpartition('=')
+        if not key:
+            raise ValueError(f"Camera weight '{item}' should be NAME=WEIGHT")
+        weights[key.strip()] = float(weight)
+    return weights
+
+
+def camera_weight(ubv_file, weights, cameras=None):
+    # Weights can be given by MAC or by camera name
+    if not weights:
+        return 1.0
+    mac = os.path.basename(ubv_file['file']).split('_', 1)[0]
+    if mac in weights:
+        return weights[mac]
+    name = (cameras or {}).get(mac, {}).get('name')
+    return weights.get(name, 1.0)
+
+
+def plan_ubv_files(ubv_files, order='lpt', weights=None, cameras=None):
+    # Flattens {date: [ubv_file, ...]} into the order files should start
+    files = [
+        (dk, x) for dk in sorted(ubv_files) for x in ubv_files[dk]
+    ]
+
+    def priority(ubv_file):
+        return (ubv_file.get('size') or 0) * camera_weight(
+            ubv_file, weights, cameras
+        )
+    if order == 'lpt':
+        files.sort(key=lambda x: -priority(x[1]))
+    elif order == 'oldest':
+        files.sort(key=lambda x: (
+            x[0], -camera_weight(x[1], weights, cameras),
+            ubv_start(x[1]['file']) or 0
+        ))
+    elif order != 'date':
+        raise ValueError(f"Unknown order {order}, use one of {ORDERS}")
+    return [x for _, x in files]
@@ -1,25 +1,256 @@
 import os
+import re
+import csv
+import sys
+import json
+import time
+import sqlite3
+import queue
 import shutil
 import logging
 import tempfile
+import threading
 import subprocess
-from pathlib import Path
 from dateutil import parser
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta, timezone
 from prettytable import PrettyTable
+from utilities.pipeline import Pipeline
+from utilities.state import StateStore
+from utilities.inventory import UBVInventory
+from utilities.transfer import move_file, same_filesystem
+from utilities.metrics import Metrics
+from utilities.profiling import Profiler
+from utilities.leases import LeaseManager, LeaseLost
+from utilities.journal import Journal
+from utilities.admission import DiskAdmission
+from utilities.planner import plan_ubv_files, ubv_start
+from utilities.catalog import SegmentCatalog, START_FORMAT
+from utilities.mp4info import read_mp4, MP4FormatError
+from utilities.results import FileResult, SegmentResult
+from utilities.fingerprint import fingerprint_record, write_sentinel
+
+# Columns of the --list-dates csv and json output
+FILECOUNT_FIELDS = (
+    'date', 'mac', 'camera', 'files', 'bytes', 'prepared', 'muxed'
+)
+# Columns of the --find output
+SEGMENT_FIELDS = ('camera', 'mac', 'start', 'duration', 'size', 'path')
+
+
+def parse_remux_line(line, temp_path):
+    # Returns the MP4 path from a 'Writing MP4' line of remux output
+    if isinstance(line, bytes):
+        line = line.decode(errors='replace')
+    line = line.strip()
+    if not line.startswith('Writing MP4'):
+        return None
+    return next(
+        (y for y in line.split(' ') if temp_path in y), None
+    )
+
+
+# MAC_<channel>_rotating_YYYY-MM-DDTHH.MM.SS+HH.MM as written by remux
+MP4_NAME = re.compile(
+    r'^([0-9A-Fa-f]{12})_.*_(\d{4})-(\d{2})-(\d{2})T'
+    r'(\d{2})\.(\d{2})\.(\d{2})(?:([+-])(\d{2})\.?(\d{2})|Z)?$'
+)
+
+
+def parse_mp4_name(filename):
+    # Returns the camera MAC and timestamp from an MP4 name without its
+    # extension, falling back to dateutil for anything unexpected.
+    m = MP4_NAME.match(filename)
+    if m:
+        fields = [int(x) for x in m.group(2, 3, 4, 5, 6, 7)]
+        tz = None
+        if m.group(8):
+            offset = timedelta(
+                hours=int(m.group(9)), minutes=int(m.group(10))
+            )
+            tz = timezone(-offset if m.group(8) == '-' else offset)
+        elif filename.endswith('Z'):
+            tz = timezone.utc
+        try:
+            return m.group(1), datetime(*fields, tzinfo=tz)
+        except ValueError:
+            pass
+    file_mac = filename.split('_')[0]
+    file_date = filename.split('_')[-1].replace('.', ':')
+    return file_mac, parser.parse(file_date)
+
+
+class RemuxJob():
+    # Tracks one UBV file while its segments are moved by the move stage,
+    # which may finish them in any order.
+    def __init__(self, ubv_file, temp, batch=None):
+        self.ubv_file = ubv_file
+        self.temp = temp
+        self.batch = batch
+        self.result = None
+        self.outputs = []
+        self.failed = False
+        self._pending = 0
+        self._remuxed = False
+        self._finished = False
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def seconds(self):
+        return time.monotonic() - self._start
+
+    def add_segment(self):
+        with self._lock:
+            self._pending += 1
+
+    def segment_done(self, output=None):
+        with self._lock:
+            self._pending -= 1
+            if not output:
+                self.failed = True
+            # A batch retried one file at a time moves some MP4s twice
+            elif output not in self.outputs:
+                self.outputs.append(output)
+            return self._ready()
+
+    def remux_done(self, result):
+        with self._lock:
+            self.result = result
+            self._remuxed = True
+            return self._ready()
+
+    def _ready(self):
+        # True exactly once, when remux has exited and every segment moved
+        if self._remuxed and self._pending == 0 and not self._finished:
+            self._finished = True
+            return True
+        return False
+
+
+class RemuxBatch():
+    # The jobs sharing one remux run and its temp folder, which is removed
+    # once the last of them has finished.
+    def __init__(self, temp, size):
+        self.temp = temp
+        self._remaining = size
+        self._lock = threading.Lock()
+
+    def job_finished(self):
+        with self._lock:
+            self._remaining -= 1
+            return self._remaining == 0
 
 
 class UBVRemux():
-    def __init__(self, config, auto_create_tmp=True):
+    def __init__(self, config, auto_create_tmp=True, jobs=None,
+                 prepare_jobs=None, move_jobs=None):
         self.config = config
         self.logger = logging.getLogger(__name__)
+        # Concurrency limits for the prepare, remux and move stages
+        self.jobs = jobs or os.cpu_count() or 1
+        self.prepare_jobs = prepare_jobs or self.jobs
+        self.move_jobs = move_jobs or 2
+        self.state = None
+        if getattr(self.config, 'state_db', None):
+            self.state = StateStore(self.config.state_db)
+        self.inventory = UBVInventory(self.config.files, state=self.state)
+        self.catalog = None
+        if getattr(self.config, 'catalog', None):
+            self.catalog = SegmentCatalog(self.config.catalog)
+        self.leases = None
+        if getattr(self.config, 'lease_dir', None):
+            self.leases = LeaseManager(
+                self.config.lease_dir, ttl=self.config.lease_ttl
+            )
+        self.move_stats = {"rename": 0, "copy": 0, "bytes_copied": 0}
+        self.metrics = Metrics()
+        self.cameras = {}
+        self.profiler = None
+        self._move_lock = threading.Lock()
+        self._output_dirs = set()
+        self.journal = None
+        self.admission = None
+        self._recovery = None
+        self._stale = []
+        self._resumed = {}
+        self._results = None
         if auto_create_tmp:
+            staging_root = self._staging_root()
             self.temp = tempfile.mkdtemp(
-                dir=self.config.temp
+                dir=staging_root
             )
             self.logger.debug(
                 f"Initialized with {self.temp} as temp path."
             )
+            if getattr(self.config, 'journal', False):
+                self.journal = Journal(os.path.join(
+                    staging_root,
+                    f"journal-{os.path.basename(self.temp)}.jsonl"
+                ))
+                self.journal.open(self.temp)
+                self._stale = Journal.claim_stale(staging_root)
+                self._recovery = self._replay(self._stale)
+            if getattr(self.config, 'disk_watermark', 0):
+                self.admission = DiskAdmission(
+                    [self.temp, self.config.output],
+                    watermark=self.config.disk_watermark,
+                    expansion=self.config.temp_expansion
+                )
+
+    def _staging_root(self):
+        # MP4s written on the output filesystem can be renamed into place
+        # instead of copied across devices.
+        if not self.config.stage_on_output:
+            return self.config.temp
+        os.makedirs(self.config.output, exist_ok=True)
+        if same_filesystem(self.config.temp, self.config.output):
+            return self.config.temp
+        staging = os.path.join(self.config.output, '.staging')
+        os.makedirs(staging, exist_ok=True)
+        self.logger.info(
+            f"Staging MP4 files in {staging} on the output filesystem."
+        )
+        return staging
+
+    def enable_profiling(self, output_dir):
+        # Child process rusage plus cProfile for the Python hot paths
+        self.profiler = Profiler(output_dir)
+        for name in ('get_ubv_files', 'parse_mp4', 'move_mp4'):
+            self.profiler.instrument(self, name, name)
+        for handler in logging.getLogger().handlers:
+            self.profiler.instrument(handler, 'handle', 'logging')
+        return self.profiler
+
+    def camera_labels(self, path):
+        # UBV and MP4 file names both start with the camera MAC
+        mac = os.path.basename(path).split('_')[0]
+        camera = self.cameras.get(mac, {}).get('name')
+        return {"mac": mac, "camera": camera}
+
+    @staticmethod
+    def _file_size(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def report_moves(self):
+        self.logger.info(
+            f"Moved MP4 files with {self.move_stats['rename']} renames and "
+            f"{self.move_stats['copy']} copies "
+            f"({self.move_stats['bytes_copied']} bytes copied)."
+        )
+        return dict(self.move_stats)
+
+    def report_fingerprints(self):
+        stats = dict(self.inventory.fingerprint_stats)
+        if stats['unchanged'] or stats['changed']:
+            self.logger.info(
+                f"Checked fingerprints of muxed files rewritten since: "
+                f"{stats['unchanged']} unchanged and skipped, "
+                f"{stats['changed']} changed and remuxed again."
+            )
+        return stats
 
     def clean_up(self):
         if len(os.listdir(self.temp)) == 0:
@@ -34,69 +265,677 @@ class UBVRemux():
 
     def remux_ubv_by_date(self, date, cameras):
         self.logger.debug(f"Remuxing UBV files by date {date}.")
-        ubv_files = self.get_ubv_by_date(date)
-        self.prepare_ubv_files(ubv_files)
-        self.logger.info(f"Beginning remux for {date}")
+        ubv_files = self.get_ubv_by_date(date) or []
+        self.logger.info(
+            f"Beginning remux for {date} with {self.prepare_jobs} prepare, "
+            f"{self.jobs} remux and {self.move_jobs} move workers"
+        )
+        self.remux_ubv_files(ubv_files, cameras)
+
+    def plan_all(self, cameras, order="lpt"):
+        # Every file in the backlog, in the order they should start
+        ubv_files = plan_ubv_files(
+            self.get_ubv_files(), order=order,
+            weights=getattr(self.config, 'camera_weights', None),
+            cameras=cameras
+        )
+        self.logger.info(
+            f"Planned {len(ubv_files)} files in {order} order."
+        )
+        return ubv_files
+
+    def remux_all(self, cameras, order="lpt"):
+        # One pipeline over the whole backlog, so workers never sit idle
+        # waiting for the last big file of a day
+        return self.remux_ubv_files(self.plan_all(cameras, order), cameras)
+
+    def remux_ubv_files(self, ubv_files, cameras):
+        # Prepare, remux and move overlap: while one file is remuxed the
+        # next is being prepared and the previous one's MP4s are moved.
+        if self._recovery:
+            self.recover(ubv_files, cameras)
+        if self.config.remux_batch_files > 1:
+            items = self._batch_ubv_files(ubv_files)
+        else:
+            items = ubv_files
+        errors = self._run_pipeline(items, cameras, total=len(ubv_files))
+        if errors:
+            self.logger.warning(
+                f"{len(errors)} of {len(ubv_files)} files failed."
+            )
+        return errors
+
+    def iter_results(self, ubv_files, cameras):
+        # Runs the pipeline over any iterable of UBV entries, taking the
+        # next one only as workers free up, and yields a SegmentResult as
+        # each MP4 is moved and a FileResult as each UBV file finishes.
+        # Closing the generator early stops new files from starting, while
+        # those already started are finished. Batching needs the files up
+        # front, so each gets its own remux run here.
+        recovered = self.recover([], cameras) if self._recovery else set()
+        stop = threading.Event()
+        results = queue.Queue(maxsize=self.jobs + self.move_jobs)
+        errors = []
+
+        def _items():
+            for ubv_file in ubv_files:
+                if stop.is_set():
+                    return
+                if ubv_file['file'] in recovered:
+                    ubv_file['muxed'] = True
+                yield ubv_file
+
+        def _run():
+            try:
+                errors.extend(
+                    self._run_pipeline(_items(), cameras, batched=False)
+                )
+            finally:
+                results.put(None)
+        self._results = results
+        thread = threading.Thread(
+            target=_run, name="remux-results", daemon=True
+        )
+        thread.start()
+        try:
+            for record in iter(results.get, None):
+                yield record
+            for stage, item, e in errors:
+                # Files that failed before remux never reach _finish_job
+                if stage == "prepare":
+                    yield self._file_result(item, "failed", error=str(e))
+        finally:
+            stop.set()
+            # Workers block on a full queue, so keep it drained
+            while thread.is_alive():
+                try:
+                    results.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
+            self._results = None
+
+    def _emit(self, record):
+        if self._results is not None:
+            self._results.put(record)
+
+    def _file_result(self, ubv_file, status, job=None, error=None):
+        record = FileResult(
+            source=ubv_file['file'], status=status, error=error,
+            bytes_in=self._ubv_size(ubv_file),
+            **self.camera_labels(ubv_file['file'])
+        )
+        if job is not None:
+            record.outputs = list(job.outputs)
+            record.bytes_out = sum(map(self._file_size, job.outputs))
+            record.seconds = job.seconds
+            if job.result is not None:
+                record.returncode = job.result['returncode']
+        return record
+
+    def watch(self, watcher, cameras, stop, order="lpt", get_cameras=None,
+              on_group=None):
+        # Feeds files into one long running pipeline as the watcher finds
+        # them settled, until stop is set
+        if self._recovery:
+            self.recover([], cameras)
+        batched = self.config.remux_batch_files > 1
+
+        def _ready():
+            for paths in watcher.ready_groups(stop):
+                if get_cameras:
+                    # Shared with the move stage, so new cameras are seen.
+                    # An unreachable CloudKey keeps the cameras we have.
+                    try:
+                        cameras.update(get_cameras())
+                    except (Exception, SystemExit) as e:
+                        self.logger.warning(
+                            f"Could not refresh cameras, keeping "
+                            f"{len(cameras)} known ones: {e}"
+                        )
+                group = [
+                    x for x in map(self.inventory.entry, paths)
+                    if x and not x['muxed']
+                ]
+                group = plan_ubv_files(
+                    {0: group}, order=order, cameras=cameras,
+                    weights=getattr(self.config, 'camera_weights', None)
+                )
+                if on_group:
+                    on_group(group)
+                if batched:
+                    yield from self._batch_ubv_files(group)
+                else:
+                    yield from group
+        return self._run_pipeline(_ready(), cameras, batched=batched)
+
+    def _run_pipeline(self, items, cameras, total=None, batched=None):
+        self._processed = 0
+        self._total = total
+        self._progress_lock = threading.Lock()
+        self.cameras = cameras
+        if batched is None:
+            batched = self.config.remux_batch_files > 1
+        pipeline = Pipeline(name="remux")
+        if batched:
+            pipeline.add_stage(
+                "prepare", self._prepare_batch_stage,
+                workers=self.prepare_jobs)
+            pipeline.add_stage(
+                "remux", self._remux_batch_stage, workers=self.jobs)
+        else:
+            pipeline.add_stage(
+                "prepare", self._prepare_stage, workers=self.prepare_jobs)
+            pipeline.add_stage(
+                "remux", self._remux_stage, workers=self.jobs)
+        pipeline.add_stage(
+            "move", lambda job: self._move_stage(job, cameras),
+            workers=self.move_jobs)
+        errors = pipeline.run(items)
+        if self.leases:
+            # Anything left over belongs to files that failed part way
+            self.leases.release_all()
+        if self.journal:
+            self.journal.compact(self.temp)
+        return errors
+
+    def _prepare_stage(self, ubv_file):
+        if ubv_file['muxed']:
+            self.logger.debug(
+                f"Skipping {ubv_file['file']} - already remuxed"
+            )
+            self._emit(self._file_result(ubv_file, "skipped"))
+            return None
+        if not self.claim(ubv_file):
+            self._emit(self._file_result(ubv_file, "skipped"))
+            return None
+        if not ubv_file['prepared']:
+            self.logger.debug(
+                f"Preparing {ubv_file['file']} in {self.temp}"
+            )
+            start = time.monotonic()
+            prepared = False
+            try:
+                prepared = self._prepare_file(
+                    ubv_file, self.temp, profiler=self.profiler
+                )
+            finally:
+                seconds = time.monotonic() - start
+                self.metrics.record(
+                    "prepare", seconds, **self.camera_labels(ubv_file['file']),
+                    bytes_in=self._ubv_size(ubv_file),
+                    bytes_out=self._file_size(f"{ubv_file['file']}.txt"),
+                    failed=not prepared
+                )
+            if prepared:
+                ubv_file['prepared'] = True
+                if self.state:
+                    self.state.set_prepared(ubv_file['file'], seconds)
+            else:
+                self.logger.warning(
+                    f"Failed to prepare {ubv_file['file']}"
+                )
+        return ubv_file
+
+    @staticmethod
+    def _replay(journals):
+        # Merges what the runs behind journals left unfinished
+        runs = []
+        files = {}
+        for journal in journals:
+            journal_runs, journal_files = journal.replay()
+            runs.extend(journal_runs)
+            files.update(journal_files)
+        return runs, files
+
+    def recover(self, ubv_files, cameras):
+        # Reconciles what a crashed run left behind: finished MP4s still in
+        # its temp folder are moved, and files whose remux had completed
+        # are marked muxed. Anything else is remuxed again, but MP4s that
+        # were already moved aren't moved a second time.
+        runs, files = self._recovery
+        self._recovery = None
+        muxed = set()
+        for path, entry in files.items():
+            outputs = {k: v['output'] for k, v in entry['moved'].items()}
+            complete = True
+            for segment, size in entry['segments'].items():
+                if segment in outputs:
+                    continue
+                if not os.path.exists(segment) or (
+                    size is not None and self._file_size(segment) != size
+                ):
+                    complete = False
+                    continue
+                try:
+                    duration = self.verify_segment({"path": segment})
+                    mp4dict = self.parse_mp4(segment, cameras)
+                    mp4dict['duration'] = duration
+                    outputs[segment] = self.move_mp4(mp4dict)
+                except (ValueError, OSError) as e:
+                    self.logger.warning(f"Could not recover {segment}: {e}")
+                    complete = False
+                    continue
+                self._journal(
+                    "moved", path, path=segment, output=outputs[segment],
+                    size=size
+                )
+            if entry['returncode'] == 0 and complete and outputs:
+                self.logger.info(
+                    f"Recovered {path} from an interrupted run."
+                )
+                self._set_file_muxed({"file": path}, list(outputs.values()))
+                muxed.add(path)
+            else:
+                self._resumed[path] = {
+                    v: self._file_size(v) for v in outputs.values()
+                }
+        for temp in runs:
+            if temp != self.temp and os.path.isdir(temp):
+                self.logger.info(f"Removing temp folder {temp} left behind.")
+                shutil.rmtree(temp)
         for ubv_file in ubv_files:
-            self.logger.info(
-                f"Processing File {ubv_files.index(ubv_file) + 1} "
-                f"of {len(ubv_files)}"
-            )
-            mp4_files = self.remux_file(ubv_file)
-            if mp4_files:
-                for mp4_file in mp4_files:
-                    mp4dict = self.parse_mp4(mp4_file, cameras)
-                    result = self.move_mp4(mp4dict)  # noqa: F841
+            if ubv_file['file'] in muxed:
+                ubv_file['muxed'] = True
+        for journal in self._stale:
+            journal.discard()
+        self._stale = []
+        if self.journal:
+            self.journal.compact(self.temp)
+        return muxed
+
+    def _journal(self, event, ubv_path, **fields):
+        if self.journal:
+            self.journal.write(event, ubv_path, **fields)
+
+    def claim(self, ubv_file):
+        # Without UBV_LEASE_DIR every file is ours
+        if not self.leases:
+            return True
+        name = self._lease_name(ubv_file)
+        if not self.leases.claim(name):
+            self.logger.debug(
+                f"Skipping {ubv_file['file']} - claimed by another host"
+            )
+            return False
+        # Another host may have finished it since the tree was scanned
+        if os.path.exists(f"{ubv_file['file']}.muxed"):
+            self.logger.debug(
+                f"Skipping {ubv_file['file']} - remuxed by another host"
+            )
+            ubv_file['muxed'] = True
+            self.leases.release(name)
+            return False
+        return True
+
+    def release(self, ubv_file):
+        if self.leases:
+            self.leases.release(self._lease_name(ubv_file))
+
+    def holds_lease(self, ubv_file):
+        # False once another host has taken over the file's lease
+        if not self.leases:
+            return True
+        return self.leases.held(self._lease_name(ubv_file))
+
+    def check_lease(self, ubv_file, segment):
+        # A segment of a file whose lease was lost is dropped rather than
+        # moved, as the new holder remuxes the file again
+        if self.holds_lease(ubv_file):
+            return
+        try:
+            os.remove(segment['path'])
+        except FileNotFoundError:
+            pass
+        raise LeaseLost(f"Lost the lease on {ubv_file['file']}")
+
+    def _lease_name(self, ubv_file):
+        # Relative, as each host may mount the share somewhere else
+        return os.path.relpath(ubv_file['file'], self.config.files)
+
+    def _prepare_batch_stage(self, batch):
+        batch = [x for x in map(self._prepare_stage, batch) if x]
+        return batch or None
+
+    def _batch_ubv_files(self, ubv_files):
+        # Groups files by camera in recording order, split by the file
+        # count and byte budget. Files without a start time go alone.
+        batches = []
+        cameras = {}
+        for ubv_file in ubv_files:
+            if ubv_file['muxed'] or ubv_start(ubv_file['file']) is None:
+                batches.append([ubv_file])
+                continue
+            mac = os.path.basename(ubv_file['file']).split('_', 1)[0]
+            cameras.setdefault(mac, []).append(ubv_file)
+        budget = self.config.remux_batch_bytes
+        for mac, files in sorted(cameras.items()):
+            batch = []
+            size = 0
+            for ubv_file in sorted(files, key=lambda x: ubv_start(x['file'])):
+                ubv_size = self._ubv_size(ubv_file)
+                if batch and (
+                    len(batch) >= self.config.remux_batch_files
+                    or (budget and size + ubv_size > budget)
+                ):
+                    batches.append(batch)
+                    batch = []
+                    size = 0
+                batch.append(ubv_file)
+                size += ubv_size
+            if batch:
+                batches.append(batch)
+        # Batches start in the order their first file was planned in
+        position = {id(x): i for i, x in enumerate(ubv_files)}
+        batches.sort(key=lambda x: min(position[id(y)] for y in x))
+        self.logger.debug(
+            f"Grouped {len(ubv_files)} files into {len(batches)} batches."
+        )
+        return batches
+
+    def _ubv_size(self, ubv_file):
+        if 'size' not in ubv_file:
+            ubv_file['size'] = self._file_size(ubv_file['file'])
+        return ubv_file['size']
+
+    def _remux_stage(self, ubv_file):
+        # Every job gets its own folder so concurrent remux runs never
+        # write their MP4 files on top of each other. Segments are handed
+        # to the move stage as soon as remux moves on to the next one.
+        job = RemuxJob(ubv_file, tempfile.mkdtemp(dir=self.temp))
+        yield from self._remux_job(job)
+
+    def _remux_job(self, job):
+        ubv_file = job.ubv_file
+        result = None
+        self._admit(job.temp, self._ubv_size(ubv_file))
+        self._journal("start", ubv_file['file'], temp=job.temp)
+        try:
+            for event, record in self._stream_remux(
+                ubv_file, job.temp, profiler=self.profiler
+            ):
+                if event == "segment":
+                    self._consumed(job.temp, record)
+                    self._journal(
+                        "segment", ubv_file['file'], path=record['path'],
+                        size=record.get('size')
+                    )
+                    job.add_segment()
+                    yield {"job": job, "segment": record}
+                else:
+                    result = record
+        except Exception:
+            self.metrics.record(
+                "remux", job.seconds, **self.camera_labels(ubv_file['file']),
+                bytes_in=self._ubv_size(ubv_file), failed=True
+            )
+            yield {"job": job, "segment": None, "result": None}
+            raise
+        self.metrics.record(
+            "remux", result['seconds'], **self.camera_labels(ubv_file['file']),
+            bytes_in=self._ubv_size(ubv_file),
+            bytes_out=sum(x.get('size') or 0 for x in result['outputs']),
+            failed=result['returncode'] != 0
+        )
+        self._journal(
+            "remuxed", ubv_file['file'], returncode=result['returncode']
+        )
+        yield {"job": job, "segment": None, "result": result}
+        if self.state:
+            self.state.set_remuxed(ubv_file['file'], result['seconds'])
+
+    def _remux_batch_stage(self, batch):
+        # One remux run for the whole batch. Each MP4 belongs to the last
+        # UBV file that started before it. If remux fails, files that had
+        # already finished are kept and the rest are remuxed one by one.
+        if len(batch) == 1:
+            yield from self._remux_stage(batch[0])
+            return
+        temp = tempfile.mkdtemp(dir=self.temp)
+        shared = RemuxBatch(temp, len(batch))
+        jobs = [RemuxJob(x, temp, batch=shared) for x in batch]
+        self._admit(temp, sum(self._ubv_size(x) for x in batch))
+        for job in jobs:
+            self._journal("start", job.ubv_file['file'], temp=temp)
+        starts = [ubv_start(x['file']) for x in batch]
+        segments = {id(job): [] for job in jobs}
+        result = None
+        current = 0
+        try:
+            for event, record in self._run_remux(
+                [x['file'] for x in batch], temp, profiler=self.profiler
+            ):
+                if event == "segment":
+                    index = self._segment_source(record['path'], starts)
+                    current = max(current, index)
+                    job = jobs[index]
+                    self._consumed(temp, record)
+                    self._journal(
+                        "segment", job.ubv_file['file'], path=record['path'],
+                        size=record.get('size')
+                    )
+                    segments[id(job)].append(record)
+                    job.add_segment()
+                    yield {"job": job, "segment": record}
+                else:
+                    result = record
+        except Exception:
+            for job in jobs:
+                yield {"job": job, "segment": None, "result": None}
+            raise
+        if result['returncode'] == 0:
+            done = len(jobs)
+        else:
+            self.logger.warning(
+                f"Batched remux of {len(batch)} files exited with "
+                f"{result['returncode']}, retrying them one at a time."
+            )
+            done = current
+        share = result['seconds'] / len(batch)
+        for job in jobs[:done]:
+            outputs = segments[id(job)]
+            self.metrics.record(
+                "remux", share, **self.camera_labels(job.ubv_file['file']),
+                bytes_in=self._ubv_size(job.ubv_file),
+                bytes_out=sum(x.get('size') or 0 for x in outputs)
+            )
+            self._journal("remuxed", job.ubv_file['file'], returncode=0)
+            yield {"job": job, "segment": None, "result": dict(
+                result, file=job.ubv_file['file'], returncode=0,
+                outputs=outputs, seconds=share
+            )}
+            if self.state:
+                self.state.set_remuxed(job.ubv_file['file'], share)
+        for job in jobs[done:]:
+            # Kept apart from MP4s of the batch that are still being moved
+            job.temp = tempfile.mkdtemp(dir=temp)
+            yield from self._remux_job(job)
+
+    def _admit(self, temp, ubv_bytes):
+        # Waits for space for the MP4s this remux run is going to write
+        if self.admission:
+            self.admission.admit(temp, ubv_bytes)
+
+    def _consumed(self, temp, segment):
+        if self.admission:
+            self.admission.consumed(temp, segment.get('size') or 0)
+
+    def _remove_job_temp(self, temp):
+        if self.admission:
+            self.admission.release(temp)
+        self._remove_worker_temp(temp)
+
+    @staticmethod
+    def _segment_source(mp4_file, starts):
+        name = os.path.splitext(os.path.basename(mp4_file))[0]
+        try:
+            stamp = parse_mp4_name(name)[1].timestamp()
+        except (ValueError, OverflowError):
+            return 0
+        index = 0
+        for i, start in enumerate(starts):
+            # MP4 names only carry whole seconds
+            if int(start) <= stamp:
+                index = i
+        return index
+
+    def _move_stage(self, item, cameras):
+        job = item['job']
+        if item['segment'] is None:
+            if job.remux_done(item['result']):
+                self._finish_job(job)
+            return item
+        output = None
+        duration = None
+        error = None
+        segment = item['segment']
+        start = time.monotonic()
+        try:
+            self.check_lease(job.ubv_file, segment)
+            duration = self.verify_segment(segment)
+            mp4dict = self.parse_mp4(segment['path'], cameras)
+            mp4dict['duration'] = duration
+            output = self._skip_resumed(job.ubv_file, mp4dict, segment) \
+                or self.move_mp4(mp4dict)
+            self._journal(
+                "moved", job.ubv_file['file'], path=segment['path'],
+                output=output, size=segment.get('size')
+            )
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            size = segment.get('size') or 0
+            seconds = time.monotonic() - start
+            labels = self.camera_labels(segment['path'])
+            self.metrics.record(
+                "move", seconds, **labels,
+                bytes_in=size, bytes_out=size if output else 0,
+                failed=output is None, media_seconds=duration
+            )
+            self._emit(SegmentResult(
+                source=job.ubv_file['file'], segment=segment['path'],
+                output=output, bytes=size, duration=duration,
+                remux_seconds=segment.get('seconds'), move_seconds=seconds,
+                error=error, **labels
+            ))
+            if job.segment_done(output):
+                self._finish_job(job)
+        return item
+
+    def verify_segment(self, segment):
+        # Returns the duration of a complete MP4 from its headers. One left
+        # truncated is removed and raises MP4FormatError, so its UBV file
+        # isn't marked muxed.
+        if not getattr(self.config, 'verify_mp4', True):
+            return None
+        try:
+            return read_mp4(segment['path'])['duration']
+        except MP4FormatError:
+            self.logger.warning(f"Removing incomplete {segment['path']}")
+            try:
+                os.remove(segment['path'])
+            except FileNotFoundError:
+                pass
+            raise
+
+    def _skip_resumed(self, ubv_file, mp4dict, segment):
+        # An MP4 moved before a crash is dropped rather than moved again
+        resumed = self._resumed.get(ubv_file['file'])
+        if not resumed:
+            return None
+        output = os.path.join(
+            mp4dict['output']['path'], mp4dict['output']['filename']
+        )
+        if output in resumed and os.path.exists(output) \
+                and resumed[output] == segment.get('size') \
+                and self._file_size(output) == resumed[output]:
+            self.logger.debug(f"Keeping {output} from an interrupted run")
+            os.remove(segment['path'])
+            return output
+        return None
+
+    def _finish_job(self, job):
+        ubv_file = job.ubv_file
+        result = job.result
+        error = None
+        try:
+            if result is None:
+                error = "Remux did not complete."
+            elif result['returncode'] != 0:
+                error = f"Remux exited with {result['returncode']}."
+            elif job.failed:
+                error = "Not all MP4 files were moved."
+            elif job.outputs and not self.holds_lease(ubv_file):
+                error = "Lost the lease before it was marked muxed."
+            elif job.outputs:
                 self.logger.info(
                     f"Marking {ubv_file['file']} as muxed."
                 )
-                self._set_file_muxed(ubv_file)
+                self._set_file_muxed(ubv_file, job.outputs, job.seconds)
+            else:
+                error = "Remux wrote no MP4 files."
+            if error:
+                self.logger.warning(f"{ubv_file['file']}: {error}")
+        finally:
+            self._journal("done", ubv_file['file'])
+            self._resumed.pop(ubv_file['file'], None)
+            self.release(ubv_file)
+            if job.batch is None:
+                self._remove_job_temp(job.temp)
+            else:
+                if job.temp != job.batch.temp:
+                    self._remove_job_temp(job.temp)
+                if job.batch.job_finished():
+                    self._remove_job_temp(job.batch.temp)
+            with self._progress_lock:
+                self._processed += 1
+                self.logger.info(
+                    f"Processed File {self._processed}"
+                    + (f" of {self._total}" if self._total else "")
+                )
+            self._emit(self._file_result(
+                ubv_file, "muxed" if ubv_file['muxed'] else "failed",
+                job=job, error=error
+            ))
+
+    def _remove_worker_temp(self, worker_temp):
+        if len(os.listdir(worker_temp)) == 0:
+            os.rmdir(worker_temp)
+        else:
+            self.logger.warning(
+                f"Leaving {worker_temp} in place due to remaining files."
+            )
 
     def get_ubv_by_date(self, date):
         self.logger.debug(f"Getting UBV files by date {date}.")
-        ubv_files = self.get_ubv_files()
         if isinstance(date, str):
             try:
                 date = parser.parse(date)
             except parser.ParserError:
                 raise ValueError(f"Couldn't parse {date}")
             date = date.date()
-        if date in ubv_files:
+        if date >= self._min_age_date():
+            self.logger.debug(
+                f"{date} is newer than {self.config.min_age} days."
+            )
+            return None
+        # Only the one day folder is checked, not the whole tree
+        ubv_files = self.inventory.refresh_date(date)
+        if ubv_files:
             self.logger.debug(
-                f"Returning {len(ubv_files[date])} files for {date}"
+                f"Returning {len(ubv_files)} files for {date}"
             )
-            return ubv_files[date]
+        return ubv_files
 
     def get_ubv_files(self, filter_age=True):
         self.logger.debug(
             f"Getting UBV files from {self.config.files}"
         )
-        filelist = {}
-        for root, folder, files in os.walk(self.config.files):
-            if len(files) > 0:
-                y, m, d = [int(x) for x in root.split(os.path.sep)[-3:]]
-                filedate = date(y, m, d)
-                # Find if any have been prepared
-                ubv = [x for x in files if x.endswith('.ubv')]
-                txt = [x for x in files if x.endswith('.txt')]
-                muxed = [x for x in files if x.endswith('.muxed')]
-                # This returns a list of dicts.
-                # - prepared = True if the file has indices created.
-                # - muxed = True if the file already has been remuxed
-                remux_list = [
-                    {
-                        "file": os.path.join(root, x),
-                        "prepared": (f"{x}.txt" in txt),
-                        "muxed": (f"{x}.muxed" in muxed)
-                    } for x in ubv
-                ]
-                # Add them to the list
-                filelist[filedate] = remux_list
+        filelist = self.inventory.refresh()
         # Filter down where filedate > min_age if true
         if filter_age:
-            min_age_date = (
-                date.today() - timedelta(days=self.config.min_age)
-            )
+            min_age_date = self._min_age_date()
             self.logger.debug(
                 "Filtering for files older than "
                 f"{self.config.min_age} days."
@@ -109,70 +948,193 @@ class UBVRemux():
         )
         return filelist
 
-    def get_ubv_filecounts(self, cameras):
+    def _min_age_date(self):
+        return date.today() - timedelta(days=self.config.min_age)
+
+    def count_ubv_files(self, cameras):
+        # One pass over the inventory, bucketed by date and camera MAC
+        counts = {}
+        ubv_files = self.get_ubv_files(filter_age=False)
+        for dk, ubvf in ubv_files.items():
+            for x in ubvf:
+                mac = os.path.basename(x['file']).split('_', 1)[0]
+                row = counts.get((dk, mac))
+                if row is None:
+                    row = counts[(dk, mac)] = {
+                        "date": dk.strftime("%F"),
+                        "mac": mac,
+                        "camera": cameras.get(mac, {}).get('name'),
+                        "files": 0,
+                        "bytes": 0,
+                        "prepared": 0,
+                        "muxed": 0
+                    }
+                row['files'] += 1
+                row['bytes'] += x.get('size') or 0
+                row['prepared'] += int(bool(x['prepared']))
+                row['muxed'] += int(bool(x['muxed']))
+        return [counts[k] for k in sorted(counts)]
+
+    def get_ubv_filecounts(self, cameras, output_format="table", out=None):
+        out = out or sys.stdout
+        rows = self.count_ubv_files(cameras)
+        if output_format == "json":
+            totals = {
+                k: sum(x[k] for x in rows)
+                for k in ('files', 'bytes', 'prepared', 'muxed')
+            }
+            json.dump({"rows": rows, "totals": totals}, out, indent=2)
+            out.write("\n")
+        elif output_format == "csv":
+            writer = csv.DictWriter(out, fieldnames=list(FILECOUNT_FIELDS))
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            self.logger.info("Found the following files:")
+            print(self._filecount_table(rows, cameras), file=out)
+        return rows
+
+    @staticmethod
+    def _filecount_table(rows, cameras):
         # Build a table to pretty print
         camera_list = sorted(list(cameras.keys()))
+        unknown = any(x['mac'] not in cameras for x in rows)
         header = [cameras[c]['name'] for c in camera_list]
         header.insert(0, 'Date')
-        header.append('Total')
-        # Build the table
+        if unknown:
+            header.append('Unknown')
+        header.extend(['Total', 'Prepared', 'Muxed', 'Bytes'])
         table = PrettyTable(header)
-        ubv_files = self.get_ubv_files(filter_age=False)
-        for dk in sorted(ubv_files.keys()):
-            ds = dk.strftime("%F")
-            ubvf = ubv_files[dk]
+        by_date = {}
+        for x in rows:
+            by_date.setdefault(x['date'], []).append(x)
+        for ds in sorted(by_date):
+            by_mac = {x['mac']: x for x in by_date[ds]}
             row = [ds]
-            row_total = 0
-            for camera in camera_list:
-                # Get the counts
-                cam_files = [
-                    x for x in ubvf
-                    if os.path.split(x['file'])[-1].startswith(camera)
-                ]
-                row.append(len(cam_files))
-                row_total = row_total + len(cam_files)
-            row.append(row_total)
+            row.extend(
+                by_mac[c]['files'] if c in by_mac else 0 for c in camera_list
+            )
+            if unknown:
+                row.append(sum(
+                    x['files'] for x in by_date[ds] if x['mac'] not in cameras
+                ))
+            for k in ('files', 'prepared', 'muxed', 'bytes'):
+                row.append(sum(x[k] for x in by_date[ds]))
             table.add_row(row)
-        self.logger.info("Found the following files:")
-        print(table)
+        return table
 
-    def remux_file(self, ubv_file):
+    def remux_file(self, ubv_file, temp_path=None):
+        temp_path = temp_path or self.temp
         if ubv_file['muxed']:
             self.logger.debug(
                 f"Skipping {ubv_file['file']} - already remuxed"
             )
-            mp4_files = None
+            result = None
         else:
             self.logger.debug(
                 f"Performing remux against {ubv_file['file']} "
-                f"in {self.temp}"
+                f"in {temp_path}"
+            )
+            result = self._remux(
+                ubv_file, temp_path, profiler=self.profiler
             )
-            mp4_files = self._remux(ubv_file, self.temp)
-        return mp4_files
+        return result
+
+    @classmethod
+    def _remux(cls, ubv_file, temp_path, on_segment=None, profiler=None):
+        result = None
+        for event, record in cls._stream_remux(
+            ubv_file, temp_path, profiler=profiler
+        ):
+            if event == "segment" and on_segment:
+                on_segment(record)
+            elif event == "exit":
+                result = record
+        return result
+
+    @staticmethod
+    def _stream_remux(ubv_file, temp_path, profiler=None):
+        for event, record in UBVRemux._run_remux(
+            [ubv_file['file']], temp_path, profiler=profiler
+        ):
+            if event == "exit":
+                record['file'] = ubv_file['file']
+            yield event, record
 
     @staticmethod
-    def _remux(ubv_file, temp_path):
+    def _run_remux(ubv_paths, temp_path, profiler=None):
+        # Yields ("segment", record) for each MP4 once remux has moved on
+        # past it, then ("exit", result) when the process ends. Both pipes
+        # are drained as output arrives so remux can never block on them.
         args = [
-            "remux", "-with-audio", "-output-folder",
-            temp_path, ubv_file['file']
+            "remux", "-with-audio", "-output-folder", temp_path, *ubv_paths
         ]
+        start = time.time()
+        started = time.monotonic()
         r = subprocess.Popen(
             args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
         )
-        result = r.stderr.read()
-        output_files = [
-            x for x in str(result).split('\\n')
-            if x.startswith('Writing MP4')
+        lines = queue.Queue()
+
+        def _reader(stream):
+            for line in iter(stream.readline, b''):
+                lines.put(line)
+            stream.close()
+            lines.put(None)
+        readers = [
+            threading.Thread(target=_reader, args=(x,), daemon=True)
+            for x in (r.stdout, r.stderr)
         ]
-        if len(output_files) > 0:
-            mp4_files = [
-                next(
-                    (y for y in x.split(' ') if temp_path in y), None
-                ) for x in output_files
-            ]
+        for reader in readers:
+            reader.start()
+        outputs = []
+        current = None
+        open_pipes = len(readers)
+        while open_pipes:
+            line = lines.get()
+            if line is None:
+                open_pipes -= 1
+                continue
+            mp4_file = parse_remux_line(line, temp_path)
+            if mp4_file is None:
+                continue
+            now = time.time()
+            if current:
+                current.update(
+                    finished=now, seconds=now - current['started'],
+                    size=UBVRemux._file_size(current['path'])
+                )
+                yield "segment", current
+            current = {"path": mp4_file, "started": now}
+            outputs.append(current)
+        if profiler:
+            returncode = profiler.wait(
+                r, "remux", " ".join(ubv_paths), started
+            )
         else:
-            mp4_files = None
-        return mp4_files
+            returncode = r.wait()
+        for reader in readers:
+            reader.join()
+        end = time.time()
+        if current:
+            current.update(
+                finished=end, seconds=end - current['started'],
+                size=UBVRemux._file_size(current['path'])
+            )
+            # A segment still being written when remux failed is partial
+            if returncode == 0:
+                yield "segment", current
+            else:
+                outputs.remove(current)
+                if os.path.exists(current['path']):
+                    os.remove(current['path'])
+        yield "exit", {
+            "returncode": returncode,
+            "outputs": outputs,
+            "started": start,
+            "finished": end,
+            "seconds": end - start
+        }
 
     def prepare_ubv_files(self, ubv_files):
         t = len(ubv_files)
@@ -202,57 +1164,131 @@ class UBVRemux():
         )
         output_path = mp4dict['output']['path']
         output_file = mp4dict['output']['filename']
-        if not os.path.exists(output_path):
-            self.logger.debug(
-                f"Creating output path {output_path}"
-            )
-            os.makedirs(output_path, exist_ok=True)
+        self._make_output_dir(output_path)
         output_filepath = os.path.join(
             output_path, output_file
         )
         self.logger.debug(
             f"Moving MP4 file to {output_filepath}"
         )
-        newpath = shutil.move(
-            source_path, output_filepath
+        size = os.path.getsize(source_path)
+        kind = move_file(
+            source_path, output_filepath, verify=self.config.verify_copy
+        )
+        with self._move_lock:
+            self.move_stats[kind] += 1
+            if kind == "copy":
+                self.move_stats['bytes_copied'] += size
+        self._catalog_segment(mp4dict, output_filepath, size)
+        return output_filepath
+
+    def _catalog_segment(self, mp4dict, output_filepath, size):
+        # A catalog that can't be written is rebuilt later, the move stands
+        if not self.catalog or 'camera' not in mp4dict:
+            return
+        try:
+            self.catalog.add(
+                output_filepath, mp4dict['camera']['name'],
+                mp4dict['start'].strftime(START_FORMAT),
+                mac=mp4dict['camera']['mac'], size=size,
+                duration=mp4dict.get('duration')
+            )
+        except sqlite3.Error as e:
+            self.logger.warning(f"Cannot catalog {output_filepath}: {e}")
+
+    def find_segments(self, camera, start, end, output_format="table",
+                      out=None):
+        out = out or sys.stdout
+        rows = self.catalog.find(camera, start, end)
+        if output_format == "json":
+            json.dump(rows, out, indent=2)
+            out.write("\n")
+        elif output_format == "csv":
+            writer = csv.DictWriter(out, fieldnames=list(SEGMENT_FIELDS))
+            writer.writeheader()
+            writer.writerows(
+                {k: x[k] for k in SEGMENT_FIELDS} for x in rows
+            )
+        else:
+            self.logger.info(
+                f"Found {len(rows)} segments of {camera} between "
+                f"{start} and {end}:"
+            )
+            table = PrettyTable(
+                ['Camera', 'MAC', 'Start', 'Duration', 'Bytes', 'Path']
+            )
+            for x in rows:
+                table.add_row([x[k] for k in SEGMENT_FIELDS])
+            print(table, file=out)
+        return rows
+
+    def move_mp4_files(self, mp4_files, cameras):
+        # Moves a batch of MP4s, skipping any from unknown cameras
+        plan = self.plan_mp4_files(mp4_files, cameras)
+        for output_path in {x['output']['path'] for x in plan['planned']}:
+            self._make_output_dir(output_path)
+        plan['moved'] = [self.move_mp4(x) for x in plan['planned']]
+        return plan
+
+    def _make_output_dir(self, output_path):
+        # Each date/camera folder is only created once per run
+        if output_path in self._output_dirs:
+            return
+        self.logger.debug(
+            f"Creating output path {output_path}"
         )
-        return newpath
+        os.makedirs(output_path, exist_ok=True)
+        self._output_dirs.add(output_path)
 
     def parse_mp4(self, mp4_file, cameras):
         self.logger.debug(
             f"Parsing MP4 File {mp4_file}"
         )
-        # Parse the filename
-        filepath, filename = os.path.split(mp4_file)
-        filename, ext = os.path.splitext(filename)
-        # Get the camera ID and date
-        file_mac = filename.split('_')[0]
-        file_date = filename.split('_')[-1].replace('.', ':')
-        file_date = parser.parse(file_date)
-        # Identify which camera it's from
-        if file_mac in cameras:
-            file_camera = cameras[file_mac]
-            self.logger.debug(
-                f"Identified Camera: {filename} -> {file_camera['name']}"
-            )
-        else:
+        mp4dict = self._plan_mp4(mp4_file, cameras)
+        if mp4dict is None:
+            file_mac = os.path.basename(mp4_file).split('_')[0]
             raise ValueError(
-                f"Cannot identify {file_mac}. Is this a valid camera?"
-                "Options: {cameras}"
+                f"Cannot identify {file_mac}. Is this a valid camera? "
+                f"Options: {', '.join(cameras)}"
             )
-        output_path = os.path.join(
-            self.config.output,
-            file_date.strftime("%Y-%m-%d"),
-            file_camera['name']
+        self.logger.debug(
+            f"Setting output path: {mp4dict['output']['path']}"
         )
-        self.logger.debug(f"Setting output path: {output_path}")
-        of = "_".join([
-            file_camera['name'],
-            file_date.strftime("%Y-%m-%d_%H-%M-%S")
-        ])
-        output_file = f"{of}{ext}"
-        self.logger.debug(f"Setting output name: {output_file}")
-        mp4dict = {
+        self.logger.debug(
+            f"Setting output name: {mp4dict['output']['filename']}"
+        )
+        return mp4dict
+
+    def plan_mp4_files(self, mp4_files, cameras):
+        # Plans the output of a batch of MP4s, collecting every file from
+        # an unknown camera rather than failing on the first one.
+        planned = []
+        unknown = {}
+        for mp4_file in mp4_files:
+            mp4dict = self._plan_mp4(mp4_file, cameras)
+            if mp4dict is None:
+                file_mac = os.path.basename(mp4_file).split('_')[0]
+                unknown.setdefault(file_mac, []).append(mp4_file)
+            else:
+                planned.append(mp4dict)
+        if unknown:
+            self.logger.warning(
+                f"Cannot identify cameras {', '.join(sorted(unknown))} "
+                f"for {sum(len(x) for x in unknown.values())} MP4 files."
+            )
+        return {"planned": planned, "unknown": unknown}
+
+    def _plan_mp4(self, mp4_file, cameras):
+        filepath, filename = os.path.split(mp4_file)
+        filename, ext = os.path.splitext(filename)
+        file_mac, file_date = parse_mp4_name(filename)
+        file_camera = cameras.get(file_mac)
+        if file_camera is None:
+            return None
+        stamp = file_date.strftime("%Y-%m-%d_%H-%M-%S")
+        return {
+            "camera": {"mac": file_mac, "name": file_camera['name']},
+            "start": file_date,
             "file": {
                 "path": mp4_file,
                 "folder": filepath,
@@ -260,27 +1296,45 @@ class UBVRemux():
                 "ext": ext
             },
             "output": {
-                "path": output_path,
-                "filename": output_file
+                "path": os.path.join(
+                    self.config.output, stamp[:10], file_camera['name']
+                ),
+                "filename": f"{file_camera['name']}_{stamp}{ext}"
             }
         }
-        self.logger.debug(f"Returning dict for {mp4_file}")
-        return mp4dict
 
-    @staticmethod
-    def _set_file_muxed(ubv_file):
-        muxed_filepath = f"{ubv_file['file']}.muxed"
-        Path(muxed_filepath).touch()
+    def _set_file_muxed(self, ubv_file, outputs=None, seconds=None):
+        ubv_file['muxed'] = True
+        record = None
+        if getattr(self.config, 'fingerprint', True):
+            try:
+                record = fingerprint_record(ubv_file['file'])
+            except OSError as e:
+                self.logger.warning(
+                    f"Cannot fingerprint {ubv_file['file']}: {e}"
+                )
+        if self.state:
+            # The state store replaces the .muxed sentinel file
+            self.state.set_muxed(ubv_file['file'], outputs, seconds, record)
+        if not self.state or self.leases:
+            # Other hosts only see the sentinel file
+            write_sentinel(f"{ubv_file['file']}.muxed", record)
 
     @staticmethod
-    def _prepare_file(ubv_file, temp_path):
+    def _prepare_file(ubv_file, temp_path, profiler=None):
         ubv_filepath, ubv_filename = os.path.split(ubv_file['file'])
         stdout_file = f"{ubv_filename}.txt"
         stdout_path = os.path.join(temp_path, stdout_file)
         with open(stdout_path, 'wb') as out:
             args = ['ubnt_ubvinfo', '-P', '-f', ubv_file['file']]
+            started = time.monotonic()
             p = subprocess.Popen(args, stdout=out, cwd=temp_path)
-            result = p.wait()
+            if profiler:
+                result = profiler.wait(
+                    p, "ubnt_ubvinfo", ubv_file['file'], started
+                )
+            else:
+                result = p.wait()
         if result == 0:
             success = shutil.move(
                 stdout_path, os.path.join(ubv_filepath, stdout_file)
@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import functools
+
+
+class Profiler():
+    # Collects resource usage for every ubnt_ubvinfo/remux child through
+    # os.wait4, and cProfile data for instrumented Python stages. When
+    # stages nest on one thread the outer one is paused, so each stage's
+    # pstats only holds its own time.
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.logger = logging.getLogger(__name__)
+        self.children = []
+        self._profiles = {}
+        # Calls per stage that ran without a profiler
+        self.unprofiled = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def wait(self, proc, tool, target, started=None):
+        # Reaps proc with os.wait4 so its rusage can be kept
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        record = {
+            "tool": tool,
+            "file": target,
+            "returncode": proc.returncode,
+            "user_seconds": usage.ru_utime,
+            "system_seconds": usage.ru_stime,
+            # Linux reports ru_maxrss in KiB
+            "max_rss_kb": usage.ru_maxrss,
+            "wall_seconds": time.monotonic() - started if started else None
+        }
+        with self._lock:
+            self.children.append(record)
+        self.logger.debug(
+            f"{tool} on {target}: {record['user_seconds']:.1f}s user, "
+            f"{record['system_seconds']:.1f}s sys, "
+            f"{record['max_rss_kb']} KiB peak RSS"
+        )
+        return proc.returncode
+
+    def instrument(self, obj, name, stage):
+        func = getattr(obj, name)
+
+        @functools.wraps(func)
+        def _profiled(*args, **kwargs):
+            return self.call(stage, func, *args, **kwargs)
+        setattr(obj, name, _profiled)
+        return _profiled
+
+    def call(self, stage, func, *args, **kwargs):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        if stack and stack[-1][1]:
+            stack[-1][1].disable()
+        profile = self._profile(stage)
+        if not self._enable(stage, profile):
+            profile = None
+        stack.append([stage, profile])
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _, profile = stack.pop()
+            if profile:
+                profile.disable()
+            if stack and stack[-1][1] and \
+                    not self._enable(stack[-1][0], stack[-1][1]):
+                stack[-1][1] = None
+
+    def _enable(self, stage, profile):
+        # From Python 3.12 cProfile allows one active profiler per process,
+        # so a stage that starts while another thread is being profiled
+        # runs unprofiled rather than failing
+        try:
+            profile.enable()
+            return True
+        except ValueError:
+            with self._lock:
+                self.unprofiled[stage] = self.unprofiled.get(stage, 0) + 1
+            return False
+
+    def _profile(self, stage):
+        key = (stage, threading.get_ident())
+        with self._lock:
+            if key not in self._profiles:
+                self._profiles[key] = cProfile.Profile()
+            return self._profiles[key]
+
+    def write_report(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        with self._lock:
+            stages = {}
+            for (stage, _), profile in self._profiles.items():
+                stages.setdefault(stage, []).append(profile)
+            children = list(self.children)
+            unprofiled = dict(self.unprofiled)
+        for stage, profiles in stages.items():
+            path = os.path.join(self.output_dir, f"{stage}.pstats")
+            stats = None
+            for profile in profiles:
+                try:
+                    if stats is None:
+                        stats = pstats.Stats(profile)
+                    else:
+                        stats.add(profile)
+                except TypeError:
+                    # Never enabled, every call on its thread ran unprofiled
+                    continue
+            if stats is None:
+                continue
+            stats.dump_stats(path)
+            self.logger.info(f"Wrote {stage} profile to {path}")
+        for stage, count in unprofiled.items():
+            self.logger.info(
+                f"{stage}: {count} calls ran unprofiled while another "
+                "thread was being profiled"
+            )
+        tools = {}
+        for child in children:
+            totals = tools.setdefault(child['tool'], {
+                "processes": 0, "user_seconds": 0.0, "system_seconds": 0.0,
+                "max_rss_kb": 0, "max_rss_file": None
+            })
+            totals['processes'] += 1
+            totals['user_seconds'] += child['user_seconds']
+            totals['system_seconds'] += child['system_seconds']
+            if child['max_rss_kb'] > totals['max_rss_kb']:
+                totals['max_rss_kb'] = child['max_rss_kb']
+                totals['max_rss_file'] = child['file']
+        report = {"tools": tools, "children": children}
+        path = os.path.join(self.output_dir, "children.json")
+        with open(path, 'w') as fh:
+            json.dump(report, fh, indent=2)
+        for tool, totals in tools.items():
+            self.logger.info(
+                f"{tool}: {totals['processes']} runs, "
+                f"{totals['user_seconds']:.1f}s user, "
+                f"{totals['system_seconds']:.1f}s sys, peak RSS "
+                f"{totals['max_rss_kb']} KiB on {totals['max_rss_file']}"
+            )
+        return report
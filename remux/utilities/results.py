@@ -0,0 +1,43 @@
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+# Records yielded by UBVRemux.iter_results. Errors are kept as messages so
+# records can be logged or serialised as they are.
+
+
+@dataclass
+class SegmentResult:
+    # One MP4 written by remux, once it has been moved or has failed
+    source: str
+    segment: str
+    mac: str
+    camera: Optional[str]
+    output: Optional[str]
+    bytes: int
+    duration: Optional[float]
+    remux_seconds: Optional[float]
+    move_seconds: float
+    error: Optional[str] = None
+
+    @property
+    def ok(self):
+        return self.output is not None
+
+
+@dataclass
+class FileResult:
+    # One UBV file, once it's muxed, has failed or was skipped
+    source: str
+    mac: str
+    camera: Optional[str]
+    status: str
+    outputs: List[str] = field(default_factory=list)
+    bytes_in: int = 0
+    bytes_out: int = 0
+    seconds: float = 0.0
+    returncode: Optional[int] = None
+    error: Optional[str] = None
+
+    @property
+    def ok(self):
+        return self.status != "failed"
@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from utilities.fingerprint import read_sentinel
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ubv_files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    prepared INTEGER NOT NULL DEFAULT 0,
+    muxed INTEGER NOT NULL DEFAULT 0,
+    moved INTEGER NOT NULL DEFAULT 0,
+    outputs TEXT,
+    prepare_seconds REAL,
+    remux_seconds REAL,
+    move_seconds REAL,
+    fingerprint TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL
+);
+"""
+
+
+class StateStore():
+    # Keeps the prepare/remux/move state of every UBV file in SQLite so we
+    # don't need to rediscover it from .txt/.muxed sentinel files. Rows are
+    # keyed by path and are only trusted while size and mtime still match.
+    def __init__(self, path):
+        self.path = path
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self.conn.row_factory = sqlite3.Row
+        with self._lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(SCHEMA)
+            self._migrate()
+        self.logger.debug(f"Opened state store at {path}")
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def _migrate(self):
+        # Stores created before fingerprints were kept lack the column
+        columns = {
+            x['name'] for x in
+            self.conn.execute("PRAGMA table_info(ubv_files)")
+        }
+        if 'fingerprint' not in columns:
+            self.conn.execute(
+                "ALTER TABLE ubv_files ADD COLUMN fingerprint TEXT"
+            )
+
+    def get(self, path):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT * FROM ubv_files WHERE path = ?", (path,)
+            ).fetchone()
+        return self._to_dict(row)
+
+    def lookup(self, path, size, mtime_ns):
+        row = self.get(path)
+        if row and row['size'] == size and row['mtime_ns'] == mtime_ns:
+            return row
+        return None
+
+    def record_file(self, path, size, mtime_ns, prepared, muxed,
+                    fingerprint=None):
+        with self._lock:
+            self.conn.execute(
+                "INSERT INTO ubv_files "
+                "(path, size, mtime_ns, prepared, muxed, moved, fingerprint, "
+                "updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET "
+                "size = excluded.size, mtime_ns = excluded.mtime_ns, "
+                "prepared = excluded.prepared, muxed = excluded.muxed, "
+                "moved = excluded.moved, fingerprint = excluded.fingerprint, "
+                "updated = excluded.updated",
+                (path, size, mtime_ns, int(prepared), int(muxed),
+                 int(muxed), fingerprint, time.time())
+            )
+
+    def files_in(self, folder):
+        # Rows directly inside folder, using the primary key range
+        prefix = folder.rstrip(os.path.sep) + os.path.sep
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT * FROM ubv_files WHERE path >= ? AND path < ? "
+                "ORDER BY path",
+                (prefix, prefix[:-1] + chr(ord(os.path.sep) + 1))
+            ).fetchall()
+        return [
+            self._to_dict(x) for x in rows
+            if os.path.dirname(x['path']) == prefix[:-1]
+        ]
+
+    def get_directory(self, path):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT mtime_ns FROM directories WHERE path = ?", (path,)
+            ).fetchone()
+        return row['mtime_ns'] if row else None
+
+    def set_directory(self, path, mtime_ns):
+        with self._lock:
+            self.conn.execute(
+                "INSERT INTO directories (path, mtime_ns) VALUES (?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET mtime_ns = excluded.mtime_ns",
+                (path, mtime_ns)
+            )
+
+    def set_prepared(self, path, seconds=None):
+        self._update(path, prepared=1, prepare_seconds=seconds)
+
+    def set_remuxed(self, path, seconds=None):
+        self._update(path, remux_seconds=seconds)
+
+    def set_muxed(self, path, outputs=None, seconds=None, record=None):
+        # record is the size, mtime and fingerprint taken once muxed
+        self._update(
+            path, muxed=1, moved=1, outputs=json.dumps(outputs or []),
+            move_seconds=seconds, **(record or {})
+        )
+
+    def import_sentinels(self, root):
+        # Migrate the state held in .txt/.muxed sentinel files
+        self.logger.info(f"Importing sentinel files from {root}")
+        count = 0
+        for folder, _, files in os.walk(root):
+            names = set(files)
+            for name in files:
+                if not name.endswith('.ubv'):
+                    continue
+                path = os.path.join(folder, name)
+                st = os.stat(path)
+                muxed = f"{name}.muxed" in names
+                # Keep what the sentinel saw when it was muxed, so a file
+                # changed since then is checked on the next scan
+                record = read_sentinel(f"{path}.muxed") if muxed else None
+                record = record or {
+                    "size": st.st_size, "mtime_ns": st.st_mtime_ns
+                }
+                self.record_file(
+                    path, record['size'], record['mtime_ns'],
+                    prepared=f"{name}.txt" in names, muxed=muxed,
+                    fingerprint=record.get('fingerprint')
+                )
+                count += 1
+        self.logger.info(f"Imported {count} UBV files into {self.path}")
+        return count
+
+    def _update(self, path, **fields):
+        fields = {k: v for k, v in fields.items() if v is not None}
+        fields['updated'] = time.time()
+        assignments = ", ".join(f"{k} = ?" for k in fields)
+        with self._lock:
+            self.conn.execute(
+                f"UPDATE ubv_files SET {assignments} WHERE path = ?",
+                (*fields.values(), path)
+            )
+
+    @staticmethod
+    def _to_dict(row):
+        if row is None:
+            return None
+        result = dict(row)
+        result['prepared'] = bool(result['prepared'])
+        result['muxed'] = bool(result['muxed'])
+        result['moved'] = bool(result['moved'])
+        result['outputs'] = json.loads(result['outputs'] or '[]')
+        return result
@@ -0,0 +1,103 @@
+import os
+import errno
+import shutil
+import hashlib
+import logging
+
+# Copies are done in large chunks since the destination is usually a NAS
+CHUNK_SIZE = 64 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def same_filesystem(a, b):
+    return os.stat(a).st_dev == os.stat(b).st_dev
+
+
+def move_file(source, destination, verify=False):
+    # Renames when source and destination share a filesystem, otherwise
+    # copies in-kernel where possible. Returns "rename" or "copy".
+    try:
+        os.rename(source, destination)
+        return "rename"
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    partial = f"{destination}.partial"
+    try:
+        copied = copy_file(source, partial)
+        size = os.path.getsize(source)
+        if copied != size:
+            raise IOError(
+                f"Copied {copied} of {size} bytes from {source} to "
+                f"{destination}"
+            )
+        if verify and file_digest(source) != file_digest(partial):
+            raise IOError(
+                f"Checksum mismatch copying {source} to {destination}"
+            )
+        shutil.copystat(source, partial)
+        os.replace(partial, destination)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    os.remove(source)
+    return "copy"
+
+
+def copy_file(source, destination):
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        remaining = os.fstat(src.fileno()).st_size
+        for copier in (_copy_file_range, _sendfile):
+            try:
+                copied = copier(src.fileno(), dst.fileno(), remaining)
+                if copied == remaining:
+                    return copied
+                # Some filesystems return 0 before the end of the file
+                logger.debug(
+                    f"{copier.__name__} stopped after {copied} of "
+                    f"{remaining} bytes"
+                )
+            except OSError as e:
+                if e.errno not in (
+                    errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP
+                ):
+                    raise
+                logger.debug(f"{copier.__name__} unavailable: {e}")
+            except AttributeError:
+                pass
+            # Start over with the next method
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        return dst.tell()
+
+
+def _copy_file_range(src, dst, remaining):
+    copied = 0
+    while copied < remaining:
+        n = os.copy_file_range(src, dst, min(CHUNK_SIZE, remaining - copied))
+        if n == 0:
+            break
+        copied += n
+    return copied
+
+
+def _sendfile(src, dst, remaining):
+    copied = 0
+    while copied < remaining:
+        n = os.sendfile(dst, src, copied, min(CHUNK_SIZE, remaining - copied))
+        if n == 0:
+            break
+        copied += n
+    return copied
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,216 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+# inotify event flags from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE |
+    IN_DELETE_SELF
+)
+EVENT = struct.Struct('iIII')
+
+
+class Inotify():
+    # Just enough of inotify(7) through ctypes to follow a folder tree
+    def __init__(self):
+        libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True
+        )
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.paths = {}
+
+    def add_watch(self, path):
+        wd = self._add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        self.paths[wd] = path
+        return wd
+
+    def read(self, timeout):
+        # Returns [(folder, mask, name)], empty if nothing arrived in time
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 65536)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            events.append((self.paths.get(wd), mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class StabilityTracker():
+    # A file is ready once its size and mtime have stayed the same for the
+    # quiet period, measured from its mtime or from when we last saw it
+    # change, whichever is later.
+    def __init__(self, quiet):
+        self.quiet = quiet
+        self._files = {}
+
+    def __len__(self):
+        return len(self._files)
+
+    def observe(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self._files.pop(path, None)
+            return
+        mtime = st.st_mtime_ns / 1e9
+        seen = self._files.get(path)
+        if seen is None:
+            self._files[path] = (st.st_size, st.st_mtime_ns, mtime)
+        elif seen[:2] != (st.st_size, st.st_mtime_ns):
+            self._files[path] = (st.st_size, st.st_mtime_ns, time.time())
+
+    def ready(self):
+        now = time.time()
+        for path in list(self._files):
+            self.observe(path)
+        ready = [
+            path for path, (_, mtime_ns, changed) in self._files.items()
+            if now - max(changed, mtime_ns / 1e9) >= self.quiet
+        ]
+        for path in ready:
+            del self._files[path]
+        return sorted(ready)
+
+
+class UBVWatcher():
+    # Finds UBV files under root as they arrive, through inotify where the
+    # filesystem supports it and by polling the day folders otherwise, and
+    # hands them on once they've stopped changing. Network mounts usually
+    # need polling, as inotify only sees changes made by this host.
+    def __init__(self, root, quiet=300, interval=30, use_inotify=True):
+        self.root = root
+        self.interval = interval
+        self.tracker = StabilityTracker(quiet)
+        self.logger = logging.getLogger(__name__)
+        self.inotify = None
+        self._folders = {}
+        self._handed = {}
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+            except (OSError, AttributeError) as e:
+                self.logger.warning(
+                    f"inotify is unavailable, polling instead: {e}"
+                )
+
+    def ready_groups(self, stop):
+        # Yields lists of settled UBV paths until stop is set
+        self._scan(self.root)
+        last_scan = time.monotonic()
+        while not stop.is_set():
+            if self.inotify:
+                self._handle(self.inotify.read(min(1, self.interval)))
+                # Rescan now and then in case an event was missed
+                rescan = time.monotonic() - last_scan >= self.interval * 10
+            else:
+                rescan = not stop.wait(self.interval)
+            if rescan:
+                self._scan(self.root)
+                last_scan = time.monotonic()
+            ready = self.tracker.ready()
+            for path in ready:
+                self._handed[path] = self._signature(path)
+            if ready:
+                self.logger.info(f"{len(ready)} UBV files are ready.")
+                yield ready
+        if self.inotify:
+            self.inotify.close()
+
+    def _handle(self, events):
+        for folder, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self.logger.warning("inotify queue overflowed, rescanning.")
+                self._folders.clear()
+                self._scan(self.root)
+                continue
+            if folder is None:
+                continue
+            path = os.path.join(folder, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._scan(path)
+            elif name.endswith('.ubv'):
+                self._observe(path)
+
+    def _observe(self, path):
+        # Files already handed on are only tracked again if they change
+        if path in self._handed and \
+                self._handed[path] == self._signature(path):
+            return
+        self.tracker.observe(path)
+
+    @staticmethod
+    def _signature(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def _scan(self, path):
+        # Lists folders whose mtime changed, watching any new ones, and
+        # tracks the UBV files in them. Unchanged folders are only walked
+        # through to their subfolders.
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+            if self.inotify and path not in self._folders:
+                self.inotify.add_watch(path)
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                self.logger.warning(f"Cannot watch {path}: {e}")
+            return
+        cached = self._folders.get(path)
+        if cached and cached[0] == mtime_ns:
+            for subfolder in cached[1]:
+                self._scan(subfolder)
+            return
+        with os.scandir(path) as it:
+            entries = list(it)
+        subfolders = [
+            x.path for x in entries
+            if x.is_dir(follow_symlinks=False) and not x.name.startswith('.')
+        ]
+        self._folders[path] = (mtime_ns, subfolders)
+        for subfolder in subfolders:
+            self._scan(subfolder)
+        names = {x.name for x in entries}
+        for entry in entries:
+            if entry.name.endswith('.ubv') and \
+                    f"{entry.name}.muxed" not in names:
+                self._observe(entry.path)